@@ -0,0 +1,46 @@
+"""
+Helpers shared by the benchmarks: Django is configured with the test
+settings from runtests.py and a throwaway database is created to seed.
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+
+from django.conf import settings
+
+if not settings.configured:
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import runtests  # noqa: configures settings
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, setup_test_environment
+
+
+def setup():
+    """Create an empty database for the benchmark to seed."""
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0)
+
+
+def measure(func, repeat=5):
+    """
+    Call func repeat times and return the result of the last call and a
+    dict of its number of 'queries' and the best 'sql' and 'wall' times
+    in milliseconds.
+    """
+    best_sql = best_wall = None
+    for i in range(repeat):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.time()
+            result = func()
+            wall = (time.time() - start) * 1000
+        sql = sum(float(query['time']) for query in queries.captured_queries) * 1000
+        best_sql = sql if best_sql is None else min(sql, best_sql)
+        best_wall = wall if best_wall is None else min(wall, best_wall)
+    return result, {'queries': len(queries), 'sql': best_sql, 'wall': best_wall}
+
+
+def report(name, stats):
+    print('%-40s %4d queries %10.1f ms SQL %10.1f ms wall' % (
+        name, stats['queries'], stats['sql'], stats['wall']))
@@ -0,0 +1,68 @@
+"""
+Benchmark generating the BackgroundLabels and Facets of the output_xml
+of a CustomSearchEngine with many background Labels and FacetItems.
+
+    python -m benchmarks.cse_xml [--background-labels N] [--facet-items N]
+
+The previous implementation, which formatted a string for each Label
+and FacetItem, parsed it back into an element and loaded the Label of
+each FacetItem separately, is timed alongside for comparison.
+"""
+from __future__ import print_function
+from optparse import OptionParser
+
+from benchmarks.common import measure, report, setup
+from benchmarks.fixtures import seed
+
+from django.conf import settings
+from lxml import etree as ET
+
+from gcse.models import FacetItem, Label
+
+
+def previous_label_xml(label, complete=True):
+    weight = ''
+    if label.weight and complete:
+        weight = ' weight="%s"' % label.weight
+    return '<Label name="%s" mode="%s"%s/>' % (label.name, label.get_mode_display(), weight)
+
+
+def previous_xml(cse):
+    background = ET.XML("<BackgroundLabels />")
+    for label in cse.background_labels.all():
+        background.append(ET.XML(previous_label_xml(label)))
+    context = ET.XML("<Context />")
+    num_facet_items = settings.GCSE_CONFIG.get('NUM_FACET_ITEMS_PER_FACET')
+    for i, facet_item in enumerate(cse.facetitem_set.filter(label__isnull=False)):
+        if i % num_facet_items == 0:
+            facet_el = ET.XML("<Facet />")
+            context.append(facet_el)
+        facet_el.append(ET.XML('<FacetItem title="%s">%s</FacetItem>' % (
+                    facet_item.title, previous_label_xml(facet_item.label, complete=False))))
+    return ET.tostring(background, encoding='unicode'), ET.tostring(context, encoding='unicode')
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--background-labels', type='int', default=500)
+    parser.add_option('--facet-items', type='int', default=200)
+    options, args = parser.parse_args()
+
+    setup()
+    cse = seed(100, 10, 1)[0]
+    Label.objects.bulk_create([Label(name='background%d' % i, background=True, weight=0.5)
+                               for i in range(options.background_labels)] +
+                              [Label(name='facet%d' % i) for i in range(options.facet_items)])
+    cse.background_labels.add(*Label.objects.filter(name__startswith='background'))
+    FacetItem.objects.bulk_create([FacetItem(cse=cse, title=label.name, label=label, order=i)
+                                   for i, label in enumerate(Label.objects.filter(name__startswith='facet'))])
+    print('%d background Labels, %d FacetItems' % (cse.background_labels.count(), cse.facetitem_set.count()))
+
+    result, stats = measure(lambda: (cse._background_labels_xml(), cse._facets_xml()))
+    report('element builders', stats)
+    previous, stats = measure(lambda: previous_xml(cse))
+    report('previous string parsing', stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+A synthetic dataset for the benchmarks, written with bulk inserts so
+large fixtures can be created quickly.
+"""
+import random
+
+from gcse.models import Annotation, CustomSearchEngine, FacetItem, Label
+from gcse import search  # after the models it indexes
+
+
+def seed(num_annotations, num_labels, num_cses):
+    """
+    Create CustomSearchEngines, each with a background Label and
+    FacetItems for some of the other Labels, and Annotations with a
+    background Label and a few other Labels.
+    """
+    random.seed(0)
+    cses = [CustomSearchEngine.objects.create(gid='cse%d' % i, title='CSE %d' % i)
+            for i in range(num_cses)]
+    Label.objects.bulk_create([Label(name='_cse_cse%d' % i, background=True) for i in range(num_cses)] +
+                              [Label(name='label%d' % i) for i in range(num_labels)])
+    backgrounds = list(Label.objects.filter(background=True).order_by('id'))
+    labels = list(Label.objects.filter(background=False).order_by('id'))
+    facet_items = []
+    for cse, background in zip(cses, backgrounds):
+        cse.background_labels.add(background)
+        facet_items.extend(FacetItem(cse=cse, title=label.name, label=label, order=i)
+                           for i, label in enumerate(random.sample(labels, min(12, len(labels)))))
+    FacetItem.objects.bulk_create(facet_items)
+
+    statuses = [Annotation.STATUS.active] * 8 + [Annotation.STATUS.submitted, Annotation.STATUS.deleted]
+    annotations = []
+    for i in range(num_annotations):
+        comment = 'Annotation %d' % i
+        annotations.append(Annotation(comment=comment, original_url='http://example.com/%d/' % i,
+                                      status=random.choice(statuses), **Annotation.derived_fields(comment)))
+    Annotation.objects.bulk_create(annotations, batch_size=500)
+    through = Annotation.labels.through
+    links = []
+    for annotation_id in Annotation.objects.values_list('id', flat=True):
+        chosen = set([random.choice(backgrounds).id] + [label.id for label in random.sample(labels, 3)])
+        links.extend(through(annotation_id=annotation_id, label_id=label_id) for label_id in chosen)
+    through.objects.bulk_create(links, batch_size=500)
+    # written without signals so bring the Annotation Includes and the
+    # search index up to date
+    CustomSearchEngine.refresh_includes([cse.gid for cse in cses])
+    search.get_backend().rebuild()
+    return cses
@@ -0,0 +1,47 @@
+"""
+Benchmark counting the Annotations of each of a CustomSearchEngine's
+Labels, as listed by the CSELabelList view, on a large fixture.
+
+    python -m benchmarks.labels_counts [--annotations N] [--labels N] [--cses N]
+
+The previous implementation, which counted every Annotation having any
+of the Labels whatever its status or CustomSearchEngine, is timed
+alongside for comparison.
+"""
+from __future__ import print_function
+from optparse import OptionParser
+
+from benchmarks.common import measure, report, setup
+from benchmarks.fixtures import seed
+
+from django.db.models import Count, Q
+
+from gcse.models import Annotation
+
+
+def previous_labels_counts(cse, labels):
+    annotations = Annotation.objects.filter(Q(labels__in=labels) | Q(labels__in=cse.background_labels.all())).\
+        values('labels__id').order_by().annotate(Count('labels__id'))
+    count_by_id = dict([(x['labels__id'], x['labels__id__count']) for x in annotations])
+    return [(label, count_by_id.setdefault(label.id, 0)) for label in labels]
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--annotations', type='int', default=100000)
+    parser.add_option('--labels', type='int', default=500)
+    parser.add_option('--cses', type='int', default=20)
+    options, args = parser.parse_args()
+
+    setup()
+    cse = seed(options.annotations, options.labels, options.cses)[0]
+    print('%d Annotations, %d Labels, %d CustomSearchEngines' % (
+        options.annotations, options.labels + options.cses, options.cses))
+    result, stats = measure(lambda: cse.all_labels().annotation_counts(cse))
+    report('LabelQuerySet.annotation_counts', stats)
+    previous, stats = measure(lambda: previous_labels_counts(cse, list(cse.all_labels())))
+    report('previous _labels_counts', stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""
+Benchmark every named route in gcse.urls on a synthetic dataset.
+
+    python -m benchmarks.routes [--annotations N] [--labels N] [--cses N] [--record]
+
+Each route is requested once to warm up and then timed, reporting its
+number of queries, total SQL time and wall time. The process exits with
+an error when a route runs more queries than its budget in
+benchmarks/budgets.json; --record writes the measured counts as the
+new budgets instead.
+
+The Annotation file and page caches are disabled so the queries
+needed to render each page are counted.
+"""
+from __future__ import print_function
+from optparse import OptionParser
+import json
+import os
+import sys
+
+from benchmarks.common import measure, report, setup
+from benchmarks.fixtures import seed
+
+from django.conf import settings
+from django.core.urlresolvers import RegexURLPattern, reverse
+from django.test.client import Client
+from mock import patch
+
+from gcse import urls
+from gcse.models import Annotation
+
+
+BUDGETS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'budgets.json')
+
+
+def route_names():
+    return [pattern.name for pattern in urls.urlpatterns
+            if isinstance(pattern, RegexURLPattern) and pattern.name]
+
+
+def route_urls(cse):
+    """Return a dict mapping each route name to a URL showing the CustomSearchEngine's content."""
+    label = cse.background_labels.all()[0]
+    annotation = cse.annotations().order_by('id')[0]
+    return {
+        'gcse_cse': reverse('gcse_cse', args=(cse.gid,)),
+        'gcse_annotations': reverse('gcse_annotations', args=(cse.gid, 1)),
+        'gcse_cse_list': reverse('gcse_cse_list'),
+        'gcse_cse_detail': reverse('gcse_cse_detail', args=(cse.gid,)),
+        'gcse_results': reverse('gcse_results', args=(cse.gid,)),
+        'gcse_annotation_list': reverse('gcse_annotation_list'),
+        'gcse_search': reverse('gcse_search') + '?q=annotation',
+        'gcse_annotation_detail': reverse('gcse_annotation_detail', args=(annotation.id,)),
+        'gcse_cse_annotation_list': reverse('gcse_cse_annotation_list', args=(cse.gid,)),
+        'gcse_label_list': reverse('gcse_label_list'),
+        'gcse_label_detail': reverse('gcse_label_detail', args=(label.id,)),
+        'gcse_cse_label_list': reverse('gcse_cse_label_list', args=(cse.gid,)),
+        'gcse_cse_label_detail': reverse('gcse_cse_label_detail', args=(cse.gid, label.id)),
+        }
+
+
+def _fetch(client, url):
+    response = client.get(url)
+    if response.status_code != 200:
+        raise AssertionError('%s returned %d' % (url, response.status_code))
+    if response.streaming:
+        # the queries run as the content is read
+        b''.join(response.streaming_content)
+    return response
+
+
+def run(cse, repeat=3):
+    """Return a dict mapping each route name to its measurements."""
+    client = Client()
+    route_url = route_urls(cse)
+    missing = set(route_names()) - set(route_url)
+    if missing:
+        raise AssertionError('No URL to benchmark for the routes: %s' % ', '.join(sorted(missing)))
+    results = {}
+    with patch.dict(settings.GCSE_CONFIG, {'ANNOTATION_FEED_CACHE_TIMEOUT': 0,
+                                           'PAGE_CACHE_TIMEOUT': 0}):
+        for name in route_names():
+            url = route_url[name]
+            # computes the Annotation counts
+            _fetch(client, url)
+            response, results[name] = measure(lambda: _fetch(client, url), repeat)
+    return results
+
+
+def over_budget(results, budgets):
+    """Return the names of the routes running more queries than their budgets."""
+    return [name for name, stats in sorted(results.items())
+            if name not in budgets or stats['queries'] > budgets[name]]
+
+
+def load_budgets():
+    with open(BUDGETS) as budgets:
+        return json.load(budgets)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--annotations', type='int', default=200000)
+    parser.add_option('--labels', type='int', default=2000)
+    parser.add_option('--cses', type='int', default=50)
+    parser.add_option('--record', action='store_true', default=False,
+                      help='Write the query counts as the new budgets')
+    options, args = parser.parse_args()
+
+    setup()
+    cse = seed(options.annotations, options.labels, options.cses)[0]
+    print('%d Annotations, %d Labels, %d CustomSearchEngines' % (
+        Annotation.objects.count(), options.labels + options.cses, options.cses))
+    results = run(cse)
+    for name in route_names():
+        report(name, results[name])
+
+    if options.record:
+        with open(BUDGETS, 'w') as budgets:
+            json.dump(dict((name, stats['queries']) for name, stats in results.items()),
+                      budgets, indent=4, separators=(',', ': '), sort_keys=True)
+            budgets.write('\n')
+        return
+    budgets = load_budgets()
+    failed = over_budget(results, budgets)
+    for name in failed:
+        print('%s ran %d queries; its budget is %s' % (name, results[name]['queries'], budgets.get(name)))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
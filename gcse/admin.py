@@ -4,10 +4,13 @@ from django.http import HttpResponseRedirect
 from django.core.urlresolvers import reverse
 from django.shortcuts import render_to_response, get_object_or_404
 from django.contrib import admin
+from django.db.models import Q
 from django.forms import ModelForm, CharField, Textarea
 from django.forms.models import ModelChoiceField, ModelMultipleChoiceField
 from django.template.loader import render_to_string
-from gcse.models import Label, Annotation, CustomSearchEngine, FacetItem
+from django.utils import timezone
+from gcse import jobs
+from gcse.models import Label, Annotation, CustomSearchEngine, FacetItem, Job
 from ordered_model.admin import OrderedModelAdmin
 
 
@@ -30,6 +33,14 @@ class CustomSearchEngineAdmin(admin.ModelAdmin):
     save_on_top = True
     readonly_fields = ('output_xml', 'creator', 'created', 'modified')
     form = CustomSearchEngineForm
+    actions = ['rebuild_xml']
+
+    def rebuild_xml(self, request, queryset):
+        gids = list(queryset.values_list('gid', flat=True))
+        for gid in gids:
+            jobs.enqueue(Job.KIND.rebuild_cse_xml, gid=gid)
+        self.message_user(request, "Queued %d Jobs rebuilding the XML" % len(gids))
+    rebuild_xml.short_description = "Rebuild the XML in the background"
 
 admin.site.register(CustomSearchEngine, CustomSearchEngineAdmin)
 
@@ -100,3 +111,26 @@ class FacetItemAdmin(OrderedModelAdmin):
     list_display = ('title', 'move_up_down_links')
 
 admin.site.register(FacetItem, FacetItemAdmin)
+
+
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'source', 'upload', 'gid', 'status', 'progress', 'total', 'attempts',
+                    'created', 'finished')
+    list_filter = ('status', 'kind')
+    fields = ('kind', 'source', 'upload', 'gid', 'bulk', 'status', 'progress', 'total', 'attempts',
+              'run_after', 'started', 'finished', 'message')
+    readonly_fields = ('status', 'progress', 'total', 'attempts', 'run_after', 'started', 'finished', 'message')
+    actions = ['retry']
+
+    def retry(self, request, queryset):
+        retry = Q(status=Job.STATUS.failed)
+        stale = jobs.stale_before()
+        if stale is not None:
+            # abandoned by their workers
+            retry |= Q(status=Job.STATUS.running, modified__lt=stale)
+        count = queryset.filter(retry).update(status=Job.STATUS.queued, attempts=0, message='',
+                                              run_after=timezone.now(), finished=None)
+        self.message_user(request, "Queued %d Jobs to run again" % count)
+    retry.short_description = "Run the failed or stuck Jobs again"
+
+admin.site.register(Job, JobAdmin)
@@ -1,29 +1,32 @@
 from django.shortcuts import render_to_response, get_object_or_404
 from django.http import HttpResponseRedirect
+from django.core.urlresolvers import reverse
 from django.db import transaction
 from django.template import loader, Context
 from django.core.mail import send_mail
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.sites.models import Site
 from django.conf import settings
-from gcse.models import AnnotationSAXHandler, Annotation
+from gcse import jobs
+from gcse.models import Annotation, Job
 from gcse.forms import ImportForm
 
 
 @staff_member_required
 @transaction.autocommit
 def importAnnotations(request):
-    """Import the content of an Annotations file"""
+    """Queue a Job importing the content of an Annotations file"""
     if request.method == 'POST':
         form = ImportForm(request.POST, request.FILES)
         if form.is_valid():
-            handler = AnnotationSAXHandler()
             if form.cleaned_data['url'] != '':
-                handler.parse(str(form.cleaned_data['url']))
+                job = jobs.enqueue(Job.KIND.import_annotations, source=str(form.cleaned_data['url']))
             else:
-                handler.parseString(request.FILES['fileName'].read())
-            # redirect to the annotation screen to see the results
-            return HttpResponseRedirect('/admin/cse/annotation/')
+                upload = request.FILES['fileName']
+                job = Job(kind=Job.KIND.import_annotations)
+                job.upload.save(upload.name, upload)
+            # redirect to the job to follow the import's progress
+            return HttpResponseRedirect(reverse('admin:gcse_job_change', args=(job.pk,)))
     else:
         form = ImportForm()
     return render_to_response('admin/cse/import.html', {'form': form})
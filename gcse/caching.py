@@ -0,0 +1,148 @@
+"""
+Generation counters used to invalidate cached gcse content.
+
+Every CustomSearchEngine has a generation stored in the Django cache
+which is advanced whenever anything its XML, Annotation files or pages
+are built from changes. Cache keys include the generation so stale
+entries are never read again and simply expire.
+
+Pages not belonging to a single CustomSearchEngine use the generations
+of the scopes below: CSES, LABELS and ANNOTATIONS change with any
+CustomSearchEngine (or its Labels and FacetItems), Label or Annotation
+respectively and label_scope() with a Label or its Annotations. They
+can't clash with gids, which never contain ':'. annotation_scope()
+changes with an Annotation's Labels.
+
+Generations are millisecond timestamps so they never go backwards when
+evicted from the cache and double as the time the content last changed.
+
+The generations are only seen by every process when the default cache
+is shared between them, e.g. memcached, Redis, a database or file based
+cache. A generation advanced by an admin request or a 'run_gcse_jobs'
+or 'rebuild_cse_xml' worker never reaches the web processes through a
+local-memory cache, so with one caching is disabled and conditional
+requests aren't answered, unless GCSE_CONFIG['CACHE_SHARED'] says the
+site runs in a single process.
+"""
+import hashlib
+import math
+import time
+import warnings
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+
+
+GENERATION_KEY = 'gcse:generation:%s'
+# generations are recreated from the clock if evicted so they don't need to live forever
+GENERATION_TIMEOUT = 60 * 60 * 24 * 7
+FEED_KEY = 'gcse:feed:%s:%s:%s:%s:%s'
+PAGE_KEY = 'gcse:page:%s:%s:%s'
+LABEL_LINKS_KEY = 'gcse:label_links:%s:%s:%s:%s'
+
+CSES = 'cses:'
+LABELS = 'labels:'
+ANNOTATIONS = 'annotations:'
+
+
+def is_shared():
+    """Whether the default cache is seen by every process of the site."""
+    shared = settings.GCSE_CONFIG.get('CACHE_SHARED')
+    if shared is None:
+        return not isinstance(cache, LocMemCache)
+    return shared
+
+
+def timeout(name):
+    """
+    Return the GCSE_CONFIG cache timeout with the name, or 0 to disable
+    the caching when the cache isn't shared between processes.
+    """
+    value = settings.GCSE_CONFIG.get(name)
+    if value and not is_shared():
+        warnings.warn("GCSE_CONFIG['%s'] is ignored as the default cache is local to each process; "
+                      "configure a shared cache or set GCSE_CONFIG['CACHE_SHARED']" % name,
+                      RuntimeWarning)
+        return 0
+    return value
+
+
+def _now():
+    return int(time.time() * 1000)
+
+
+def generation(scope):
+    """Return the current generation for the scope (e.g. a CSE gid)."""
+    key = GENERATION_KEY % scope
+    value = cache.get(key)
+    if value is None:
+        value = _now()
+        if not cache.add(key, value, GENERATION_TIMEOUT):
+            # another request initialized it first
+            value = cache.get(key, value)
+    return value
+
+
+def generations(scopes):
+    """Return a dict of the current generation of each scope, read from the cache together."""
+    keys = dict((GENERATION_KEY % scope, scope) for scope in set(scopes))
+    values = cache.get_many(list(keys))
+    return dict((scope, values[key] if key in values else generation(scope))
+                for key, scope in keys.items())
+
+
+def bump_generation(*scopes):
+    """Advance the generation of each scope invalidating its cached content."""
+    now = _now()
+    for scope in set(scopes):
+        key = GENERATION_KEY % scope
+        cache.set(key, max(now, (cache.get(key) or 0) + 1), GENERATION_TIMEOUT)
+
+
+def last_modified(version):
+    """
+    Return the generation as whole seconds since the epoch, rounded up,
+    or None until that second has passed: If-Modified-Since only has
+    whole seconds so a change later in the same second would otherwise
+    be answered as not modified.
+    """
+    seconds = int(math.ceil(version / 1000.0))
+    if _now() <= seconds * 1000:
+        return None
+    return seconds
+
+
+def feed_key(gid, page, after, per_page, version):
+    return FEED_KEY % (gid, page, after, per_page, version)
+
+
+def label_scope(label_id):
+    return 'label:%s' % label_id
+
+
+def annotation_scope(annotation_id):
+    return 'annotation:%s' % annotation_id
+
+
+def label_links_keys(annotations):
+    """
+    Return the keys of the rendered Label links of the (id, modified)
+    pairs of Annotations, valid until the Annotation or any Label
+    changes. The generations are read together.
+    """
+    versions = generations([LABELS] + [annotation_scope(annotation_id) for annotation_id, modified in annotations])
+    return [LABEL_LINKS_KEY % (annotation_id, modified.isoformat(),
+                               versions[annotation_scope(annotation_id)], versions[LABELS])
+            for annotation_id, modified in annotations]
+
+
+def label_links_key(annotation_id, modified):
+    """The key of an Annotation's rendered Label links; see label_links_keys()."""
+    return label_links_keys([(annotation_id, modified)])[0]
+
+
+def page_key(view_name, path, versions):
+    """The key of a rendered page; the path is hashed to keep the key short and free of spaces."""
+    return PAGE_KEY % (view_name, hashlib.md5(path.encode('utf-8')).hexdigest(),
+                       '-'.join(str(version) for version in versions))
@@ -0,0 +1,110 @@
+"""
+Maintained counts of active Annotations: in total, per Label and per
+CustomSearchEngine, stored as AnnotationCount rows.
+
+Counts are computed the first time they are read and then adjusted by
+the handlers in gcse.signals as Annotations change status or Labels.
+Changes whose effect is costly to work out (e.g. a CustomSearchEngine's
+background Labels changing, or bulk imports) invalidate the counts
+instead so they are recomputed when next read.
+
+The 'rebuild_gcse_counters' management command recomputes every count.
+"""
+from django.db import IntegrityError
+from django.db.models import Count, F
+
+from gcse.models import Annotation, AnnotationCount, CustomSearchEngine, atomic
+
+
+ALL = AnnotationCount.SCOPE.all
+LABEL = AnnotationCount.SCOPE.label
+CSE = AnnotationCount.SCOPE.cse
+# objects read or computed per query
+BATCH_SIZE = 500
+
+
+def _active():
+    return Annotation.objects.filter(status=Annotation.STATUS.active)
+
+
+def _compute(scope, object_ids):
+    """Return a dict of the counts of the objects in the scope."""
+    if scope == ALL:
+        return {0: _active().count()}
+    counts = dict((object_id, 0) for object_id in object_ids)
+    if scope == LABEL:
+        rows = _active().filter(labels__in=object_ids).values_list('labels').\
+            order_by().annotate(Count('id', distinct=True))
+    else:
+        rows = CustomSearchEngine.objects.filter(pk__in=object_ids,
+                                                 background_labels__annotation__status=Annotation.STATUS.active).\
+            values_list('pk').order_by().annotate(Count('background_labels__annotation', distinct=True))
+    counts.update(rows)
+    return counts
+
+
+def counts(scope, object_ids):
+    """Return a dict of the counts of active Annotations of the objects in the scope."""
+    object_ids = list(object_ids)
+    result = {}
+    for i in range(0, len(object_ids), BATCH_SIZE):
+        result.update(_counts(scope, object_ids[i:i + BATCH_SIZE]))
+    return result
+
+
+def _counts(scope, object_ids):
+    result = dict(AnnotationCount.objects.filter(scope=scope, object_id__in=object_ids).
+                  values_list('object_id', 'count'))
+    missing = [object_id for object_id in object_ids if object_id not in result]
+    if missing:
+        computed = _compute(scope, missing)
+        try:
+            with atomic():
+                AnnotationCount.objects.bulk_create(AnnotationCount(scope=scope, object_id=object_id, count=count)
+                                                    for object_id, count in computed.items())
+        except IntegrityError:
+            # computed concurrently; these values are as good
+            pass
+        result.update(computed)
+    return result
+
+
+def count(scope, object_id=0):
+    """Return the count of active Annotations of a single object in the scope."""
+    return counts(scope, [object_id])[object_id]
+
+
+def adjust(scope, object_ids, delta):
+    """Add delta to the counts of the objects; counts not yet computed are left to be computed."""
+    object_ids = list(object_ids)
+    if object_ids and delta:
+        AnnotationCount.objects.filter(scope=scope, object_id__in=object_ids).\
+            update(count=F('count') + delta)
+
+
+def invalidate(scope, object_ids=None):
+    """Discard the counts of the objects, or of all the objects in the scope, to be recomputed."""
+    counts = AnnotationCount.objects.filter(scope=scope)
+    if object_ids is not None:
+        object_ids = list(object_ids)
+        if not object_ids:
+            return
+        counts = counts.filter(object_id__in=object_ids)
+    counts.delete()
+
+
+def clear():
+    """Discard every count, to be recomputed."""
+    AnnotationCount.objects.all().delete()
+
+
+def rebuild():
+    """Recompute the total, Label and CustomSearchEngine counts. Returns the number of counts."""
+    with atomic():
+        clear()
+        total = 1
+        count(ALL)
+        label_ids = _active().values_list('labels', flat=True).order_by().distinct()
+        total += len(counts(LABEL, [label_id for label_id in label_ids if label_id is not None]))
+        total += len(counts(CSE, CustomSearchEngine.objects.values_list('pk', flat=True)))
+    return total
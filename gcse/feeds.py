@@ -0,0 +1,87 @@
+"""
+Incremental rendering of the Annotations XML files Google retrieves via
+the 'Include' elements of a CustomSearchEngine.
+"""
+from __future__ import unicode_literals
+
+from django.utils.html import escape, strip_spaces_between_tags
+
+from gcse.models import Annotation
+
+
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8" ?>\n'
+
+
+class KeysetPage(object):
+    """
+    A page of Annotations following the Annotation with id 'after'.
+
+    Provides the parts of django.core.paginator.Page used by
+    annotations_xml() but reads the page with an index seek on the
+    Annotation id so every page costs the same regardless of its
+    position. 'number' is the one based number of the page, as for
+    django.core.paginator.Page. 'count', the total number of
+    Annotations, is counted from the queryset unless supplied, e.g.
+    from gcse.counters.
+    """
+
+    class _Paginator(object):
+        def __init__(self, count):
+            self.count = count
+
+    def __init__(self, queryset, number, after, per_page, count=None):
+        queryset = queryset.order_by('id').distinct()
+        ids = list(queryset.filter(id__gt=after).values_list('id', flat=True)[:per_page])
+        if ids:
+            self.object_list = queryset.filter(id__gt=after, id__lte=ids[-1])
+        else:
+            self.object_list = queryset.none()
+        self.paginator = self._Paginator(queryset.count() if count is None else count)
+        self.number = number
+        self._start = (number - 1) * per_page + 1
+        self._length = len(ids)
+
+    def start_index(self):
+        if not self._length:
+            return 0
+        return self._start
+
+    def end_index(self):
+        if not self._length:
+            return 0
+        return self._start + self._length - 1
+
+
+def annotation_xml(annotation, label_names):
+    """Return the XML for a single Annotation with the supplied Label names."""
+    parts = ['<Annotation about="%s">' % escape(annotation.about)]
+    for name in label_names:
+        parts.append('<Label name="%s" />' % escape(name))
+    if annotation.original_url:
+        parts.append('<AdditionalData attribute="original_url" value="%s"/>' % escape(annotation.original_url))
+    if annotation.comment:
+        parts.append('<Comment>%s</Comment>' % escape(annotation.comment))
+    parts.append('</Annotation>')
+    # matches the {% spaceless %} block of the 'gcse/annotation.xml' template
+    return strip_spaces_between_tags(''.join(parts))
+
+
+def annotations_xml(page):
+    """
+    Generate the Annotations XML for a Paginator page of Annotations.
+
+    The output is identical to rendering the 'gcse/annotation.xml'
+    template but is yielded in chunks: the header is produced before
+    any Annotation is fetched and the Annotations are iterated without
+    caching them in the QuerySet. The page's QuerySet must be ordered
+    so the Labels, which are loaded for the whole page in one query,
+    match the Annotations that are streamed.
+    """
+    yield XML_HEADER
+    yield '<Annotations start="%d" num="%d" total="%d">\n' % (page.start_index(),
+                                                            page.end_index(),
+                                                            page.paginator.count)
+    label_names = Annotation.label_names(page.object_list.values_list('id', flat=True))
+    for annotation in page.object_list.iterator():
+        yield annotation_xml(annotation, label_names.get(annotation.id, []))
+    yield '\n</Annotations>\n'
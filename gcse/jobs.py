@@ -0,0 +1,188 @@
+"""
+A queue of Jobs stored in the database, so imports and XML rebuilds
+queued from the admin run out of band rather than within a request.
+
+The 'run_gcse_jobs' management command claims and runs the queued
+Jobs. Several workers can run at once: a Job is claimed by the worker
+whose UPDATE of its status succeeds. Each Job records its progress and
+its outcome, or the error it failed with, for the admin to show.
+
+Failures to fetch a file, e.g. a timeout or a 5xx response, are
+retried up to GCSE_CONFIG['JOB_MAX_ATTEMPTS'] times, waiting
+GCSE_CONFIG['JOB_RETRY_DELAY'] seconds, doubled after each attempt.
+Nothing has been written when a fetch fails so retrying is safe.
+Uploaded files are deleted once their Job is done or has failed.
+
+A running Job reports its progress as it goes. One that hasn't for
+GCSE_CONFIG['JOB_STALE_TIMEOUT'] seconds is taken as abandoned, e.g.
+by a worker that was killed, and is queued to run again, or failed once
+it has been attempted GCSE_CONFIG['JOB_MAX_ATTEMPTS'] times. The
+timeout should be longer than any Job runs between progress reports.
+A worker whose Job was claimed again meanwhile leaves its outcome to
+the new claim.
+"""
+import datetime
+import io
+import socket
+import traceback
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from django.utils.six.moves.urllib.error import HTTPError, URLError
+
+from gcse.models import Annotation, CustomSearchEngine, Job, _download
+
+
+try:
+    # socket.error is OSError, raised for missing files too
+    NETWORK_ERRORS = (ConnectionError, socket.timeout, socket.gaierror, socket.herror)
+except NameError:
+    # Python 2, where socket.error is only raised for network failures
+    NETWORK_ERRORS = (socket.error,)
+
+
+class TransientError(Exception):
+    """A failure worth retrying the Job for."""
+
+
+def _is_transient(error):
+    if isinstance(error, HTTPError):
+        return error.code >= 500 or error.code == 429
+    return isinstance(error, (TransientError, URLError) + NETWORK_ERRORS)
+
+
+def _fetch(url):
+    """Download the file at the url into a temporary file."""
+    try:
+        return _download(url)
+    except Exception as e:
+        if _is_transient(e):
+            raise TransientError('Failed to fetch %s: %s' % (url, e))
+        raise
+
+
+def import_annotations(job):
+    if job.source:
+        source = _fetch(job.source)
+    elif job.upload:
+        # the bytes as uploaded so the parser reads their declared encoding
+        source = job.upload.storage.open(job.upload.name, 'rb')
+    else:
+        source = io.BytesIO(job.data.encode('utf-8'))
+    handler = Annotation._sax_handler(Annotation, job.bulk, collect=False)
+    handler.progress = job.report_progress
+    with source:
+        handler.parse(source)
+    job.report_progress(handler.count, handler.count)
+    return 'Imported %d Annotations' % handler.count
+
+
+def import_cse(job):
+    cse = CustomSearchEngine.from_url(job.source, import_linked_annotations=True, bulk=job.bulk,
+                                      progress=job.report_progress)
+    return 'Imported Custom Search Engine %s' % cse.gid
+
+
+def rebuild_cse_xml(job):
+    cses = CustomSearchEngine.objects.order_by('id')
+    if job.gid:
+        cses = cses.filter(gid=job.gid)
+    pks = list(cses.values_list('pk', flat=True))
+    job.report_progress(0, len(pks))
+    changed = 0
+    for i, pk in enumerate(pks, 1):
+        changed += CustomSearchEngine.objects.get(pk=pk).rebuild_xml()
+        job.report_progress(i)
+    return 'Rebuilt %d of %d Custom Search Engines' % (changed, len(pks))
+
+
+RUNNERS = {
+    Job.KIND.import_annotations: import_annotations,
+    Job.KIND.import_cse: import_cse,
+    Job.KIND.rebuild_cse_xml: rebuild_cse_xml,
+    }
+
+
+def enqueue(kind, **fields):
+    """Queue a Job of the kind to be run by a worker."""
+    return Job.objects.create(kind=kind, **fields)
+
+
+def stale_before(now=None):
+    """
+    Return the time running Jobs last reporting progress before are
+    taken as abandoned, or None if they never are.
+    """
+    timeout = settings.GCSE_CONFIG.get('JOB_STALE_TIMEOUT')
+    if not timeout:
+        return None
+    return (now or timezone.now()) - datetime.timedelta(seconds=timeout)
+
+
+def requeue_stale(now=None):
+    """Queue the abandoned running Jobs to run again, or fail those out of attempts."""
+    now = now or timezone.now()
+    cutoff = stale_before(now)
+    if cutoff is None:
+        return
+    stale = Job.objects.filter(status=Job.STATUS.running, modified__lt=cutoff)
+    stale.filter(attempts__gte=settings.GCSE_CONFIG.get('JOB_MAX_ATTEMPTS')).\
+        update(status=Job.STATUS.failed, message='Abandoned by its worker', finished=now, modified=now)
+    stale.update(status=Job.STATUS.queued, message='Abandoned by its worker, retrying', run_after=now, modified=now)
+
+
+def claim():
+    """Mark the next Job due to run as running and return it, or None."""
+    now = timezone.now()
+    requeue_stale(now)
+    due = Job.objects.filter(status=Job.STATUS.queued, run_after__lte=now).order_by('run_after', 'id')
+    for pk in due.values_list('pk', flat=True)[:10]:
+        # another worker may claim it first
+        if Job.objects.filter(pk=pk, status=Job.STATUS.queued).\
+                update(status=Job.STATUS.running, attempts=F('attempts') + 1, started=now, modified=now):
+            return Job.objects.get(pk=pk)
+    return None
+
+
+def _finish(job, status, message, **fields):
+    job.status = status
+    job.message = message
+    now = timezone.now()
+    upload = None
+    if status != Job.STATUS.queued:
+        fields['finished'] = now
+        if job.upload:
+            # the upload won't be read again
+            upload = job.upload.name
+            fields['upload'] = ''
+    for field, value in fields.items():
+        setattr(job, field, value)
+    # only while this worker's claim holds; another may have reclaimed the Job
+    if Job.objects.filter(pk=job.pk, status=Job.STATUS.running, started=job.started).\
+            update(status=status, message=message, modified=now, **fields) and upload:
+        job.upload.storage.delete(upload)
+
+
+def run(job):
+    """Run a claimed Job, recording its outcome. Transient failures requeue it."""
+    try:
+        message = RUNNERS[job.kind](job)
+    except Exception as e:
+        if _is_transient(e) and job.attempts < settings.GCSE_CONFIG.get('JOB_MAX_ATTEMPTS'):
+            delay = settings.GCSE_CONFIG.get('JOB_RETRY_DELAY') * 2 ** (job.attempts - 1)
+            _finish(job, Job.STATUS.queued, 'Attempt %d failed, retrying in %d seconds: %s' % (job.attempts, delay, e),
+                    run_after=timezone.now() + datetime.timedelta(seconds=delay))
+        else:
+            _finish(job, Job.STATUS.failed, traceback.format_exc())
+    else:
+        _finish(job, Job.STATUS.done, message)
+    return job
+
+
+def run_next():
+    """Claim and run the next Job due, returning it, or None if there is none."""
+    job = claim()
+    if job is not None:
+        run(job)
+    return job
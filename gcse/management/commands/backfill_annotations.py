@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from gcse.models import Annotation
+
+
+class Command(BaseCommand):
+    args = ''
+    help = "Recompute the Annotations' denormalized columns, e.g. after upgrading django-gcse"
+
+    def handle(self, *args, **options):
+        batch_size = 1000
+        count = 0
+        last_id = 0
+        while True:
+            rows = list(Annotation.objects.filter(id__gt=last_id).order_by('id').
+                        values('id', 'comment', 'sort_key', 'first_letter')[:batch_size])
+            if not rows:
+                break
+            for row in rows:
+                values = Annotation.derived_fields(row['comment'])
+                if any(row[field] != value for field, value in values.items()):
+                    count += Annotation.objects.filter(id=row['id']).update(**values)
+            last_id = rows[-1]['id']
+        self.stdout.write('Updated %d Annotations' % count)
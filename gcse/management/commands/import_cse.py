@@ -1,3 +1,5 @@
+from optparse import make_option
+
 from django.core.management.base import BaseCommand
 from gcse.models import CustomSearchEngine
 
@@ -5,11 +7,35 @@ from gcse.models import CustomSearchEngine
 class Command(BaseCommand):
     args = 'url_to_cse_xml'
     help = 'Import XML feed into CustomSearchEngine including Annotations'
+    option_list = BaseCommand.option_list + (
+        make_option('--bulk',
+                    action='store_true',
+                    dest='bulk',
+                    default=False,
+                    help='Import the Annotations in batches; much faster for large Annotations files'),
+        make_option('--incremental',
+                    action='store_true',
+                    dest='incremental',
+                    default=False,
+                    help='Only write the Annotations which differ from those already imported'),
+        make_option('--threads',
+                    type='int',
+                    dest='threads',
+                    default=None,
+                    help='Number of Annotations files to download concurrently'),
+        )
 
     def handle(self, *args, **options):
         if len(args) != 1:
             self.stderr.write("Incorrect number of arguments. import_cse " + Command.args)
             exit()
         url = args[0]
-        cse = CustomSearchEngine.from_url(url, import_linked_annotations=True)
+        if options.get('incremental'):
+            cse, counts = CustomSearchEngine.sync_from_url(url, threads=options.get('threads'))
+            self.stdout.write("Annotations inserted: %(inserted)d updated: %(updated)d "
+                              "deleted: %(deleted)d unchanged: %(unchanged)d" % counts)
+            return
+        cse = CustomSearchEngine.from_url(url, import_linked_annotations=True,
+                                          bulk=options.get('bulk', False),
+                                          threads=options.get('threads'))
         cse.save()
@@ -0,0 +1,154 @@
+from difflib import unified_diff
+from multiprocessing import Pool
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import resolve
+from django.db import connections
+from django.http import Http404, HttpRequest, QueryDict
+from django.utils.encoding import force_text
+from django.utils.six.moves.urllib.parse import urlparse
+
+from gcse import caching
+from gcse.models import CustomSearchEngine
+
+
+def render_feeds(cse):
+    """
+    Render the Annotations files linked from the CustomSearchEngine's
+    Include elements into the cache. Returns the number rendered and a
+    list of the URLs that couldn't be.
+    """
+    rendered = 0
+    skipped = []
+    for link in cse.annotations_urls():
+        url = urlparse(link)
+        match = resolve(url.path)
+        request = HttpRequest()
+        request.method = 'GET'
+        request.path = request.path_info = url.path
+        request.GET = QueryDict(url.query)
+        try:
+            response = match.func(request, *match.args, **match.kwargs)
+        except Http404:
+            # e.g. a page past the end of the Annotations
+            skipped.append(link)
+            continue
+        if response.status_code == 200:
+            rendered += 1
+        else:
+            skipped.append(link)
+    return rendered, skipped
+
+
+def rebuild(pk, dry_run=False, feeds=False):
+    """
+    Regenerate the output_xml of the CustomSearchEngine with the pk.
+    Returns a tuple of its gid, whether the output_xml changed, the diff
+    of the change when 'dry_run' is set, the number of Annotations files
+    rendered, the URLs of those skipped and the error, if any.
+    """
+    try:
+        cse = CustomSearchEngine.objects.get(pk=pk)
+        output_xml = force_text(cse.output_xml)
+        changed = cse.rebuild_xml(save=not dry_run)
+        diff = ''
+        if dry_run and changed:
+            diff = ''.join(unified_diff(output_xml.splitlines(True),
+                                        force_text(cse.output_xml).splitlines(True),
+                                        '%s (current)' % cse.gid, '%s (rebuilt)' % cse.gid))
+        rendered, skipped = render_feeds(cse) if feeds and not dry_run else (0, [])
+        return cse.gid, changed, diff, rendered, skipped, None
+    except Exception as e:
+        return 'id %s' % pk, False, '', 0, [], '%s: %s' % (type(e).__name__, e)
+
+
+def _rebuild(args):
+    return rebuild(*args)
+
+
+class Command(BaseCommand):
+    args = ''
+    help = ("Regenerate the output_xml of every Custom Search Engine, e.g. after changing GCSE_CONFIG, "
+            "using a pool of processes")
+    option_list = BaseCommand.option_list + (
+        make_option('--gid',
+                    action='append',
+                    dest='gids',
+                    default=[],
+                    help='Only rebuild the Custom Search Engine with this gid; may be repeated'),
+        make_option('--processes',
+                    type='int',
+                    dest='processes',
+                    default=None,
+                    help='Number of processes rebuilding Custom Search Engines; defaults to the number of CPUs'),
+        make_option('--dry-run',
+                    action='store_true',
+                    dest='dry_run',
+                    default=False,
+                    help='Show the differences in the output_xml without saving them'),
+        make_option('--feeds',
+                    action='store_true',
+                    dest='feeds',
+                    default=False,
+                    help='Also render the Annotations files into the cache; needs a cache shared between processes'),
+        )
+
+    def handle(self, *args, **options):
+        feeds = options.get('feeds')
+        dry_run = options.get('dry_run')
+        if feeds and not settings.GCSE_CONFIG.get('ANNOTATION_FEED_CACHE_TIMEOUT'):
+            raise CommandError('Annotations files are not cached as GCSE_CONFIG["ANNOTATION_FEED_CACHE_TIMEOUT"] is 0')
+        if feeds and not caching.is_shared():
+            raise CommandError('Annotations files rendered into a local-memory cache are never served')
+        processes = options.get('processes')
+        if processes is not None and processes < 1:
+            raise CommandError('--processes must be at least 1')
+        cses = CustomSearchEngine.objects.order_by('id')
+        if options.get('gids'):
+            cses = cses.filter(gid__in=options['gids'])
+        tasks = [(pk, dry_run, feeds) for pk in cses.values_list('pk', flat=True)]
+
+        if processes == 1:
+            results = (_rebuild(task) for task in tasks)
+        else:
+            # the workers open connections of their own
+            for connection in connections.all():
+                connection.close()
+            pool = Pool(processes)
+            results = pool.imap_unordered(_rebuild, tasks)
+
+        changed = rendered = 0
+        errors = []
+        skipped = []
+        try:
+            for i, (gid, cse_changed, diff, cse_rendered, cse_skipped, error) in enumerate(results, 1):
+                if error:
+                    errors.append(gid)
+                    status = error
+                else:
+                    status = 'changed' if cse_changed else 'unchanged'
+                self.stdout.write('[%d/%d] %s %s' % (i, len(tasks), gid, status))
+                if diff:
+                    self.stdout.write(diff)
+                for url in cse_skipped:
+                    self.stdout.write('Skipped %s' % url)
+                changed += cse_changed
+                rendered += cse_rendered
+                skipped.extend(cse_skipped)
+        finally:
+            if processes != 1:
+                pool.close()
+                pool.join()
+
+        if dry_run:
+            self.stdout.write('%d of %d Custom Search Engines would change' % (changed, len(tasks)))
+        else:
+            self.stdout.write('Rebuilt %d of %d Custom Search Engines' % (changed, len(tasks)))
+        if feeds:
+            self.stdout.write('Rendered %d Annotations files' % rendered)
+            if skipped:
+                self.stdout.write('Skipped %d Annotations files' % len(skipped))
+        if errors:
+            raise CommandError('Failed to rebuild %d Custom Search Engines' % len(errors))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from gcse import counters
+
+
+class Command(BaseCommand):
+    args = ''
+    help = "Recompute the counts of active Annotations in total, per Label and per Custom Search Engine"
+
+    def handle(self, *args, **options):
+        count = counters.rebuild()
+        self.stdout.write('Rebuilt %d counts' % count)
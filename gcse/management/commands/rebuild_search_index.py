@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand, CommandError
+from gcse import search
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Create the Annotation search index and (re)index every Annotation'
+
+    def handle(self, *args, **options):
+        backend = search.get_backend()
+        if backend is None:
+            raise CommandError('Annotation search is disabled by GCSE_CONFIG["ANNOTATION_SEARCH_BACKEND"]')
+        backend.install()
+        count = backend.rebuild()
+        self.stdout.write('Indexed %d Annotations using the %s backend' % (count, type(backend).__name__))
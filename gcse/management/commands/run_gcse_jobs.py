@@ -0,0 +1,42 @@
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand
+from gcse import jobs
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Run the queued Jobs, e.g. imports started from the admin, waiting for more when the queue is empty'
+    option_list = BaseCommand.option_list + (
+        make_option('--once',
+                    action='store_true',
+                    dest='once',
+                    default=False,
+                    help='Exit once no Jobs are due instead of waiting for more'),
+        make_option('--sleep',
+                    type='float',
+                    dest='sleep',
+                    default=5,
+                    help='Seconds to wait before looking for Jobs again when none are due'),
+        make_option('--max-jobs',
+                    type='int',
+                    dest='max_jobs',
+                    default=None,
+                    help='Exit after running this many Jobs'),
+        )
+
+    def handle(self, *args, **options):
+        max_jobs = options.get('max_jobs')
+        count = 0
+        while max_jobs is None or count < max_jobs:
+            job = jobs.run_next()
+            if job is None:
+                if options.get('once'):
+                    break
+                time.sleep(options.get('sleep'))
+                continue
+            count += 1
+            self.stdout.write('Job %d %s %s: %s' % (job.pk, job, job.get_status_display(),
+                                                    job.message.strip().splitlines()[-1] if job.message else ''))
+        self.stdout.write('Ran %d Jobs' % count)
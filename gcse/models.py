@@ -1,32 +1,72 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from contextlib import closing, contextmanager
 from string import ascii_letters
 import datetime
+import io
 import math
+import shutil
+import tempfile
+import threading
+import unicodedata
+from multiprocessing.pool import ThreadPool
 
 from lxml import etree as ET
 import lxml.sax
 import xml.sax.saxutils
 import xml.sax.handler
 
-from django.db import models, connection
+from django.db import models, connection, transaction, IntegrityError
 from django.db.models import Count, Q
+from django.db.models.query import QuerySet
+from django.db.models.query import prefetch_related_objects
 from django.conf import settings
 from django.contrib.sites.models import Site
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.utils import timezone
 from django.utils.translation import ugettext as _
-from django.utils.encoding import python_2_unicode_compatible
+from django.utils import six
+from django.utils.encoding import force_text, python_2_unicode_compatible
+from django.utils.six.moves.urllib.request import urlopen
 
 from model_utils.models import TimeStampedModel
 from model_utils import Choices
 from model_utils.managers import InheritanceManager
-from model_utils.managers import QueryManager
+from model_utils.managers import PassThroughManager, QueryManager
+from model_utils.tracker import FieldTracker
 
 from ordered_model.models import OrderedModel
 
+from gcse import caching, skeletons
+
+try:
+    atomic = transaction.atomic
+except AttributeError:
+    # Django < 1.6: commit_on_success() commits whenever it exits, even
+    # within another block, so nested blocks use a savepoint instead
+    @contextmanager
+    def atomic():
+        if not transaction.is_managed():
+            with transaction.commit_on_success():
+                yield
+            return
+        sid = transaction.savepoint()
+        try:
+            yield
+        except Exception:
+            transaction.savepoint_rollback(sid)
+            raise
+        transaction.savepoint_commit(sid)
+
+try:
+    on_commit = transaction.on_commit
+except AttributeError:
+    # Django < 1.9 has no commit hooks; see CustomSearchEngine.deferred_xml_updates
+    on_commit = None
+
 
 settings.GCSE_CONFIG = dict({
         'NUM_FACET_ITEMS_PER_FACET': 4,
@@ -34,10 +74,60 @@ settings.GCSE_CONFIG = dict({
         'NUM_ANNOTATIONS_PER_PAGE': 25,
         'NUM_CSES_PER_PAGE': 25,
         'NUM_LABELS_PER_PAGE': 25,
+        # whether the default cache is shared by every process; None to
+        # assume it is unless it's a local-memory cache. See gcse.caching
+        'CACHE_SHARED': None,
+        # seconds to cache each rendered Annotations file; 0 disables caching
+        'ANNOTATION_FEED_CACHE_TIMEOUT': 60 * 60 * 24,
+        # page Annotations files by Annotation id instead of OFFSET
+        'ANNOTATION_FEED_KEYSET_PAGINATION': False,
+        # Annotations written per transaction by bulk imports
+        'ANNOTATION_IMPORT_BATCH_SIZE': 500,
+        # concurrent downloads of the Annotations files linked from imported CSEs
+        'NUM_ANNOTATION_FETCH_THREADS': 4,
+        # seconds to cache each rendered HTML page; 0 disables caching
+        'PAGE_CACHE_TIMEOUT': 0,
+        # seconds to share each Annotation's rendered Label links in the cache; 0 disables it
+        'LABEL_LINKS_CACHE_TIMEOUT': 0,
+        # 'auto', 'sqlite', 'postgresql', 'python' or None; see gcse.search
+        'ANNOTATION_SEARCH_BACKEND': 'auto',
+        # most Annotations returned by the 'python' search backend
+        'ANNOTATION_SEARCH_MAX_RESULTS': 1000,
+        # times a Job is run before a failure to fetch its files is reported
+        'JOB_MAX_ATTEMPTS': 3,
+        # seconds before a Job is retried, doubled after each attempt
+        'JOB_RETRY_DELAY': 60,
+        # seconds a running Job may go without reporting progress before it
+        # is taken as abandoned by its worker and run again; None disables it
+        'JOB_STALE_TIMEOUT': 60 * 60,
+        # seconds to wait for a response when fetching a file; None waits forever
+        'FETCH_TIMEOUT': 60,
         },
         **getattr(settings, 'GCSE_CONFIG' , {}))
 
 
+class LabelQuerySet(QuerySet):
+
+    def annotation_counts(self, cse):
+        """
+        Return a list of (Label, count) pairs of these Labels and the
+        number of active Annotations in the CustomSearchEngine having
+        each of them. The counts are a single grouped query over the
+        Annotation/Label table, joined to itself to restrict it to the
+        Annotations with one of the CustomSearchEngine's background Labels.
+        """
+        labels = list(self)
+        background_label_ids = CustomSearchEngine.background_labels.through.objects.\
+            filter(customsearchengine=cse).values('label')
+        rows = Annotation.labels.through.objects.\
+            filter(label__in=set(label.id for label in labels),
+                   annotation__status=Annotation.STATUS.active,
+                   annotation__labels__in=background_label_ids).\
+            values_list('label').order_by().annotate(Count('annotation', distinct=True))
+        count_by_id = dict(rows)
+        return [(label, count_by_id.get(label.id, 0)) for label in labels]
+
+
 @python_2_unicode_compatible
 class Label(models.Model):
     """Labels associated with an Annotation. Used to refine search results.
@@ -81,10 +171,31 @@ class Label(models.Model):
         All CustomSearchEngines having this Label as either a background label.
         or in a FacetItem.
         """
+        if hasattr(self, '_cses'):
+            # loaded by prefetch_cses()
+            return self._cses
         cses = CustomSearchEngine.objects.filter(Q(background_labels=self) |
                                                  Q(facetitem__label=self)).distinct().order_by('title')
         return cses
 
+    @classmethod
+    def prefetch_cses(cls, labels):
+        """
+        Load the CustomSearchEngines of a page of Labels in two queries
+        so rendering each Label's cses() doesn't query the database.
+        """
+        labels = list(labels)
+        cses = dict((label.id, {}) for label in labels)
+        if cses:
+            for row in CustomSearchEngine.background_labels.through.objects.\
+                    filter(label__in=list(cses)).select_related('customsearchengine'):
+                cses[row.label_id][row.customsearchengine_id] = row.customsearchengine
+            for facet_item in FacetItem.objects.filter(label__in=list(cses)).select_related('cse'):
+                cses[facet_item.label_id][facet_item.cse_id] = facet_item.cse
+        for label in labels:
+            label._cses = sorted(cses[label.id].values(), key=lambda cse: cse.title)
+        return labels
+
     def annotations(self):
         """
         Annotations for this Label regardless of the CustomSearchEngine.
@@ -92,6 +203,12 @@ class Label(models.Model):
         return Annotation.objects.filter(status=Annotation.STATUS.active,
                                          labels__name__exact=self.name)
 
+    objects = PassThroughManager.for_queryset_class(LabelQuerySet)()
+
+    def annotation_count(self):
+        """The number of active Annotations with this Label; see gcse.counters."""
+        return counters.count(counters.LABEL, self.id)
+
     class Meta:
         ordering = ["name"]
 
@@ -104,14 +221,17 @@ class Label(models.Model):
             if mode_str == mode_string:
                 return mode_char
 
-    def xml(self, complete=True):
-        weight = ''
+    def element(self, complete=True):
+        """The Label element; 'complete' includes the weight."""
+        el = ET.Element('Label')
+        el.set('name', self.name)
+        el.set('mode', self.get_mode_display())
         if self.weight and complete:
-            weight = ' weight="%s"' % self.weight
-        params = {"name": self.name,
-                  "mode": self.get_mode_display(),
-                  "weight": weight}
-        return '<Label name="%(name)s" mode="%(mode)s"%(weight)s/>' % params
+            el.set('weight', '%s' % self.weight)
+        return el
+
+    def xml(self, complete=True):
+        return ET.tostring(self.element(complete), encoding='unicode')
 
     def __str__(self):
         return "%d %s %s weight: %s" % (self.id, self.name, self.get_mode_display(), self.weight)
@@ -132,8 +252,13 @@ class FacetItem(OrderedModel):
     class Meta(OrderedModel.Meta):
         pass
 
+    def element(self):
+        el = ET.Element('FacetItem', title=self.title)
+        el.append(self.label.element(complete=False))
+        return el
+
     def xml(self):
-        return '<FacetItem title="%s">%s</FacetItem>' % (self.title, self.label.xml(complete=False))
+        return ET.tostring(self.element(), encoding='unicode')
 
     def __str__(self):
         return '%s %s' % (self.title, self.label)
@@ -207,6 +332,21 @@ class CustomSearchEngine(TimeStampedModel):
                                                blank=True,
                                                help_text=_('Labels for this search engine'))
 
+    tracker = FieldTracker(fields=['gid', 'title', 'description', 'input_xml', 'output_xml'])
+
+    # The sections of the output_xml, regenerated in this order. All of
+    # them are regenerated from a changed input_xml, the others only when
+    # the values they are built from change.
+    XML_SECTIONS = ('input_xml', 'gid', 'title', 'description', 'background_labels', 'facets', 'includes')
+    XML_FIELD_SECTIONS = {
+        'gid': ('gid', 'includes'),
+        'title': ('title',),
+        'description': ('description',),
+        }
+
+    # the sections of each CustomSearchEngine waiting to be regenerated
+    _pending_xml = threading.local()
+
     DEFAULT_XML = b"""<?xml version="1.0"?>
     <CustomSearchEngine id="rdfdpnhicea" language="en" encoding="utf-8" enable_suggest="true">
       <Title>test</Title>
@@ -233,14 +373,24 @@ class CustomSearchEngine(TimeStampedModel):
     </CustomSearchEngine>"""
 
     def annotations(self):
+        # background Label ids may have been loaded by the views' CSEContext
+        background_labels = getattr(self, '_background_label_ids', None)
+        if background_labels is None:
+            background_labels = self.background_labels.all()
         return Annotation.objects.filter(status=Annotation.STATUS.active,
-                                         labels__in=self.background_labels.all()).select_subclasses()
+                                         labels__in=background_labels).select_subclasses()
 
     def annotation_count(self, label_id=None):
-        query = self.annotations()
+        """
+        The number of active Annotations in this CustomSearchEngine, read
+        from gcse.counters, or of those also having the Label with label_id.
+        """
+        if not self.pk:
+            # a new CustomSearchEngine has no background Labels yet
+            return 0
         if label_id:
-            return query.filter(labels__in=(label_id,)).count()
-        return query.count()
+            return self.annotations().filter(labels__in=(label_id,)).distinct().count()
+        return counters.count(counters.CSE, self.id)
 
     def all_labels(self):
         """Return all the Labels associated with this instance."""
@@ -254,165 +404,318 @@ class CustomSearchEngine(TimeStampedModel):
 
     def labels_counts(self):
         """Return all the Labels associated with this CSE and the counts of Annotations associated with each."""
-        return self._labels_counts(self.all_labels())
+        return self.all_labels().annotation_counts(self)
 
     def facet_item_labels_counts(self):
         """Return all the Labels for the FacetItems associated with this instance and the counts of Annotations associated with them."""
-        return self._labels_counts(self.facet_item_labels())
-
-    def _labels_counts(self, labels):
-        annotations = Annotation.objects.filter(Q(labels__in=labels) | Q(labels__in=self.background_labels.all())).values('labels__id').order_by().annotate(Count('labels__id'))
-        count_by_id = dict([(x['labels__id'], x['labels__id__count']) for x in annotations])
-        label_counts = [(label, count_by_id.setdefault(label.id, 0)) for label in labels]
-        return label_counts
+        return self.facet_item_labels().annotation_counts(self)
 
     def get_absolute_url(self):
         return reverse('gcse_cse_detail', kwargs={'gid': self.gid})
 
-    def _create_or_update_xml_element_text(self, doc, name):
-        value = getattr(self, name)
-        if value:
-            capitalize = name.capitalize()
-            lower = name.lower()
-            el = doc.find(".//CustomSearchEngine/%s" % capitalize)
-            if el is None:
-                doc = doc.find(".//CustomSearchEngine")
-                el = ET.XML("<%s/>" % capitalize)
-                doc.insert(1, el)
-            el.text = value
-
-    def _update_background_labels(self, doc):
-        """Replace the BackgroundLabel in the supplied doc's Context element."""
-        context = doc.xpath(".//Context")[0]
-        for child in context.getchildren():
-            if child.tag == 'BackgroundLabels':
-                context.remove(child)
-        background = ET.XML("<BackgroundLabels />")
-        context.insert(1, background)
-        for label in self.background_labels.all():
-            background.insert(1, ET.XML(label.xml()))
-
-    def _update_facets(self, doc):
-        """
-        Add/replace the Facets in the supplied doc's Context element.
+    def _title_xml(self):
+        if self.title:
+            return '<Title>%s</Title>' % xml.sax.saxutils.escape(self.title)
+
+    def _description_xml(self):
+        if self.description:
+            return '<Description>%s</Description>' % xml.sax.saxutils.escape(self.description)
+
+    def _background_labels_xml(self):
+        """The BackgroundLabels element of the Context."""
+        background = ET.Element('BackgroundLabels')
+        # no Labels until it is saved
+        if not self._state.adding:
+            background.extend(label.element() for label in self.background_labels.all())
+        return ET.tostring(background, encoding='unicode')
+
+    def _facets_xml(self):
+        """
+        The Facet elements of the Context.
         TODO: maintain ordering of FacetItems
         """
+        if self._state.adding:
+            # no FacetItems until it is saved
+            return ''
         num_facet_items = settings.GCSE_CONFIG.get('NUM_FACET_ITEMS_PER_FACET')
-        context = doc.xpath(".//Context")[0]
-        for child in context.getchildren():
-            if child.tag == 'Facet':
-                context.remove(child)
-
+        facet_items = self.facetitem_set.filter(label__isnull=False).select_related('label')
+        facets = []
         # Google limits to 16 facet items in groups of up to 4
         # but don't enforce overall limit just keep grouping them.
-        for i, facet_item in enumerate(self.facetitem_set.all()):
+        for i, facet_item in enumerate(facet_items):
             if i % num_facet_items == 0:
-                facet_el = ET.XML("<Facet />")
-                context.append(facet_el)
-            facet_item_el = ET.XML(facet_item.xml())
-            facet_el.append(facet_item_el)
+                facets.append(ET.Element('Facet'))
+            facets[-1].append(facet_item.element())
+        return ''.join(ET.tostring(facet, encoding='unicode') for facet in facets)
+
+    def _includes_xml(self):
+        """An Include element for each file of Annotations."""
+        return ''.join('<Include type="Annotations" href="%s"/>' % xml.sax.saxutils.escape(url, {'"': '&quot;'})
+                       for url in self.annotations_urls())
 
     @classmethod
     def _add_google_customizations(cls, doc):
-        if doc.tag != "GoogleCustomizations":
-            root = ET.XML("<GoogleCustomizations />")
-            root.insert(1, doc)
-            doc = root
-        return doc
+        return skeletons.add_google_customizations(doc)
 
-    def _update_gid(self, doc):
-        el = doc.xpath(".//CustomSearchEngine")[0]
-        el.attrib['id'] = self.gid
+    def _xml_skeleton(self):
+        if not self.input_xml:
+            # need to replace id attribute with id of this CSE
+            self.input_xml = self.DEFAULT_XML
+        return skeletons.get(self.gid, self.input_xml)
 
     def update_output_xml_includes(self):
-        doc = lxml.etree.fromstring(self.output_xml)
-        if self._update_includes(doc, force_update=False):
-            self.output_xml = ET.tostring(doc, encoding='UTF-8')
-            return True
-        return False
-
-    def _update_includes(self, doc, force_update=True):
-        existing = doc.findall(".//Include")
-        num_annotations = self.annotation_count()
-        per_file = settings.GCSE_CONFIG.get('NUM_ANNOTATIONS_PER_FILE')
-        # always at least one annotation file - even if empty
-        num_files = max(1, int(math.ceil(num_annotations / per_file)))
-        if not force_update and len(existing) == num_files:
+        skeleton = self._xml_skeleton()
+        values = skeleton.slot_values(self.output_xml)
+        includes = self._includes_xml()
+        if values is None:
+            self._update_xml()
+        elif values['includes'] != includes:
+            values['includes'] = includes
+            self.output_xml = skeleton.render(values)
+        else:
             return False
-        # remove existing include
-        for el in existing:
-            el.getparent().remove(el)
-        # add an include for each index of Annotations
-        for i in range(num_files):
-            annotation_url = self._annotations_url(i)
-            doc.append(ET.XML('<Include type="Annotations" href="%s"/>' % annotation_url))
         return True
 
-    def _annotations_url(self, index):
-        url = reverse('gcse_annotations', args=(self.gid, index))
+    def annotations_urls(self):
+        """
+        Return the URLs of the Annotation files for the Include elements.
+        Files are numbered from 1 like the pages of the Annotations view.
+        With keyset pagination each URL also carries the id of the last
+        Annotation in the preceding file so every file can be read with
+        an index seek rather than an OFFSET.
+        """
+        per_file = settings.GCSE_CONFIG.get('NUM_ANNOTATIONS_PER_FILE')
+        if settings.GCSE_CONFIG.get('ANNOTATION_FEED_KEYSET_PAGINATION'):
+            ids = []
+            if self.pk:
+                ids = list(self.annotations().order_by('id').distinct().values_list('id', flat=True))
+            # always at least one annotation file - even if empty
+            afters = [0] + ids[per_file - 1:-1:per_file]
+            return [self._annotations_url(i, after) for i, after in enumerate(afters, 1)]
+        num_annotations = self.annotation_count()
+        # always at least one annotation file - even if empty
+        num_files = max(1, int(math.ceil(num_annotations / float(per_file))))
+        return [self._annotations_url(i) for i in range(1, num_files + 1)]
+
+    def _annotations_url(self, number, after=None):
+        url = reverse('gcse_annotations', args=(self.gid, number))
+        if after is not None:
+            url += '?after=%d' % after
         return  '//' + Site.objects.get_current().domain + url
 
-    def _update_xml(self):
-        """Parse the input_xml and update output_xml with the values in this instance."""
-        input_xml = self.input_xml
-        if not self.input_xml:
-            # need to replace id attribute with id of this CSE
-            input_xml = self.DEFAULT_XML
-            self.input_xml = input_xml
-
-        # since lxml doesn't trust encoding directives remove them
-        doc = ET.fromstring(input_xml)
-        # handle case where user gives us only CustomSearchEngine without
-        # external Annotations file - wrap CSE with GoogleCustomizations element:
-        doc = self._add_google_customizations(doc)
-        self._update_gid(doc)
-        self._create_or_update_xml_element_text(doc, "title")
-        self._create_or_update_xml_element_text(doc, "description")
-
-        # update Context's Facet and BackgroundLabels
-        self._update_background_labels(doc)
-        self._update_facets(doc)
-
-        # Add Include of Annotations with link keyed on this CSE
-        self._update_includes(doc)
-        self.output_xml = ET.tostring(doc, encoding='UTF-8')
+    def _update_xml(self, sections=XML_SECTIONS):
+        """
+        Update the named sections of the output_xml with the values in
+        this instance. The output_xml is rendered from the Skeleton of
+        the input_xml, see gcse.skeletons, so regenerating a section
+        costs only the queries for its values. All of them are
+        regenerated with the 'input_xml' section or if the output_xml
+        wasn't rendered from the Skeleton, e.g. after the gid changed.
+        """
+        skeleton = self._xml_skeleton()
+        values = None
+        if 'input_xml' not in sections:
+            values = skeleton.slot_values(self.output_xml)
+        if values is None:
+            values = {}
+            sections = skeletons.SLOTS
+        for slot in skeletons.SLOTS:
+            if slot in sections:
+                values[slot] = getattr(self, '_%s_xml' % slot)()
+        self.output_xml = skeleton.render(values)
+
+    def _changed_xml_sections(self):
+        """Return the sections of the output_xml built from fields changed since the last save."""
+        if self._state.adding or not self.output_xml or self.tracker.has_changed('input_xml'):
+            return set(self.XML_SECTIONS)
+        sections = set()
+        for field, field_sections in self.XML_FIELD_SECTIONS.items():
+            if self.tracker.has_changed(field):
+                sections.update(field_sections)
+        return sections
 
     def update(self):
         super(CustomSearchEngine, self).save()
 
-    def save(self, *args, **kwargs):
-        if not self.id:
-            # need id so foreign key/m2m relations are satisfied
-            # when inserting them inside _update_xml()
-            super(CustomSearchEngine, self).save(*args, **kwargs)
+    def rebuild_xml(self, save=True):
+        """
+        Regenerate all of the output_xml, e.g. after GCSE_CONFIG changes,
+        saving it if it changed and 'save' is set. Returns whether it changed.
+        """
+        output_xml = self.output_xml
         self._update_xml()
-        # guaranteed to be an update now
-        kwargs.update({'force_insert': False, 'force_update': True})
+        if force_text(self.output_xml) == force_text(output_xml or ''):
+            return False
+        if save:
+            self.update()
+        return True
+
+    @classmethod
+    def _xml_updates_deferred(cls):
+        return getattr(cls._pending_xml, 'depth', 0) > 0 or \
+            (on_commit is not None and connection.in_atomic_block)
+
+    @classmethod
+    @contextmanager
+    def deferred_xml_updates(cls):
+        """
+        Collect the output_xml sections of the CustomSearchEngines to be
+        regenerated within the block and regenerate each of them once
+        when it exits, rather than on every change. Without commit hooks
+        (Django < 1.9) this is how bulk changes avoid repeated rebuilds;
+        with them, the rebuilds are further deferred until the
+        transaction commits. If the block fails within a transaction,
+        which will be rolled back, the sections are discarded; otherwise
+        the changes written before the failure are still regenerated.
+        """
+        cls._pending_xml.depth = getattr(cls._pending_xml, 'depth', 0) + 1
+        try:
+            yield
+        except Exception:
+            if cls._pending_xml.depth == 1:
+                if connection.in_atomic_block:
+                    cls._pending_xml.sections = {}
+                else:
+                    for pk in list(getattr(cls._pending_xml, 'sections', {})):
+                        cls._commit_xml(pk)
+            raise
+        finally:
+            cls._pending_xml.depth -= 1
+        if not cls._pending_xml.depth:
+            for pk in list(getattr(cls._pending_xml, 'sections', {})):
+                cls._commit_xml(pk)
+
+    @classmethod
+    def schedule_xml_update(cls, pk, sections, instance=None):
+        """
+        Regenerate the sections of the output_xml of the
+        CustomSearchEngine with the pk once the current transaction
+        commits or deferred_xml_updates() block exits, or else at once.
+        The output_xml of the instance, if given, is updated to match.
+        """
+        if not hasattr(cls._pending_xml, 'sections'):
+            cls._pending_xml.sections = {}
+        pending, instances = cls._pending_xml.sections.setdefault(pk, (set(), []))
+        pending.update(sections)
+        if instance is not None and not any(i is instance for i in instances):
+            instances.append(instance)
+        if not getattr(cls._pending_xml, 'depth', 0):
+            cls._commit_xml(pk)
+
+    @classmethod
+    def _commit_xml(cls, pk):
+        if on_commit is None:
+            cls._flush_xml(pk)
+        else:
+            # the first callback run regenerates the sections scheduled in the transaction
+            on_commit(lambda: cls._flush_xml(pk))
+
+    @classmethod
+    def _flush_xml(cls, pk):
+        if pk not in getattr(cls._pending_xml, 'sections', {}):
+            return
+        sections, instances = cls._pending_xml.sections.pop(pk)
+        try:
+            # read afresh as the changes may have been made through other instances
+            cse = cls.objects.get(pk=pk)
+        except cls.DoesNotExist:
+            return
+        output_xml = cse.output_xml
+        cse._update_xml(sections)
+        if force_text(cse.output_xml) != force_text(output_xml):
+            cls.objects.filter(pk=pk).update(output_xml=cse.output_xml)
+            caching.bump_generation(cse.gid)
+        for instance in instances:
+            instance.output_xml = cse.output_xml
+            instance.tracker.set_saved_fields(fields=['output_xml'])
+
+    @classmethod
+    def refresh_includes(cls, gids):
+        """
+        Update the Include elements of the CustomSearchEngines with the
+        supplied gids after their Annotations have changed. Like the
+        other sections they are regenerated once per transaction or
+        deferred_xml_updates() block, e.g. once per import, rather than
+        on every change.
+        """
+        for pk in cls.objects.filter(gid__in=list(gids)).exclude(output_xml='').values_list('pk', flat=True):
+            cls.schedule_xml_update(pk, ['includes'])
+
+    def save(self, *args, **kwargs):
+        sections = self._changed_xml_sections()
+        if sections and (self._state.adding or not self._xml_updates_deferred()):
+            # written along with the row
+            self._update_xml(sections)
+            sections = None
+        if not self._state.adding and not self.tracker.has_changed('output_xml') and \
+                'update_fields' not in kwargs:
+            # leave the output_xml regenerated since this instance was read alone
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name != 'output_xml']
         super(CustomSearchEngine, self).save(*args, **kwargs)
+        if sections:
+            self.schedule_xml_update(self.pk, sections, self)
 
     def __str__(self):
         return "%s" % (self.title,)
 
     @classmethod
-    def from_string(cls, xml, import_linked_annotations=False):
-        handler = CSESAXHandler()
-        cse, linked_annotation_urls = handler.parseString(xml)
-        cse.save()
-        if import_linked_annotations:
-            for url in linked_annotation_urls:
-                Annotation.from_url(url)
+    def from_string(cls, xml, import_linked_annotations=False, bulk=False, threads=None, progress=None):
+        with cls.deferred_xml_updates():
+            handler = CSESAXHandler()
+            cse, linked_annotation_urls = handler.parseString(xml)
+            cse.save()
+            if import_linked_annotations:
+                cls._import_linked_annotations(linked_annotation_urls, bulk, threads, progress)
         return cse
 
     @classmethod
-    def from_url(cls, url, import_linked_annotations=False):
-        handler = CSESAXHandler()
-        cse, linked_annotation_urls = handler.parse(url)
-        cse.save()
-        if import_linked_annotations:
-            for url in linked_annotation_urls:
-                Annotation.from_url(url)
+    def from_url(cls, url, import_linked_annotations=False, bulk=False, threads=None, progress=None):
+        with cls.deferred_xml_updates():
+            handler = CSESAXHandler()
+            cse, linked_annotation_urls = handler.parse(url)
+            cse.save()
+            if import_linked_annotations:
+                cls._import_linked_annotations(linked_annotation_urls, bulk, threads, progress)
         return cse
 
+    @classmethod
+    def sync_from_url(cls, url, threads=None):
+        """
+        Import the CustomSearchEngine at the url and bring its
+        Annotations in line with its linked Annotations files, writing
+        only the differences. Returns the CustomSearchEngine and a dict
+        of the number of Annotations 'inserted', 'updated', 'deleted'
+        and 'unchanged'.
+        """
+        with cls.deferred_xml_updates():
+            handler = CSESAXHandler()
+            cse, linked_annotation_urls = handler.parse(url)
+            cse.save()
+            sync = SyncAnnotationSAXHandler(cse)
+            for source in _annotation_files(linked_annotation_urls, threads):
+                sync.parse(source)
+            counts = sync.sync()
+        return cse, counts
+
+    @classmethod
+    def _import_linked_annotations(cls, urls, bulk=False, threads=None, progress=None):
+        """
+        Import the Annotations files at the urls, calling 'progress', if
+        given, with the number of Annotations imported from all of them
+        as the import goes and after each file.
+        """
+        count = 0
+        for source in _annotation_files(urls, threads):
+            handler = Annotation._sax_handler(Annotation, bulk, collect=False)
+            if progress is not None:
+                handler.progress = lambda imported, before=count: progress(before + imported)
+            handler.parse(source)
+            count += handler.count
+            if progress is not None:
+                progress(count)
+        return count
+
 
 class AnnotationManager(InheritanceManager):
 
@@ -478,47 +781,113 @@ class Annotation(TimeStampedModel):
                                        related_name='newer_versions',
                                        help_text=_('Set to newer Annotation instance when user modifies this instance'))
 
+    # Derived from the comment by derived_fields(); maintained by save()
+    # and the bulk imports. The lower case, accent folded comment, so
+    # case insensitive prefix searches are index range scans:
+    sort_key = models.CharField(max_length=256,
+                                blank=True,
+                                editable=False,
+                                db_index=True)
+    # and its upper case first character for the alphabetical navigation:
+    first_letter = models.CharField(max_length=1,
+                                    blank=True,
+                                    editable=False,
+                                    db_index=True)
+
+    tracker = FieldTracker(fields=['status'])
+
+    class Meta:
+        index_together = [['status', 'first_letter']]
+
     def cses(self):
         """
         All CustomSearchEngines having the same background_label(s) as this Annotation.
         """
+        if hasattr(self, '_cses'):
+            # loaded by prefetch_cses()
+            return self._cses
         cses = CustomSearchEngine.objects.filter(background_labels__in=self.labels.all())
         return cses
 
+    @classmethod
+    def prefetch_cses(cls, annotations):
+        """
+        Load the Labels and CustomSearchEngines of a page of Annotations
+        in two queries so rendering each Annotation's cses() and
+        labels_as_links() doesn't query the database.
+        """
+        annotations = list(annotations)
+        prefetch_related_objects(annotations, ['labels'])
+        label_ids = set(label.id for annotation in annotations for label in annotation.labels.all())
+        cses = {}
+        if label_ids:
+            through = CustomSearchEngine.background_labels.through
+            for row in through.objects.filter(label_id__in=label_ids).\
+                    select_related('customsearchengine').order_by('customsearchengine'):
+                cses.setdefault(row.label_id, []).append(row.customsearchengine)
+        for annotation in annotations:
+            annotation._cses = []
+            for label in annotation.labels.all():
+                for cse in cses.get(label.id, []):
+                    if cse not in annotation._cses:
+                        annotation._cses.append(cse)
+        return annotations
+
+    @classmethod
+    def label_names(cls, annotation_ids):
+        """
+        Return a dict mapping each of the supplied Annotation ids to the
+        names of its Labels in name order. Uses a single query no
+        matter how many ids are supplied.
+        """
+        names = dict((annotation_id, []) for annotation_id in annotation_ids)
+        if not names:
+            return names
+        rows = cls.labels.through.objects.filter(annotation_id__in=list(names.keys())).\
+            order_by('label__name').values_list('annotation_id', 'label__name')
+        for annotation_id, name in rows:
+            names[annotation_id].append(name)
+        return names
+
     objects = AnnotationManager()
 
     @classmethod
-    def from_string(cls, xml, klass=None):
+    def from_string(cls, xml, klass=None, bulk=False, collect=True):
         # allow use as Annotation subclass factory
         if klass is None:
             klass = cls
-        handler = AnnotationSAXHandler(klass=klass)
+        handler = cls._sax_handler(klass, bulk, collect)
         annotations = handler.parseString(xml)
         return annotations
 
     @classmethod
-    def from_url(cls, url, klass=None):
+    def from_url(cls, url, klass=None, bulk=False, collect=True):
         # allow use as Annotation subclass factory
         if klass is None:
             klass = cls
-        handler = AnnotationSAXHandler(klass=klass)
+        handler = cls._sax_handler(klass, bulk, collect)
         annotations = handler.parse(url)
         return annotations
 
+    @classmethod
+    def _sax_handler(cls, klass, bulk, collect):
+        if bulk:
+            return BulkAnnotationSAXHandler(klass=klass, collect=collect)
+        return AnnotationSAXHandler(klass=klass, collect=collect)
+
     @classmethod
     def alpha_list(cls, selection=None, cse=None, label_id=None):
-        """Return a list of the case insensitive matches of Annotation
-        comment's first letters. For use in views to give alpha based
-        links for browsing."""
-        cursor = connection.cursor()
-        if label_id is None:
-            cursor.execute("SELECT DISTINCT(SUBSTR(comment, 1, 1)) FROM "
-                           "gcse_annotation ORDER BY SUBSTR(comment, 1, 1)")
+        """Return a list of the case insensitive matches of active
+        Annotation comment's first letters, optionally only those of a
+        CustomSearchEngine and/or Label. For use in views to give alpha
+        based links for browsing."""
+        if cse is None:
+            annotations = cls.objects.filter(status=Annotation.STATUS.active)
         else:
-            cursor.execute("SELECT DISTINCT(SUBSTR(comment, 1, 1)) FROM "
-                           "gcse_annotation JOIN gcse_annotation_labels ON gcse_annotation.id=gcse_annotation_labels.annotation_id WHERE label_id=%s"
-"ORDER BY SUBSTR(comment, 1, 1)", (label_id,))
-        existent = [i[0] for i in cursor.fetchall()]
+            annotations = cse.annotations()
+        if label_id is not None:
+            annotations = annotations.filter(labels=label_id)
+        existent = set(annotations.order_by().values_list('first_letter', flat=True).distinct())
         results = []
         for i in ascii_letters[26:] + "0123456789":
             style = ''
@@ -531,6 +900,32 @@ class Annotation(TimeStampedModel):
             results.append({'i': i, 'style': style})
         return results
 
+    @staticmethod
+    def get_sort_key(text):
+        """Lower case the text and remove its accents."""
+        decomposed = unicodedata.normalize('NFKD', force_text(text or ''))
+        return ''.join(c for c in decomposed if not unicodedata.combining(c)).lower()
+
+    @classmethod
+    def derived_fields(cls, comment):
+        """Return the values of the fields derived from the comment."""
+        sort_key = cls.get_sort_key(comment)[:cls._meta.get_field('sort_key').max_length]
+        return {'sort_key': sort_key,
+                'first_letter': sort_key[:1].upper()}
+
+    @classmethod
+    def starting_with(cls, prefix):
+        """
+        Return a Q matching the Annotations whose comments start with the
+        prefix ignoring case and accents, like comment__istartswith, as
+        a range of the indexed sort_key.
+        """
+        start = cls.get_sort_key(prefix)
+        if not start:
+            return Q()
+        end = start[:-1] + six.unichr(ord(start[-1]) + 1)
+        return Q(sort_key__gte=start, sort_key__lt=end)
+
     @classmethod
     def guess_google_url(cls, url):
         from django.utils.six.moves.urllib_parse import urlparse
@@ -545,11 +940,62 @@ class Annotation(TimeStampedModel):
         return path
 
     def labels_as_links(self, include_background_labels=True):
-        return "".join(
-            ['<a class="label-link" href="%s">%s</a>' % (
-                reverse('gcse_label_detail', args=(l.id,)), l.name)
-             for l in self.labels.order_by("name") if include_background_labels or not l.background]
-            )
+        """
+        HTML links to this Annotation's Labels. Both renderings are built
+        together, from the prefetched Labels when available, and
+        memoized on the instance. When
+        GCSE_CONFIG['LABEL_LINKS_CACHE_TIMEOUT'] is set they are also
+        shared through the Django cache until the Annotation or any
+        Label changes.
+        """
+        if getattr(self, '_label_links', None) is None:
+            timeout = caching.timeout('LABEL_LINKS_CACHE_TIMEOUT')
+            if timeout and self.pk:
+                key = caching.label_links_key(self.pk, self.modified)
+                self._label_links = cache.get(key)
+                if self._label_links is None:
+                    self._label_links = self._render_label_links()
+                    cache.set(key, self._label_links, timeout)
+            else:
+                self._label_links = self._render_label_links()
+        return self._label_links[include_background_labels]
+
+    @classmethod
+    def prefetch_label_links(cls, annotations):
+        """
+        Read the shared Label links of a page of Annotations, see
+        labels_as_links(), from the cache in one request rather than
+        with several requests per Annotation.
+        """
+        annotations = list(annotations)
+        timeout = caching.timeout('LABEL_LINKS_CACHE_TIMEOUT')
+        pending = [annotation for annotation in annotations
+                   if annotation.pk and getattr(annotation, '_label_links', None) is None]
+        if not timeout or not pending:
+            return annotations
+        keys = caching.label_links_keys([(annotation.pk, annotation.modified) for annotation in pending])
+        cached = cache.get_many(keys)
+        missing = {}
+        for annotation, key in zip(pending, keys):
+            annotation._label_links = cached.get(key)
+            if annotation._label_links is None:
+                annotation._label_links = missing[key] = annotation._render_label_links()
+        if missing:
+            cache.set_many(missing, timeout)
+        return annotations
+
+    def _render_label_links(self):
+        """Return the links to the non-background Labels and to all the Labels."""
+        facet_item_links = []
+        links = []
+        # Labels are ordered by name and may have been prefetched
+        for label in self.labels.all():
+            link = '<a class="label-link" href="%s">%s</a>' % (
+                reverse('gcse_label_detail', args=(label.id,)), label.name)
+            links.append(link)
+            if not label.background:
+                facet_item_links.append(link)
+        return ("".join(facet_item_links), "".join(links))
 
     def all_labels_as_links(self):
         return self.labels_as_links(include_background_labels=True)
@@ -560,6 +1006,13 @@ class Annotation(TimeStampedModel):
     def get_absolute_url(self):
         return reverse('gcse_annotation_detail', kwargs={'id': self.id})
 
+    def save(self, *args, **kwargs):
+        for field, value in self.derived_fields(self.comment).items():
+            setattr(self, field, value)
+        # commit the handlers' counter updates along with the row
+        with atomic():
+            super(Annotation, self).save(*args, **kwargs)
+
     def __str__(self):
         return "%s %s" % (self.comment, self.original_url)
 
@@ -643,6 +1096,135 @@ class CSESAXHandler(xml.sax.handler.ContentHandler):
             self.in_background_label = False
 
 
+class AnnotationCount(models.Model):
+    """
+    The number of active Annotations in total, with a Label or in a
+    CustomSearchEngine. Maintained by gcse.counters.
+    """
+    SCOPE = Choices(('A', 'all', _('All')),
+                    ('L', 'label', _('Label')),
+                    ('C', 'cse', _('Custom Search Engine')))
+    scope = models.CharField(max_length=1,
+                             choices=SCOPE)
+    # the Label or CustomSearchEngine id; 0 for all
+    object_id = models.PositiveIntegerField(default=0)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = [['scope', 'object_id']]
+
+
+class AnnotationSearchTerm(models.Model):
+    """
+    A word in an Annotation's comment or original_url. The inverted
+    index used by the 'python' search backend in gcse.search.
+    """
+    term = models.CharField(max_length=64, db_index=True)
+    annotation = models.ForeignKey(Annotation, related_name='search_terms')
+    weight = models.PositiveSmallIntegerField(default=1)
+
+
+@python_2_unicode_compatible
+class Job(TimeStampedModel):
+    """
+    Work queued, e.g. from the admin, to be run out of band by the
+    'run_gcse_jobs' management command. See gcse.jobs.
+    """
+    KIND = Choices(('annotations', 'import_annotations', _('Import Annotations')),
+                   ('cse', 'import_cse', _('Import Custom Search Engine')),
+                   ('xml', 'rebuild_cse_xml', _('Rebuild Custom Search Engine XML')))
+    STATUS = Choices(('Q', 'queued', _('Queued')),
+                     ('R', 'running', _('Running')),
+                     ('D', 'done', _('Done')),
+                     ('F', 'failed', _('Failed')))
+    kind = models.CharField(max_length=16,
+                            choices=KIND)
+    status = models.CharField(max_length=1,
+                              choices=STATUS,
+                              default=STATUS.queued,
+                              db_index=True)
+    source = models.CharField(max_length=1024,
+                              blank=True,
+                              help_text=_('URL or file name of the file to import.'))
+    data = models.TextField(blank=True,
+                            help_text=_('Content of an Annotations file to import.'))
+    upload = models.FileField(upload_to='gcse/imports',
+                              blank=True,
+                              help_text=_('Uploaded file to import, stored as it was received.'))
+    gid = models.CharField(max_length=32,
+                           blank=True,
+                           help_text=_('Custom Search Engine to rebuild; all of them when blank.'))
+    bulk = models.BooleanField(default=True,
+                               help_text=_('Import the Annotations in batches.'))
+    progress = models.PositiveIntegerField(default=0)
+    total = models.PositiveIntegerField(null=True, blank=True)
+    message = models.TextField(blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now, db_index=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    def report_progress(self, progress, total=None):
+        """Record the number of items processed, e.g. while the Job is running."""
+        self.progress = progress
+        fields = {'progress': progress, 'modified': timezone.now()}
+        if total is not None:
+            self.total = fields['total'] = total
+        # not once the Job has been claimed again, e.g. after it was taken as abandoned
+        Job.objects.filter(pk=self.pk, started=self.started).update(**fields)
+
+    def __str__(self):
+        return "%s %s" % (self.get_kind_display(), self.source or self.upload or self.gid)
+
+
+def _open(url):
+    """Open a URL or file name for reading."""
+    if '://' in url:
+        return closing(urlopen(url, timeout=settings.GCSE_CONFIG.get('FETCH_TIMEOUT')))
+    return open(url, 'rb')
+
+
+def _download(url):
+    """Copy the content at the URL into a temporary file and return it."""
+    f = tempfile.TemporaryFile()
+    with _open(url) as source:
+        shutil.copyfileobj(source, f)
+    f.seek(0)
+    return f
+
+
+def _annotation_files(urls, threads=None):
+    """
+    Generate the Annotations files at the urls, in order, for a single
+    thread to import. The files are downloaded by a pool of up to
+    'threads' (default GCSE_CONFIG['NUM_ANNOTATION_FETCH_THREADS'])
+    threads while the earlier ones are imported.
+    """
+    if threads is None:
+        threads = settings.GCSE_CONFIG.get('NUM_ANNOTATION_FETCH_THREADS')
+    threads = min(threads or 1, len(urls))
+    if threads <= 1:
+        for url in urls:
+            yield url
+        return
+
+    pool = ThreadPool(threads)
+    try:
+        for source in pool.imap(_download, urls):
+            with source:
+                yield source
+    finally:
+        # abandon any downloads still running if an import failed
+        pool.terminate()
+
+
+def _ns_name(tag):
+    """Split an lxml '{uri}name' tag into the (uri, name) pair used by SAX."""
+    if tag.startswith('{'):
+        return tuple(tag[1:].split('}', 1))
+    return (None, tag)
+
+
 class AnnotationSAXHandler(xml.sax.handler.ContentHandler):
     """
     Create a set of Annotation instances from an XML file.  Finds or
@@ -656,24 +1238,68 @@ class AnnotationSAXHandler(xml.sax.handler.ContentHandler):
     raise an assertion?, add them all?
     """
 
-    def __init__(self, klass=Annotation):
+    # called with the number of Annotations imported every progress_interval Annotations
+    progress = None
+    progress_interval = 100
+
+    def __init__(self, klass=Annotation, collect=True):
         self.klass = klass
         self.curAnnotation = None
         self.curLabel = None
         self.inComment = False
+        # set 'collect' False to only count the Annotations when importing
+        # files too large to keep every instance in memory
+        self.collect = collect
+        self.count = 0
         self.annotations = []
 
-    def _parse(self, tree):
-        lxml.sax.saxify(tree, self)
+    def _parse(self, source):
+        """
+        Drive the handler from an incremental parse of the source
+        rather than building the whole tree. Each child of the root
+        element is discarded once handled so memory use doesn't grow
+        with the size of the file.
+        """
+        root = None
+        for event, element in lxml.etree.iterparse(source, events=('start', 'end')):
+            ns_name = _ns_name(element.tag)
+            if event == 'start':
+                if root is None:
+                    root = element
+                attributes = dict((_ns_name(key), value) for key, value in element.attrib.items())
+                self.startElementNS(ns_name, ns_name[1], attributes)
+            else:
+                if element.text:
+                    self.characters(element.text)
+                self.endElementNS(ns_name, ns_name[1])
+                if element.getparent() is root:
+                    element.clear()
+                    while element.getprevious() is not None:
+                        del root[0]
+
+    def _add(self, annotation):
+        self.count += 1
+        if self.progress is not None and self.count % self.progress_interval == 0:
+            self.progress(self.count)
+        if self.collect:
+            self.annotations.append(annotation)
 
     def parseString(self, xml):
-        tree = lxml.etree.fromstring(xml)
-        self._parse(tree)
+        if not isinstance(xml, bytes):
+            xml = xml.encode('utf-8')
+        # the Includes of the CustomSearchEngines are updated once per file
+        with CustomSearchEngine.deferred_xml_updates():
+            self._parse(io.BytesIO(xml))
         return self.annotations
 
     def parse(self, url):
-        tree = lxml.etree.parse(url)
-        self._parse(tree)
+        with CustomSearchEngine.deferred_xml_updates():
+            # also accepts an open file
+            if hasattr(url, 'read'):
+                self._parse(url)
+            else:
+                with _open(url) as f:
+                    self._parse(f)
         return self.annotations
 
     def _convert_google_timestamp(self, tstring):
@@ -713,10 +1339,384 @@ class AnnotationSAXHandler(xml.sax.handler.ContentHandler):
     def endElementNS(self, ns_name, qname):
         if qname == "Annotation":
             self.curAnnotation.save()
-            self.annotations.append(self.curAnnotation)
+            self._add(self.curAnnotation)
             self.curAnnotation = None
         elif qname == "Comment":
             self.inComment = False
             # Store in database unescaped - let view(s) escape if needed
             self.curAnnotation.comment = \
                 xml.sax.saxutils.unescape(self.curAnnotation.comment)
+
+
+class BulkAnnotationSAXHandler(AnnotationSAXHandler):
+    """
+    Create the same Annotations as AnnotationSAXHandler but in batches
+    of GCSE_CONFIG['ANNOTATION_IMPORT_BATCH_SIZE'] for importing large
+    files.
+
+    Labels are looked up by name once per import, new Annotations and
+    their Labels are inserted with bulk_create and each batch is
+    written in its own transaction: a handful of queries per batch
+    rather than several per Annotation. Annotations already in the
+    database are matched the same way get_or_create() matches them.
+
+    bulk_create() doesn't send signals so the CustomSearchEngines using
+    the imported Labels are invalidated once the import is complete.
+    """
+
+    def __init__(self, klass=Annotation, collect=True, batch_size=None):
+        AnnotationSAXHandler.__init__(self, klass=klass, collect=collect)
+        self.batch_size = batch_size or settings.GCSE_CONFIG.get('ANNOTATION_IMPORT_BATCH_SIZE')
+        self.batch = []
+        self.label_ids = {}
+        self.imported_label_ids = set()
+        self.curLabels = []
+        self.curFields = set()
+
+    def _parse(self, tree):
+        AnnotationSAXHandler._parse(self, tree)
+        self._flush()
+        signals.invalidate_labels(self.imported_label_ids)
+
+    def startElementNS(self, ns_name, qname, attributes):
+        uri, name = ns_name
+        if name == "Annotation":
+            self.curAnnotation = self.klass(about=attributes[(None, "about")],
+                                            score=attributes.get((None, "score")),
+                                            created=self._convert_google_timestamp(attributes.get((None, "timestamp"))),
+                                            # imports are always active
+                                            status=Annotation.STATUS.active)
+            self.curLabels = []
+            self.curFields = set()
+        elif name == "Label":
+            self.curLabels.append(attributes[(None, 'name')])
+        else:
+            AnnotationSAXHandler.startElementNS(self, ns_name, qname, attributes)
+            if name == "AdditionalData" and attributes[(None, 'attribute')] == 'original_url':
+                self.curFields.add('original_url')
+            elif name == "Comment":
+                self.curFields.add('comment')
+
+    def endElementNS(self, ns_name, qname):
+        if qname == "Annotation":
+            self.batch.append((self.curAnnotation, self.curLabels, self.curFields))
+            self.curAnnotation = None
+            if len(self.batch) >= self.batch_size:
+                self._flush()
+        else:
+            AnnotationSAXHandler.endElementNS(self, ns_name, qname)
+
+    def _flush(self):
+        if self.batch:
+            with atomic():
+                self._write_batch(self.batch)
+            self.batch = []
+
+    @staticmethod
+    def _key(about, score, created):
+        # the fields get_or_create() matches Annotations on
+        return (about, None if score is None else float(score), created)
+
+    def _resolve_labels(self, names):
+        """Add the ids of the named Labels, creating any missing ones, to self.label_ids."""
+        names = list(set(names) - set(self.label_ids))
+        for i in range(0, len(names), self.batch_size):
+            chunk = names[i:i + self.batch_size]
+            found = dict(Label.objects.filter(name__in=chunk).order_by('-id').values_list('name', 'id'))
+            missing = [name for name in chunk if name not in found]
+            if missing:
+                Label.objects.bulk_create([Label(name=name) for name in missing])
+                found.update(Label.objects.filter(name__in=missing).values_list('name', 'id'))
+            self.label_ids.update(found)
+
+    def _lock(self):
+        """
+        Make other imports wait for this batch to commit so the
+        Annotations matched and inserted by each don't interleave.
+        SQLite only has one writer at a time anyway.
+        """
+        if connection.vendor == 'postgresql':
+            connection.cursor().execute('LOCK TABLE %s IN SHARE ROW EXCLUSIVE MODE' %
+                                        connection.ops.quote_name(Annotation._meta.db_table))
+
+    def _read_back_ids(self, annotations, known_ids):
+        """
+        Set the primary keys of Annotations inserted by bulk_create(),
+        which only returns them on some backends, by matching the rows
+        that weren't there before on the fields the batch was merged on.
+        """
+        annotations = dict((self._key(annotation.about, annotation.score, annotation.created), annotation)
+                           for annotation in annotations)
+        rows = self.klass.objects.filter(about__in=set(key[0] for key in annotations)).\
+            values_list('id', 'about', 'score', 'created')
+        for pk, about, score, created in rows:
+            annotation = annotations.get(self._key(about, score, created))
+            if pk in known_ids or annotation is None:
+                continue
+            if annotation.pk is not None:
+                raise IntegrityError("Annotations were inserted during the import")
+            annotation.pk = pk
+        if any(annotation.pk is None for annotation in annotations.values()):
+            raise IntegrityError("Inserted Annotations could not be read back")
+
+    def _write_batch(self, batch, match_existing=True):
+        """
+        Write the batch of (Annotation, Label names, fields) records,
+        updating the Annotations already in the database that match
+        them unless 'match_existing' is False.
+        """
+        self._lock()
+        self._resolve_labels(name for annotation, names, fields in batch for name in names)
+
+        # merge repeated Annotations as successive get_or_create() calls would
+        rows = {}
+        keys = []
+        for annotation, names, fields in batch:
+            key = self._key(annotation.about, annotation.score, annotation.created)
+            if key not in rows:
+                rows[key] = {'annotation': annotation, 'fields': set(), 'label_ids': set()}
+            row = rows[key]
+            for field in fields:
+                setattr(row['annotation'], field, getattr(annotation, field))
+            row['fields'].update(fields)
+            row['label_ids'].update(self.label_ids[name] for name in names)
+            keys.append(key)
+        abouts = set(key[0] for key in rows)
+
+        # update the existing Annotations with the fields present in the XML
+        existing_ids = []
+        known_ids = set()
+        matches = self.klass.objects.filter(about__in=abouts)
+        if not match_existing:
+            known_ids.update(matches.values_list('id', flat=True))
+            matches = []
+        reactivated_ids = set()
+        for existing in matches:
+            known_ids.add(existing.pk)
+            key = self._key(existing.about, existing.score, existing.created)
+            if key in rows:
+                if existing.status != Annotation.STATUS.active:
+                    reactivated_ids.add(existing.pk)
+                row = rows[key]
+                values = dict((field, getattr(row['annotation'], field)) for field in row['fields'])
+                values.update(status=Annotation.STATUS.active, modified=timezone.now())
+                if 'comment' in values:
+                    values.update(Annotation.derived_fields(values['comment']))
+                self.klass.objects.filter(pk=existing.pk).update(**values)
+                for field, value in values.items():
+                    setattr(existing, field, value)
+                row['annotation'] = existing
+                existing_ids.append(existing.pk)
+
+        new = [row['annotation'] for row in rows.values() if row['annotation'].pk is None]
+        if self.klass._meta.parents:
+            # bulk_create() can't insert multi-table inherited models
+            for annotation in new:
+                annotation.save()
+        elif new:
+            # bulk_create() doesn't call save()
+            for annotation in new:
+                for field, value in Annotation.derived_fields(annotation.comment).items():
+                    setattr(annotation, field, value)
+            self.klass.objects.bulk_create(new)
+            if any(annotation.pk is None for annotation in new):
+                self._read_back_ids(new, known_ids)
+
+        # Labels are only ever added to Annotations, as labels.add() does
+        through = Annotation.labels.through
+        current = set(through.objects.filter(annotation_id__in=existing_ids).
+                      values_list('annotation_id', 'label_id'))
+        # the counts of the Labels the reactivated Annotations already had change too
+        self.imported_label_ids.update(label_id for annotation_id, label_id in current
+                                       if annotation_id in reactivated_ids)
+        links = []
+        for row in rows.values():
+            annotation_id = row['annotation'].pk
+            for label_id in row['label_ids']:
+                if (annotation_id, label_id) not in current:
+                    links.append(through(annotation_id=annotation_id, label_id=label_id))
+            self.imported_label_ids.update(row['label_ids'])
+        through.objects.bulk_create(links)
+
+        signals.reindex(row['annotation'] for row in rows.values())
+        for key in keys:
+            self._add(rows[key]['annotation'])
+
+
+class SyncAnnotationSAXHandler(BulkAnnotationSAXHandler):
+    """
+    Synchronize the Annotations of a CustomSearchEngine with one or more
+    Annotations files, e.g. on a nightly re-import of a hosted CSE.
+
+    parse() each of the CustomSearchEngine's files and then call sync()
+    which compares every Annotation in the files with the active and
+    deleted Annotations having the CustomSearchEngine's background
+    Labels and writes only the differences: new Annotations are
+    inserted, changed ones updated and those no longer in the files
+    marked deleted.
+
+    Annotations are matched by 'about' and compared on their score,
+    Labels, comment and original_url. Only the CustomSearchEngine's
+    Annotations are matched, so Annotations elsewhere with the same
+    'about' are left alone and new ones inserted. Annotations shared
+    with other CustomSearchEngines keep the Labels those use: Labels
+    are only removed if no other CustomSearchEngine uses them, as a
+    background Label or a FacetItem's, and an Annotation having any of
+    theirs leaves this CustomSearchEngine, by losing the others, rather
+    than being marked deleted.
+    """
+
+    def __init__(self, cse, klass=Annotation, batch_size=None):
+        BulkAnnotationSAXHandler.__init__(self, klass=klass, collect=False, batch_size=batch_size)
+        self.cse = cse
+        self.records = []
+
+    def _parse(self, source):
+        AnnotationSAXHandler._parse(self, source)
+        self._flush()
+
+    def _flush(self):
+        self.records.extend(self.batch)
+        self.batch = []
+
+    @staticmethod
+    def _fingerprint(about, score, label_names, comment, original_url):
+        return (about, None if score is None else float(score),
+                tuple(sorted(set(label_names))), comment, original_url)
+
+    def _cse_label_ids(self):
+        """
+        Return the ids of the Labels this CustomSearchEngine uses and of
+        those the other CustomSearchEngines use, as background Labels or
+        their FacetItems' Labels.
+        """
+        own, other = set(), set()
+        through = CustomSearchEngine.background_labels.through
+        rows = list(through.objects.values_list('customsearchengine_id', 'label_id'))
+        rows.extend(FacetItem.objects.filter(label__isnull=False).values_list('cse_id', 'label_id'))
+        for cse_id, label_id in rows:
+            (own if cse_id == self.cse.pk else other).add(label_id)
+        return own, other
+
+    def _existing(self):
+        """Return the CustomSearchEngine's active and deleted Annotations keyed by 'about'."""
+        own_label_ids, self.other_label_ids = self._cse_label_ids()
+        # Labels only other CustomSearchEngines use aren't in this one's files
+        foreign_label_ids = self.other_label_ids - own_label_ids
+        annotations = self.klass.objects.filter(labels__in=self.cse.background_labels.all(),
+                                                status__in=[Annotation.STATUS.active,
+                                                            Annotation.STATUS.deleted]).distinct()
+        labels = {}
+        for annotation_id, label_id, name in Annotation.labels.through.objects.\
+                filter(annotation__in=annotations.values('id')).\
+                values_list('annotation_id', 'label_id', 'label__name'):
+            labels.setdefault(annotation_id, []).append((label_id, name))
+        existing = {}
+        for row in annotations.order_by('id').values('id', 'about', 'score', 'comment',
+                                                     'original_url', 'status'):
+            row_labels = labels.get(row['id'], [])
+            row['label_ids'] = set(label_id for label_id, name in row_labels)
+            row['label_names'] = [name for label_id, name in row_labels if label_id not in foreign_label_ids]
+            row['fingerprint'] = self._fingerprint(row['about'], row['score'], row['label_names'],
+                                                   row['comment'], row['original_url'])
+            existing.setdefault(row['about'], []).append(row)
+        for rows in existing.values():
+            # prefer matching active Annotations
+            rows.sort(key=lambda row: row['status'] != Annotation.STATUS.active)
+        return existing
+
+    def _diff(self):
+        existing = self._existing()
+        inserts, updates, unchanged = [], [], 0
+        records = {}
+        for annotation, names, fields in self.records:
+            records.setdefault(annotation.about, []).append((annotation, names))
+        for about, recs in records.items():
+            rows = existing.get(about, [])
+            unmatched = []
+            for annotation, names in recs:
+                fingerprint = self._fingerprint(annotation.about, annotation.score, names,
+                                                annotation.comment, annotation.original_url)
+                match = next((row for row in rows if row['fingerprint'] == fingerprint), None)
+                if match is None:
+                    unmatched.append((annotation, names))
+                    continue
+                rows.remove(match)
+                if match['status'] == Annotation.STATUS.active:
+                    unchanged += 1
+                else:
+                    updates.append((match, annotation, names))
+            for annotation, names in unmatched:
+                if rows:
+                    updates.append((rows.pop(0), annotation, names))
+                else:
+                    inserts.append((annotation, names, set(['comment', 'original_url'])))
+        deletes = []
+        detaches = []
+        for rows in existing.values():
+            for row in rows:
+                if row['status'] != Annotation.STATUS.active:
+                    continue
+                if not row['label_ids'] & self.other_label_ids:
+                    deletes.append(row['id'])
+                elif row['label_ids'] - self.other_label_ids:
+                    # still in other CustomSearchEngines
+                    detaches.append(row)
+        return inserts, updates, deletes, detaches, unchanged
+
+    def sync(self):
+        inserts, updates, deletes, detaches, unchanged = self._diff()
+        counts = {'inserted': len(inserts),
+                  'updated': len(updates),
+                  'deleted': len(deletes) + len(detaches),
+                  'unchanged': unchanged}
+        if not (inserts or updates or deletes or detaches):
+            return counts
+
+        with atomic():
+            now = timezone.now()
+            for i in range(0, len(inserts), self.batch_size):
+                # already matched against the CustomSearchEngine's Annotations
+                self._write_batch(inserts[i:i + self.batch_size], match_existing=False)
+
+            self._resolve_labels(name for row, annotation, names in updates for name in names)
+            through = Annotation.labels.through
+            links = []
+            for row, annotation, names in updates:
+                values = Annotation.derived_fields(annotation.comment)
+                self.klass.objects.filter(pk=row['id']).update(score=annotation.score,
+                                                               comment=annotation.comment,
+                                                               original_url=annotation.original_url,
+                                                               status=Annotation.STATUS.active,
+                                                               modified=now,
+                                                               **values)
+                label_ids = set(self.label_ids[name] for name in names)
+                current = row['label_ids']
+                removed = current - label_ids - self.other_label_ids
+                if removed:
+                    through.objects.filter(annotation_id=row['id'], label_id__in=removed).delete()
+                links.extend(through(annotation_id=row['id'], label_id=label_id)
+                             for label_id in label_ids - current)
+                self.imported_label_ids.update(label_ids | removed)
+                annotation.pk = row['id']
+            through.objects.bulk_create(links)
+            signals.reindex(annotation for row, annotation, names in updates)
+
+            for i in range(0, len(deletes), self.batch_size):
+                self.klass.objects.filter(pk__in=deletes[i:i + self.batch_size]).\
+                    update(status=Annotation.STATUS.deleted, modified=now)
+            for row in detaches:
+                removed = row['label_ids'] - self.other_label_ids
+                through.objects.filter(annotation_id=row['id'], label_id__in=removed).delete()
+                self.imported_label_ids.update(removed)
+
+        # updated and deleted Annotations may have had any Labels
+        signals.invalidate_annotations()
+        signals.invalidate_labels(self.imported_label_ids)
+        signals.invalidate([self.cse.gid], refresh_includes=True)
+        return counts
+
+
+# connect the handlers keeping cached content, the search index and the
+# counts up to date
+from gcse import counters, signals
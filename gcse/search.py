@@ -0,0 +1,277 @@
+"""
+Full text search of Annotation comments and original_urls.
+
+The backend is chosen by GCSE_CONFIG['ANNOTATION_SEARCH_BACKEND']:
+
+'auto'
+    'sqlite' or 'postgresql' to match the database, otherwise 'python'.
+'sqlite'
+    An FTS5 table, gcse_annotation_fts, ranked with bm25().
+'postgresql'
+    A GIN index on the Annotations' tsvector, ranked with ts_rank().
+'python'
+    Words are extracted in Python and stored in AnnotationSearchTerm,
+    which works with any database.
+None
+    Searches with LIKE '%query%' on every Annotation.
+
+Every word in a query must prefix a word of the comment or
+original_url of the matching Annotations. The index is created, and
+filled with any existing Annotations, along with the gcse tables by
+syncdb/migrate. It is kept up to date by the handlers in gcse.signals
+and can be (re)built with the 'rebuild_search_index' management command.
+"""
+import abc
+import re
+
+from django.conf import settings
+from django.db import connection, connections, DatabaseError
+from django.db.models import Max
+from django.dispatch import receiver
+from django.utils import six
+try:
+    from django.db.models.signals import post_migrate as post_install
+except ImportError:
+    # Django < 1.7
+    from django.db.models.signals import post_syncdb as post_install
+
+from gcse.models import Annotation, AnnotationSearchTerm
+
+
+def terms(text):
+    """Return the lower case words in the text."""
+    return re.findall(r'\w+', (text or '').lower(), re.UNICODE)
+
+
+@six.add_metaclass(abc.ABCMeta)
+class SearchBackend(object):
+    """
+    Base class of the Annotation search backends, which must implement
+    search() and whatever indexing their search needs.
+    """
+
+    def install(self, using='default'):
+        """Create the database objects the backend needs."""
+
+    def index(self, annotations):
+        """Add or replace the Annotations in the index."""
+
+    def remove(self, annotation_ids):
+        """Remove the Annotations from the index."""
+
+    def clear(self):
+        """Remove every Annotation from the index."""
+
+    def is_empty(self):
+        """Whether no Annotations are in the index."""
+        return False
+
+    def rebuild(self, batch_size=1000):
+        """Index every Annotation afresh, returning the number indexed."""
+        self.clear()
+        count = 0
+        last_id = 0
+        while True:
+            annotations = list(Annotation.objects.filter(id__gt=last_id).order_by('id').
+                               only('id', 'comment', 'original_url')[:batch_size])
+            if not annotations:
+                return count
+            self.index(annotations)
+            count += len(annotations)
+            last_id = annotations[-1].id
+
+    @abc.abstractmethod
+    def search(self, queryset, query):
+        """Return the Annotations in the queryset matching the query, best matches first."""
+
+
+class SQLiteBackend(SearchBackend):
+    TABLE = 'gcse_annotation_fts'
+
+    def install(self, using='default'):
+        connections[using].cursor().execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(comment, original_url)" % self.TABLE)
+
+    def index(self, annotations):
+        rows = [(a.pk, a.comment, a.original_url) for a in annotations]
+        if rows:
+            cursor = connection.cursor()
+            cursor.executemany("DELETE FROM %s WHERE rowid = %%s" % self.TABLE,
+                               [(row[0],) for row in rows])
+            cursor.executemany("INSERT INTO %s (rowid, comment, original_url) VALUES (%%s, %%s, %%s)" % self.TABLE,
+                               rows)
+
+    def remove(self, annotation_ids):
+        connection.cursor().executemany("DELETE FROM %s WHERE rowid = %%s" % self.TABLE,
+                                        [(annotation_id,) for annotation_id in annotation_ids])
+
+    def clear(self):
+        connection.cursor().execute("DELETE FROM %s" % self.TABLE)
+
+    def is_empty(self):
+        cursor = connection.cursor()
+        cursor.execute("SELECT 1 FROM %s LIMIT 1" % self.TABLE)
+        return cursor.fetchone() is None
+
+    def search(self, queryset, query):
+        words = terms(query)
+        if not words:
+            return queryset.none()
+        match = ' '.join('"%s"*' % word for word in words)
+        return queryset.extra(select={'search_rank': 'bm25(%s, 2.0, 1.0)' % self.TABLE},
+                              tables=[self.TABLE],
+                              where=['%s.rowid = %s.id' % (self.TABLE, queryset.model._meta.db_table),
+                                     '%s MATCH %%s' % self.TABLE],
+                              params=[match],
+                              order_by=['search_rank'])
+
+
+class PostgreSQLBackend(SearchBackend):
+    """The tsvector is computed from the columns so there is nothing to keep in sync."""
+    INDEX = 'gcse_annotation_search'
+    VECTOR = ("to_tsvector('simple', coalesce(%(table)scomment, '') || ' ' || "
+              "coalesce(%(table)soriginal_url, ''))")
+
+    def install(self, using='default'):
+        connections[using].cursor().execute(
+            "CREATE INDEX IF NOT EXISTS %s ON %s USING gin((%s))" % (
+                self.INDEX, Annotation._meta.db_table, self.VECTOR % {'table': ''}))
+
+    def search(self, queryset, query):
+        words = terms(query)
+        if not words:
+            return queryset.none()
+        tsquery = ' & '.join('%s:*' % word for word in words)
+        vector = self.VECTOR % {'table': '%s.' % queryset.model._meta.db_table}
+        return queryset.extra(select={'search_rank': "ts_rank(%s, to_tsquery('simple', %%s))" % vector},
+                              select_params=[tsquery],
+                              where=["%s @@ to_tsquery('simple', %%s)" % vector],
+                              params=[tsquery],
+                              order_by=['-search_rank'])
+
+
+class PythonBackend(SearchBackend):
+    """
+    An inverted index of AnnotationSearchTerms. Words in the comment
+    rank above those only in the original_url. At most
+    GCSE_CONFIG['ANNOTATION_SEARCH_MAX_RESULTS'] Annotations are returned.
+    """
+    COMMENT_WEIGHT = 2
+    URL_WEIGHT = 1
+
+    def index(self, annotations):
+        annotations = list(annotations)
+        self.remove([a.pk for a in annotations])
+        search_terms = []
+        max_length = AnnotationSearchTerm._meta.get_field('term').max_length
+        for annotation in annotations:
+            weights = {}
+            for word in terms(annotation.original_url):
+                weights[word[:max_length]] = self.URL_WEIGHT
+            for word in terms(annotation.comment):
+                weights[word[:max_length]] = self.COMMENT_WEIGHT
+            search_terms.extend(AnnotationSearchTerm(annotation_id=annotation.pk, term=term, weight=weight)
+                                for term, weight in weights.items())
+        AnnotationSearchTerm.objects.bulk_create(search_terms)
+
+    def remove(self, annotation_ids):
+        if annotation_ids:
+            AnnotationSearchTerm.objects.filter(annotation_id__in=annotation_ids).delete()
+
+    def clear(self):
+        AnnotationSearchTerm.objects.all().delete()
+
+    def is_empty(self):
+        return not AnnotationSearchTerm.objects.exists()
+
+    def search(self, queryset, query):
+        max_length = AnnotationSearchTerm._meta.get_field('term').max_length
+        # truncated like the indexed terms
+        words = sorted(set(word[:max_length] for word in terms(query)))
+        if not words:
+            return queryset.none()
+        # only the queryset's Annotations count towards the results kept
+        annotation_ids = queryset.order_by().values('id')
+        # the best weight of each word's matches per Annotation, joined so
+        # only the Annotations matching every word are scored
+        tables = []
+        params = []
+        for i, word in enumerate(words):
+            matches = AnnotationSearchTerm.objects.filter(term__startswith=word, annotation__in=annotation_ids).\
+                values('annotation_id').annotate(best=Max('weight')).order_by()
+            sql, word_params = matches.query.sql_with_params()
+            tables.append('(%s) w%d' % (sql, i))
+            params.extend(word_params)
+        sql = 'SELECT w0.annotation_id FROM %s' % tables[0]
+        for i, table in enumerate(tables[1:], 1):
+            sql += ' INNER JOIN %s ON w%d.annotation_id = w0.annotation_id' % (table, i)
+        sql += ' ORDER BY %s DESC, w0.annotation_id LIMIT %%s' % ' + '.join('w%d.best' % i for i in range(len(words)))
+        params.append(settings.GCSE_CONFIG.get('ANNOTATION_SEARCH_MAX_RESULTS'))
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        ranked = [row[0] for row in cursor.fetchall()]
+        if not ranked:
+            return queryset.none()
+
+        table = queryset.model._meta.db_table
+        rank = 'CASE %s.id %s END' % (table, ' '.join('WHEN %d THEN %d' % (annotation_id, i)
+                                                         for i, annotation_id in enumerate(ranked)))
+        return queryset.filter(id__in=ranked).extra(select={'search_rank': rank},
+                                                    order_by=['search_rank'])
+
+BACKENDS = {
+    'sqlite': SQLiteBackend,
+    'postgresql': PostgreSQLBackend,
+    'python': PythonBackend,
+    }
+
+_backends = {}
+
+
+def _fts5_available(using='default'):
+    cursor = connections[using].cursor()
+    try:
+        cursor.execute("CREATE VIRTUAL TABLE temp.gcse_fts5_check USING fts5(content)")
+    except DatabaseError:
+        return False
+    cursor.execute("DROP TABLE temp.gcse_fts5_check")
+    return True
+
+
+def _backend_name(using='default'):
+    name = settings.GCSE_CONFIG.get('ANNOTATION_SEARCH_BACKEND')
+    if name == 'auto':
+        vendor = connections[using].vendor
+        if vendor == 'sqlite' and not _fts5_available(using):
+            name = 'python'
+        else:
+            name = vendor if vendor in BACKENDS else 'python'
+    return name
+
+
+def get_backend():
+    """Return the configured SearchBackend or None if search indexing is disabled."""
+    configured = settings.GCSE_CONFIG.get('ANNOTATION_SEARCH_BACKEND')
+    if not configured:
+        return None
+    if configured not in _backends:
+        _backends[configured] = BACKENDS[_backend_name()]()
+    return _backends[configured]
+
+
+@receiver(post_install)
+def install_index(sender, **kwargs):
+    """
+    Create the index, which isn't a model, with the gcse tables and
+    index any Annotations already in the database.
+    """
+    # the models module before Django 1.7, the AppConfig after
+    if getattr(sender, 'name', getattr(sender, '__name__', None)) not in ('gcse', 'gcse.models'):
+        return
+    if kwargs.get('using', kwargs.get('db')) != 'default':
+        return
+    backend = get_backend()
+    if backend is not None:
+        backend.install()
+        if backend.is_empty() and Annotation.objects.exists():
+            backend.rebuild()
@@ -0,0 +1,288 @@
+"""
+Signal handlers keeping cached CustomSearchEngine content and pages,
+the BackgroundLabels, Facets and Annotation Include elements of the
+CustomSearchEngine XML, the
+Annotation search index and the Annotation counts consistent with the
+Labels, FacetItems and Annotations they are built from.
+
+Handlers for removals collect the affected CustomSearchEngines in the
+'pre_' signal, while the relations still exist, and invalidate them in
+the matching 'post_' signal.
+"""
+from django.db.models.signals import post_save, pre_delete, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from gcse import caching, counters, search
+from gcse.models import Annotation, CustomSearchEngine, FacetItem, Label
+
+
+def _gids_for_labels(label_ids):
+    """The gids of the CustomSearchEngines with any of the Labels as background Labels."""
+    return set(CustomSearchEngine.objects.filter(background_labels__in=list(label_ids)).
+               values_list('gid', flat=True))
+
+
+def _gids_for_annotations(annotation_ids):
+    """The gids of the CustomSearchEngines any of the Annotations are in."""
+    return set(CustomSearchEngine.objects.filter(background_labels__annotation__in=list(annotation_ids)).
+               values_list('gid', flat=True))
+
+
+def _cse_ids_by_label(label_ids):
+    """Map each of the Labels to the ids of the CustomSearchEngines with it as a background Label."""
+    cse_ids = dict((label_id, set()) for label_id in label_ids)
+    if cse_ids:
+        through = CustomSearchEngine.background_labels.through
+        for label_id, cse_id in through.objects.filter(label_id__in=list(cse_ids)).\
+                values_list('label_id', 'customsearchengine_id'):
+            cse_ids[label_id].add(cse_id)
+    return cse_ids
+
+
+def _cse_ids(cse_ids_by_label, label_ids):
+    return set(cse_id for label_id in label_ids for cse_id in cse_ids_by_label[label_id])
+
+
+def _adjust_counts(label_ids, delta):
+    """Count an active Annotation with the Labels in or out of the totals."""
+    label_ids = list(label_ids)
+    counters.adjust(counters.ALL, [0], delta)
+    counters.adjust(counters.LABEL, label_ids, delta)
+    counters.adjust(counters.CSE, _cse_ids(_cse_ids_by_label(label_ids), label_ids), delta)
+
+
+def _gids_for_label(label):
+    return set(label.cses().values_list('gid', flat=True))
+
+
+def invalidate(gids, refresh_includes=False):
+    """
+    Invalidate the cached content of the CustomSearchEngines with the
+    supplied gids. 'refresh_includes' should be set when the number of
+    Annotations in them may have changed.
+    """
+    if gids:
+        caching.bump_generation(*gids)
+        if refresh_includes:
+            CustomSearchEngine.refresh_includes(gids)
+
+
+def invalidate_labels(label_ids):
+    """
+    Invalidate the CustomSearchEngines using any of the Labels, and the
+    counts of their Annotations, after the Annotations were written
+    without sending signals.
+    """
+    label_ids = list(label_ids)
+    cses = CustomSearchEngine.objects.filter(background_labels__in=label_ids).values_list('id', 'gid')
+    cse_ids = set()
+    gids = set()
+    for cse_id, gid in cses:
+        cse_ids.add(cse_id)
+        gids.add(gid)
+    counters.invalidate(counters.ALL)
+    counters.invalidate(counters.LABEL, label_ids)
+    counters.invalidate(counters.CSE, cse_ids)
+    invalidate(gids, refresh_includes=True)
+    _invalidate_annotation_pages(label_ids)
+
+
+def invalidate_annotations():
+    """
+    Invalidate every count and cached page of Annotations after
+    Annotations, whose Labels aren't known, were written without
+    sending signals.
+    """
+    counters.clear()
+    invalidate_pages(caching.ANNOTATIONS, caching.LABELS)
+
+
+def invalidate_pages(*scopes):
+    """Invalidate the cached pages showing content of the scopes; see gcse.caching."""
+    caching.bump_generation(*scopes)
+
+
+def _invalidate_annotation_pages(label_ids):
+    invalidate_pages(caching.ANNOTATIONS, *[caching.label_scope(label_id) for label_id in label_ids])
+
+
+def reindex(annotations):
+    """Update the search index for Annotations written without sending signals."""
+    backend = search.get_backend()
+    if backend is not None:
+        backend.index(annotations)
+
+
+def _invalidate_pending(instance, refresh_includes=False):
+    invalidate(getattr(instance, '_gcse_pending_gids', None), refresh_includes)
+    instance._gcse_pending_gids = None
+
+
+@receiver(post_save, sender=CustomSearchEngine)
+def cse_saved(sender, instance, **kwargs):
+    invalidate([instance.gid])
+    invalidate_pages(caching.CSES)
+
+
+@receiver(post_delete, sender=CustomSearchEngine)
+def cse_deleted(sender, instance, **kwargs):
+    counters.invalidate(counters.CSE, [instance.id])
+    invalidate_pages(caching.CSES, instance.gid)
+
+
+@receiver(post_save, sender=FacetItem)
+@receiver(post_delete, sender=FacetItem)
+def facet_item_changed(sender, instance, **kwargs):
+    # Labels are listed with the CustomSearchEngines using them
+    invalidate_pages(caching.CSES)
+    try:
+        cse = instance.cse
+    except CustomSearchEngine.DoesNotExist:
+        # deleted along with its CustomSearchEngine
+        return
+    CustomSearchEngine.schedule_xml_update(cse.pk, ['facets'], cse)
+    invalidate([cse.gid])
+
+
+@receiver(post_save, sender=Label)
+def label_saved(sender, instance, **kwargs):
+    cses = list(instance.cses().values_list('id', 'gid'))
+    for cse_id, gid in cses:
+        CustomSearchEngine.schedule_xml_update(cse_id, ['background_labels', 'facets'])
+    invalidate(set(gid for cse_id, gid in cses))
+    invalidate_pages(caching.LABELS, caching.label_scope(instance.id))
+
+
+@receiver(pre_delete, sender=Label)
+def label_deleting(sender, instance, **kwargs):
+    instance._gcse_pending_gids = _gids_for_label(instance)
+    # its Annotations leave these CustomSearchEngines
+    instance._gcse_pending_cse_ids = list(instance.background_cses.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Label)
+def label_deleted(sender, instance, **kwargs):
+    counters.invalidate(counters.LABEL, [instance.id])
+    counters.invalidate(counters.CSE, instance._gcse_pending_cse_ids)
+    _invalidate_pending(instance, refresh_includes=True)
+    invalidate_pages(caching.LABELS, caching.label_scope(instance.id))
+
+
+@receiver(post_save, sender=Annotation)
+def annotation_saved(sender, instance, created, **kwargs):
+    # a new Annotation has no Labels yet
+    label_ids = [] if created else list(instance.labels.values_list('id', flat=True))
+    status_changed = instance.tracker.has_changed('status')
+    if status_changed:
+        was_active = not created and instance.tracker.previous('status') == Annotation.STATUS.active
+        delta = int(instance.status == Annotation.STATUS.active) - int(was_active)
+        if delta:
+            _adjust_counts(label_ids, delta)
+    invalidate(_gids_for_labels(label_ids),
+               refresh_includes=status_changed)
+    _invalidate_annotation_pages(label_ids)
+    reindex([instance])
+
+
+@receiver(pre_delete, sender=Annotation)
+def annotation_deleting(sender, instance, **kwargs):
+    label_ids = list(instance.labels.values_list('id', flat=True))
+    instance._gcse_pending_gids = _gids_for_labels(label_ids)
+    instance._gcse_pending_label_ids = label_ids
+    instance._gcse_pending_active = instance.tracker.previous('status') == Annotation.STATUS.active
+
+
+@receiver(post_delete, sender=Annotation)
+def annotation_deleted(sender, instance, **kwargs):
+    if instance._gcse_pending_active:
+        _adjust_counts(instance._gcse_pending_label_ids, -1)
+    _invalidate_pending(instance,
+                        refresh_includes=instance.status == Annotation.STATUS.active)
+    _invalidate_annotation_pages(instance._gcse_pending_label_ids)
+    backend = search.get_backend()
+    if backend is not None:
+        backend.remove([instance.pk])
+
+
+@receiver(m2m_changed, sender=Annotation.labels.through)
+def annotation_labels_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('pre_add', 'pre_remove', 'pre_clear'):
+        if reverse:
+            # instance is a Label
+            label_ids = [instance.id]
+            annotation_ids = list(instance.annotation_set.values_list('id', flat=True)) if pk_set is None else pk_set
+            gids = _gids_for_label(instance)
+        else:
+            label_ids = list(instance.labels.values_list('id', flat=True)) if pk_set is None else pk_set
+            annotation_ids = [instance.id]
+            gids = _gids_for_labels(label_ids)
+        # the Annotations files of their CustomSearchEngines list all their Labels
+        gids |= _gids_for_annotations(annotation_ids)
+        instance._gcse_pending_gids = gids
+        instance._gcse_pending_label_ids = label_ids
+        instance._gcse_pending_annotation_ids = annotation_ids
+        instance._gcse_pending_counts = None
+        if not reverse and instance.tracker.previous('status') == Annotation.STATUS.active:
+            instance._gcse_pending_counts = _label_count_changes(instance, action, pk_set)
+    else:
+        if reverse:
+            # which of the Annotations are active is costly to work out
+            counters.invalidate(counters.LABEL, [instance.id])
+            counters.invalidate(counters.CSE, instance.background_cses.values_list('id', flat=True))
+        else:
+            pending = instance._gcse_pending_counts
+            instance._gcse_pending_counts = None
+            if pending:
+                label_ids, cse_ids, delta = pending
+                counters.adjust(counters.LABEL, label_ids, delta)
+                counters.adjust(counters.CSE, cse_ids, delta)
+        _invalidate_pending(instance,
+                            refresh_includes=reverse or instance.status == Annotation.STATUS.active)
+        _invalidate_annotation_pages(instance._gcse_pending_label_ids)
+        # the Annotations' rendered Label links
+        invalidate_pages(*[caching.annotation_scope(annotation_id)
+                           for annotation_id in instance._gcse_pending_annotation_ids])
+        if not reverse:
+            instance._label_links = None
+
+
+def _label_count_changes(annotation, action, pk_set):
+    """
+    Return the Labels and CustomSearchEngines an active Annotation is
+    being added to or removed from and the change to their counts.
+    """
+    current = set(annotation.labels.values_list('id', flat=True))
+    if action == 'pre_add':
+        label_ids = set(pk_set) - current
+        after = current | label_ids
+        delta = 1
+    else:
+        label_ids = current if pk_set is None else current & set(pk_set)
+        after = current - label_ids
+        delta = -1
+    cse_ids_by_label = _cse_ids_by_label(current | label_ids)
+    # an Annotation stays in a CustomSearchEngine while any of its Labels are background Labels
+    cse_ids = _cse_ids(cse_ids_by_label, current) ^ _cse_ids(cse_ids_by_label, after)
+    return label_ids, cse_ids, delta
+
+
+@receiver(m2m_changed, sender=CustomSearchEngine.background_labels.through)
+def background_labels_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('pre_add', 'pre_remove', 'pre_clear'):
+        if not reverse:
+            cses = [(instance.id, instance.gid)]
+        elif pk_set is None:
+            cses = instance.background_cses.values_list('id', 'gid')
+        else:
+            cses = CustomSearchEngine.objects.filter(pk__in=pk_set).values_list('id', 'gid')
+        cses = list(cses)
+        instance._gcse_pending_gids = set(gid for cse_id, gid in cses)
+        instance._gcse_pending_cse_ids = [cse_id for cse_id, gid in cses]
+    else:
+        # the Includes follow the Annotations of the background Labels
+        for cse_id in instance._gcse_pending_cse_ids:
+            CustomSearchEngine.schedule_xml_update(cse_id, ['background_labels', 'includes'],
+                                                   None if reverse else instance)
+        counters.invalidate(counters.CSE, instance._gcse_pending_cse_ids)
+        _invalidate_pending(instance)
+        invalidate_pages(caching.CSES)
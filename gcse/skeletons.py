@@ -0,0 +1,147 @@
+"""
+Compiled CustomSearchEngine output_xml templates.
+
+A Skeleton is the input_xml of a CustomSearchEngine parsed once, with
+its gid set and the elements regenerated from the database - the
+Title, Description, BackgroundLabels, Facets and Includes - replaced by
+named slots. Rendering the output_xml joins the serialized text between
+the slots with the XML of each slot, so no parsing or serializing of
+the document is needed once its Skeleton is compiled.
+
+Skeletons are immutable and kept per process keyed on the gid and a
+digest of the input_xml, so a changed input_xml compiles a new one.
+
+Skeleton.slot_values() reads the slots back out of an output_xml
+rendered from the same Skeleton so that only the slots whose values
+change need to be regenerated.
+"""
+from __future__ import unicode_literals
+
+import hashlib
+import re
+
+from lxml import etree as ET
+
+from django.utils import six
+from django.utils.encoding import force_text
+
+
+SLOTS = ('title', 'description', 'background_labels', 'facets', 'includes')
+
+# the XML each slot can hold, matched in rendered output_xml
+SLOT_PATTERNS = dict((slot, re.compile(pattern, re.DOTALL)) for slot, pattern in (
+        ('title', r'(?:<Title\b[^>]*/>|<Title\b[^>]*>.*?</Title>)?'),
+        ('description', r'(?:<Description\b[^>]*/>|<Description\b[^>]*>.*?</Description>)?'),
+        ('background_labels', r'<BackgroundLabels\s*/>|<BackgroundLabels>.*?</BackgroundLabels>'),
+        ('facets', r'(?:<Facet>.*?</Facet>)*'),
+        ('includes', r'(?:<Include\b[^>]*/>)*'),
+        ))
+
+# processing instructions mark the slots while compiling
+SLOT_TARGET = 'gcse-slot'
+SLOT_RE = re.compile(r'<\?%s (\w+)\?>' % SLOT_TARGET)
+
+# most Skeletons kept per process
+MAX_SKELETONS = 1000
+
+_skeletons = {}
+
+
+def add_google_customizations(doc):
+    """Wrap a lone CustomSearchEngine element in a GoogleCustomizations element."""
+    if doc.tag != "GoogleCustomizations":
+        root = ET.XML("<GoogleCustomizations />")
+        root.insert(1, doc)
+        doc = root
+    return doc
+
+
+def _slot(name, tail=None):
+    slot = ET.ProcessingInstruction(SLOT_TARGET, name)
+    slot.tail = tail
+    return slot
+
+
+class Skeleton(object):
+
+    def __init__(self, gid, input_xml):
+        if isinstance(input_xml, six.text_type):
+            # lxml rejects text with an encoding declaration
+            input_xml = input_xml.encode('utf-8')
+        doc = add_google_customizations(ET.fromstring(input_xml))
+        cse = doc.xpath(".//CustomSearchEngine")[0]
+        cse.attrib['id'] = gid
+
+        # the Title and Description are kept when the CustomSearchEngine has none
+        self.defaults = {'background_labels': '<BackgroundLabels/>'}
+        for name in ('title', 'description'):
+            el = doc.find(".//CustomSearchEngine/%s" % name.capitalize())
+            if el is None:
+                cse.insert(1, _slot(name))
+            else:
+                self.defaults[name] = ET.tostring(el, encoding='unicode', with_tail=False)
+                el.getparent().replace(el, _slot(name, el.tail))
+
+        context = doc.xpath(".//Context")[0]
+        for child in context.getchildren():
+            if child.tag in ('BackgroundLabels', 'Facet'):
+                context.remove(child)
+        context.insert(1, _slot('background_labels'))
+        context.append(_slot('facets'))
+
+        for el in doc.findall(".//Include"):
+            el.getparent().remove(el)
+        doc.append(_slot('includes'))
+
+        parts = SLOT_RE.split(ET.tostring(doc, encoding='UTF-8').decode('utf-8'))
+        self.chunks = parts[0::2]
+        self.slots = parts[1::2]
+
+    def render(self, values):
+        """Return the output_xml with the XML of each slot in values, or its default."""
+        parts = [self.chunks[0]]
+        for slot, chunk in zip(self.slots, self.chunks[1:]):
+            value = values.get(slot)
+            parts.append(self.defaults.get(slot, '') if value is None else value)
+            parts.append(chunk)
+        return ''.join(parts).encode('utf-8')
+
+    def slot_values(self, output_xml):
+        """
+        Return a dict of the XML of each slot in the output_xml or None
+        when the output_xml wasn't rendered from this Skeleton.
+        """
+        if not output_xml:
+            return None
+        output = force_text(output_xml)
+        if not output.startswith(self.chunks[0]):
+            return None
+        values = {}
+        start = len(self.chunks[0])
+        for slot, chunk in zip(self.slots, self.chunks[1:]):
+            match = SLOT_PATTERNS[slot].match(output, start)
+            if match is None or not output.startswith(chunk, match.end()):
+                return None
+            end = match.end()
+            values[slot] = output[start:end]
+            start = end + len(chunk)
+        if start != len(output):
+            return None
+        return values
+
+
+def get(gid, input_xml):
+    """Return the Skeleton of the input_xml of the CustomSearchEngine with the gid."""
+    data = input_xml.encode('utf-8') if isinstance(input_xml, six.text_type) else input_xml
+    key = (gid, hashlib.md5(data).hexdigest())
+    skeleton = _skeletons.get(key)
+    if skeleton is None:
+        if len(_skeletons) >= MAX_SKELETONS:
+            _skeletons.clear()
+        skeleton = _skeletons[key] = Skeleton(gid, input_xml)
+    return skeleton
+
+
+def clear():
+    """Discard every Skeleton."""
+    _skeletons.clear()
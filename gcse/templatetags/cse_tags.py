@@ -1,14 +1,14 @@
 from django import template
 
 
-from cse.models import Annotation
+from gcse import counters
 
 class AnnotationCountNode(template.Node):
     def __init__(self):
         pass
 
     def render(self, context):
-        return str(Annotation.objects.filter(status='A').exclude(original_url='').count())
+        return str(counters.count(counters.ALL))
 
 
 def do_annotation_count(parser, token):
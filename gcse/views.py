@@ -1,20 +1,29 @@
+import datetime
+
 from django.template import RequestContext
 from django.shortcuts import render_to_response, get_object_or_404
 from django.http import Http404
 from django.http import HttpResponseRedirect
 from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from django.core.urlresolvers import reverse
 from django.db.models import Q
+from django.core.cache import cache
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
 from django.views.decorators.cache import never_cache
+from django.views.decorators.http import condition
 from django.views.generic.base import View
 from django.views.generic import (DetailView, ListView, TemplateView)
 from django.core.mail import mail_managers
 from django.core import urlresolvers
 from django.contrib.sites.models import Site
 from django.conf import settings
+from django.utils.decorators import method_decorator
+from django.utils.functional import cached_property
 from django.utils.translation import ugettext_lazy as _
 
+from gcse import caching, counters, search
+from gcse.feeds import annotations_xml, KeysetPage
 from gcse.models import CustomSearchEngine, Annotation, Label
 
 try:
@@ -23,42 +32,206 @@ except ImportError:
     import json
 
 
-class CustomSearchEngineList(ListView):
+class PageCacheMixin(object):
+    """
+    Cache the rendered page for GCSE_CONFIG['PAGE_CACHE_TIMEOUT']
+    seconds. The cache key includes the generations of the
+    page_cache_scopes (see gcse.caching) so the handlers in gcse.signals
+    invalidate just the pages showing content that changed.
+
+    Only GET requests by anonymous users are cached.
+    """
+    page_cache_scopes = ()
+
+    def get_page_cache_scopes(self):
+        return self.page_cache_scopes
+
+    def dispatch(self, request, *args, **kwargs):
+        timeout = caching.timeout('PAGE_CACHE_TIMEOUT')
+        user = getattr(request, 'user', None)
+        if not timeout or request.method != 'GET' or (user is not None and user.is_authenticated()):
+            return super(PageCacheMixin, self).dispatch(request, *args, **kwargs)
+
+        versions = [caching.generation(scope) for scope in self.get_page_cache_scopes()]
+        key = caching.page_key(self.__class__.__name__, request.get_full_path(), versions)
+        cached = cache.get(key)
+        if cached is not None:
+            content, content_type = cached
+            return HttpResponse(content, content_type=content_type)
+        response = super(PageCacheMixin, self).dispatch(request, *args, **kwargs)
+        if response.status_code == 200 and not response.streaming:
+            if hasattr(response, 'render'):
+                response.render()
+            cache.set(key, (response.content, response['Content-Type']), timeout)
+        return response
+
+
+class CSEPageCacheMixin(PageCacheMixin):
+    """Cache a page showing a single CustomSearchEngine until anything in it changes."""
+
+    def get_page_cache_scopes(self):
+        return [self.kwargs['gid']]
+
+
+class CSEContext(object):
+    """
+    The CustomSearchEngine a request is for along with its background
+    Label ids, Labels and counts, each loaded at most once however many
+    times the view and its template use them.
+    """
+
+    def __init__(self, gid):
+        self.cse = get_object_or_404(CustomSearchEngine, gid=gid)
+        self._annotation_counts = {}
+
+    def _load_background_label_ids(self):
+        """
+        Load the background Label ids, once, onto the CustomSearchEngine
+        for its annotations() to use instead of a subquery.
+        """
+        if getattr(self.cse, '_background_label_ids', None) is None:
+            self.cse._background_label_ids = list(CustomSearchEngine.background_labels.through.objects.
+                                                  filter(customsearchengine=self.cse).
+                                                  values_list('label', flat=True))
+        return self.cse._background_label_ids
+
+    @property
+    def background_label_ids(self):
+        return self._load_background_label_ids()
+
+    def annotations(self):
+        self._load_background_label_ids()
+        return self.cse.annotations()
+
+    def alpha_list(self, selection, label_id=None):
+        self._load_background_label_ids()
+        return Annotation.alpha_list(selection=selection, cse=self.cse, label_id=label_id)
+
+    def annotation_count(self, label_id=None):
+        if label_id not in self._annotation_counts:
+            if label_id is not None:
+                self._load_background_label_ids()
+            self._annotation_counts[label_id] = self.cse.annotation_count(label_id=label_id)
+        return self._annotation_counts[label_id]
+
+    @cached_property
+    def facet_labels(self):
+        return list(self.cse.facet_item_labels())
+
+    @cached_property
+    def labels_counts(self):
+        return self.cse.all_labels().annotation_counts(self.cse)
+
+
+class CSEContextMixin(object):
+    """Share a CSEContext for the 'gid' of the request between the view and its template."""
+
+    @cached_property
+    def cse_context(self):
+        return CSEContext(self.kwargs['gid'])
+
+    @property
+    def cse(self):
+        return self.cse_context.cse
+
+    def get_context_data(self, **kwargs):
+        context = super(CSEContextMixin, self).get_context_data(**kwargs)
+        context['cse'] = self.cse
+        context['cse_context'] = self.cse_context
+        return context
+
+
+class AlphaIndexMixin(object):
+    """Browse Annotations by the first letter in the 'q' parameter."""
+
+    @cached_property
+    def query(self):
+        return self.request.GET.get('q', 'A')
+
+
+class CustomSearchEngineList(PageCacheMixin, ListView):
     """
     Generate list of all CustomSearchEngines.
     """
+    page_cache_scopes = (caching.CSES,)
     context_object_name = 'gcse_list'
     model = CustomSearchEngine
     paginate_by = settings.GCSE_CONFIG.get('NUM_CSES_PER_PAGE')
     template_name = 'gcse/cse_list.html'
 
 
-class CustomSearchEngineDetail(DetailView):
+class CustomSearchEngineDetail(CSEPageCacheMixin, CSEContextMixin, DetailView):
     model = CustomSearchEngine
     slug_url_kwarg = 'gid'
     slug_field = 'gid'
     template_name = 'gcse/cse_detail.html'
 
+    def get_object(self, queryset=None):
+        return self.cse
+
 
 class CustomSearchEngineResults(CustomSearchEngineDetail):
     template_name = 'gcse/cse_results.html'
 
 
+def _cse_etag(request, *args, **kwargs):
+    if not caching.is_shared():
+        return None
+    gid = kwargs['gid']
+    return '%s-%s' % (gid, caching.generation(gid))
+
+
+def _cse_last_modified(request, *args, **kwargs):
+    if not caching.is_shared():
+        return None
+    seconds = caching.last_modified(caching.generation(kwargs['gid']))
+    if seconds is None:
+        return None
+    return datetime.datetime.utcfromtimestamp(seconds)
+
+
+def _annotations_etag(request, *args, **kwargs):
+    if not caching.is_shared():
+        return None
+    gid = kwargs['gid']
+    return '%s-%s-%s-%s-%s' % (gid, kwargs['page'], request.GET.get('after'),
+                               CSEAnnotations.paginate_by, caching.generation(gid))
+
+
 class CustomSearchEngineDetailXML(View):
     """
-    Generate CustomSearchEngine XML with updated Annotation Include elements.
+    Serve the CustomSearchEngine XML. The Annotation Include elements
+    are kept up to date as Annotations change so this is just a read.
+
+    Conditional requests are answered from the CustomSearchEngine's
+    cached generation without querying the database, when the cache is
+    shared between processes; see gcse.caching.
     """
+    @method_decorator(condition(etag_func=_cse_etag,
+                                last_modified_func=_cse_last_modified))
     def get(self, request, *args, **kwargs):
-        cse = get_object_or_404(CustomSearchEngine,
-                                gid=kwargs['gid'])
-        if cse.update_output_xml_includes():
-            cse.update()
-        return HttpResponse(cse.output_xml)
+        output_xml = get_object_or_404(CustomSearchEngine.objects.values_list('output_xml', flat=True),
+                                       gid=kwargs['gid'])
+        return HttpResponse(output_xml)
 
 
 class CSEAnnotations(ListView):
     """
     Generate paginated Annotation XML for a specified CustomSearchEngine.
+
+    The XML is streamed as the Annotations are read from the database
+    rather than rendering the 'gcse/annotation.xml' template in memory.
+
+    When GCSE_CONFIG['ANNOTATION_FEED_CACHE_TIMEOUT'] is set each file
+    is rendered once and served from the Django cache until anything
+    in the CustomSearchEngine changes.
+
+    Files requested with an 'after' Annotation id, as generated with
+    GCSE_CONFIG['ANNOTATION_FEED_KEYSET_PAGINATION'], are paged by
+    Annotation id rather than by OFFSET.
+
+    Like the CustomSearchEngine XML, conditional requests are answered
+    without querying the database.
     """
     context_object_name = 'annotations'
     model = CustomSearchEngine
@@ -66,41 +239,91 @@ class CSEAnnotations(ListView):
     slug_url_kwarg = 'gid'
     template_name = 'gcse/annotation.xml'
 
+    @method_decorator(condition(etag_func=_annotations_etag,
+                                last_modified_func=_cse_last_modified))
+    def get(self, request, *args, **kwargs):
+        timeout = caching.timeout('ANNOTATION_FEED_CACHE_TIMEOUT')
+        if not timeout:
+            return super(CSEAnnotations, self).get(request, *args, **kwargs)
+
+        gid = kwargs['gid']
+        version = caching.generation(gid)
+        key = caching.feed_key(gid, kwargs['page'], request.GET.get('after'),
+                               self.paginate_by, version)
+        content = cache.get(key)
+        if content is None:
+            response = super(CSEAnnotations, self).get(request, *args, **kwargs)
+            content = b''.join(response.streaming_content)
+            cache.set(key, content, timeout)
+        return HttpResponse(content)
+
     def get_queryset(self):
-        cse = get_object_or_404(CustomSearchEngine,
-                                gid=self.kwargs['gid'])
-        return cse.annotations()
+        self.cse = get_object_or_404(CustomSearchEngine,
+                                     gid=self.kwargs['gid'])
+        # ordered so every page is stable; distinct to match annotation_count()
+        return self.cse.annotations().order_by('id').distinct()
+
+    def paginate_queryset(self, queryset, page_size):
+        after = self.request.GET.get('after')
+        if after is None:
+            return super(CSEAnnotations, self).paginate_queryset(queryset, page_size)
+        try:
+            number = int(self.kwargs['page'])
+            if number < 1:
+                raise ValueError(number)
+            page = KeysetPage(queryset, number, int(after), page_size, self.cse.annotation_count())
+        except ValueError:
+            raise Http404(_("Invalid page (%(page_number)s)") % {'page_number': self.kwargs['page']})
+        return (page.paginator, page, page.object_list, True)
+
+    def render_to_response(self, context, **response_kwargs):
+        return StreamingHttpResponse(annotations_xml(context['page_obj']),
+                                     **response_kwargs)
+
+
+class AnnotationPageMixin(object):
+    """
+    Load the Labels, CustomSearchEngines and cached Label links of each
+    page of Annotations together instead of once per Annotation as the
+    page is rendered.
+    """
+    def paginate_queryset(self, queryset, page_size):
+        paginator, page, object_list, is_paginated = \
+            super(AnnotationPageMixin, self).paginate_queryset(queryset, page_size)
+        page.object_list = Annotation.prefetch_label_links(Annotation.prefetch_cses(object_list))
+        return (paginator, page, page.object_list, is_paginated)
 
 
-class AnnotationList(ListView):
+class AnnotationList(PageCacheMixin, AlphaIndexMixin, AnnotationPageMixin, ListView):
     """
     Render all the Annotations in alphabetical order in a paged manner.
     """
+    page_cache_scopes = (caching.ANNOTATIONS, caching.LABELS, caching.CSES)
     context_object_name = 'annotation_list'
     model = Annotation
     paginate_by = settings.GCSE_CONFIG.get('NUM_ANNOTATIONS_PER_PAGE')
     template_name = 'gcse/annotation_list.html'
 
     def get_queryset(self):
-        query = self.request.GET.get('q', 'A')
         qset = (
-            Q(comment__istartswith=query)
+            Annotation.starting_with(self.query)
             )
-        return Annotation.objects.active().filter(qset).distinct().order_by('comment') #.prefetch_related('labels')
+        return Annotation.objects.active().filter(qset).distinct().order_by('sort_key') #.prefetch_related('labels')
 
     def get_context_data(self, *args, **kwargs):
         context = super(AnnotationList, self).get_context_data(**kwargs)
-        query = self.request.GET.get('q', 'A')
-        context['index'] = Annotation.alpha_list(selection=query)
-        context['query'] = query
-        context['count'] = Annotation.objects.count()
+        context['index'] = Annotation.alpha_list(selection=self.query)
+        context['query'] = self.query
+        context['count'] = counters.count(counters.ALL)
         return context
 
 
-class AnnotationSearchList(ListView):
+class AnnotationSearchList(PageCacheMixin, AnnotationPageMixin, ListView):
     """
-    Render all the matching Annotations the query string.
+    Render all the matching Annotations the query string, best matches
+    first when a search backend is configured (see gcse.search).
     """
+    page_cache_scopes = (caching.ANNOTATIONS, caching.LABELS, caching.CSES)
     model = Annotation
     paginate_by = settings.GCSE_CONFIG.get('NUM_ANNOTATIONS_PER_PAGE')
     template_name = 'gcse/search.html'
@@ -108,6 +331,9 @@ class AnnotationSearchList(ListView):
     def get_queryset(self):
         query = self.request.GET.get('q', '')
         if query:
+            backend = search.get_backend()
+            if backend is not None:
+                return backend.search(Annotation.objects.active(), query)
             qset = (
                 Q(original_url__icontains=query) |
                 Q(comment__icontains=query)
@@ -123,69 +349,67 @@ class AnnotationSearchList(ListView):
         return context
 
 
-class CSEAnnotationList(AnnotationList):
+class CSEAnnotationList(CSEPageCacheMixin, CSEContextMixin, AnnotationList):
     """
     Render all the Annotations in alphabetical order in a paged manner for a single CSE.
     """
     template_name = 'gcse/cse_annotation_list.html'
 
     def get_queryset(self):
-        cse = get_object_or_404(CustomSearchEngine,
-                                gid=self.kwargs['gid'])
-        self.cse = cse
-        query = self.request.GET.get('q', 'A')
         qset = (
-            Q(comment__istartswith=query)
+            Annotation.starting_with(self.query)
             )
-        return cse.annotations().filter(qset).order_by('comment').prefetch_related('labels')
+        return self.cse_context.annotations().filter(qset).order_by('sort_key')
 
     def get_context_data(self, *args, **kwargs):
         context = super(CSEAnnotationList, self).get_context_data(**kwargs)
-        query = self.request.GET.get('q', 'A')
-        context['index'] = Annotation.alpha_list(selection=query)
-        context['query'] = query
-        context['count'] = self.cse.annotation_count()
-        context['cse'] = self.cse
+        context['index'] = self.cse_context.alpha_list(self.query)
+        context['count'] = self.cse_context.annotation_count()
         return context
 
 
-class AnnotationDetail(DetailView):
+class AnnotationDetail(PageCacheMixin, DetailView):
+    page_cache_scopes = (caching.ANNOTATIONS, caching.LABELS, caching.CSES)
     model = Annotation
     slug_url_kwarg = 'id'
     slug_field = 'id'
     template_name = 'gcse/annotation_detail.html'
 
 
-class LabelList(ListView):
+class LabelList(PageCacheMixin, ListView):
     """
     Render all the Labels in alphabetical order in a paged manner.
     """
+    page_cache_scopes = (caching.LABELS, caching.CSES)
     model = Label
     paginate_by = settings.GCSE_CONFIG.get('NUM_LABELS_PER_PAGE')
     template_name = 'gcse/label_list.html'
 
+    def paginate_queryset(self, queryset, page_size):
+        paginator, page, object_list, is_paginated = \
+            super(LabelList, self).paginate_queryset(queryset, page_size)
+        page.object_list = Label.prefetch_cses(object_list)
+        return (paginator, page, page.object_list, is_paginated)
+
 
-class CSELabelList(LabelList):
+class CSELabelList(CSEPageCacheMixin, CSEContextMixin, ListView):
     """
     Render all the Labels for a Custom Search Engine in alphabetical order in a paged manner.
     """
+    paginate_by = settings.GCSE_CONFIG.get('NUM_LABELS_PER_PAGE')
     template_name = 'gcse/cse_label_list.html'
 
     def get_queryset(self):
-        cse = get_object_or_404(CustomSearchEngine,
-                                gid=self.kwargs['gid'])
-        self.cse = cse
-        return cse.labels_counts()
+        return self.cse_context.labels_counts
 
     def get_context_data(self, *args, **kwargs):
         context = super(CSELabelList, self).get_context_data(**kwargs)
-        context['cse'] = self.cse
-        context['count_facets'] = self.cse.facet_item_labels().count()
-        context['count_labels'] = self.cse.all_labels().count() - context['count_facets']
+        context['count_facets'] = len(self.cse_context.facet_labels)
+        context['count_labels'] = len(self.cse_context.labels_counts) - context['count_facets']
         return context
 
 
-class LabelDetail(ListView):
+class LabelDetail(PageCacheMixin, AlphaIndexMixin, AnnotationPageMixin, ListView):
     """
     Show the Annotations for a Label across all CustomSearchEngines
     """
@@ -196,57 +420,53 @@ class LabelDetail(ListView):
     slug_field = 'id'
     template_name = 'gcse/label_detail.html'
 
+    def get_page_cache_scopes(self):
+        return [caching.label_scope(self.kwargs['id']), caching.LABELS, caching.CSES]
+
+    @cached_property
+    def label(self):
+        return get_object_or_404(Label, pk=self.kwargs['id'])
+
     def get_queryset(self):
-        label = get_object_or_404(Label,
-                                  pk=self.kwargs['id'])
-        self.label = label
-        query = self.request.GET.get('q', 'A')
         qset = (
-            Q(comment__istartswith=query) &
-            Q(labels__in=[label])
+            Annotation.starting_with(self.query) &
+            Q(labels__in=[self.label])
             )
-        return Annotation.objects.active().filter(qset).order_by('comment')#.prefetch_related()
+        return Annotation.objects.active().filter(qset).order_by('sort_key')#.prefetch_related()
 
     def get_context_data(self, *args, **kwargs):
         context = super(LabelDetail, self).get_context_data(**kwargs)
-        query = self.request.GET.get('q', 'A')
         context['label'] = self.label
-        context['index'] = Annotation.alpha_list(selection=query, label_id=self.label.id)
-        context['query'] = query
-        context['total_count'] = Annotation.objects.active().filter(labels__in=(self.label,)).count()
+        context['index'] = self.get_index()
+        context['query'] = self.query
+        context['total_count'] = self.get_total_count()
         return context
 
+    def get_index(self):
+        return Annotation.alpha_list(selection=self.query, label_id=self.label.id)
+
+    def get_total_count(self):
+        return self.label.annotation_count()
+
 
-class CSELabelDetail(LabelDetail):
+class CSELabelDetail(CSEPageCacheMixin, CSEContextMixin, LabelDetail):
     """
     Show the Annotations for a Label in a specific CustomSearchEngine.
     """
     template_name = 'gcse/cse_label_detail.html'
 
     def get_queryset(self):
-        label = get_object_or_404(Label,
-                                  pk=self.kwargs['id'])
-        self.label = label
-
-        query = self.request.GET.get('q', 'A')
         qset = (
-            Q(comment__istartswith=query) &
-            Q(labels__in=[label])
+            Annotation.starting_with(self.query) &
+            Q(labels__in=[self.label])
             )
-        cse = get_object_or_404(CustomSearchEngine,
-                                gid=self.kwargs['gid'])
-        self.cse = cse
-        return cse.annotations().filter(qset).order_by('comment').prefetch_related('labels')
+        return self.cse_context.annotations().filter(qset).order_by('sort_key')
 
-    def get_context_data(self, *args, **kwargs):
-        context = super(CSELabelDetail, self).get_context_data(**kwargs)
-        query = self.request.GET.get('q', 'A')
-        context['label'] = self.label
-        context['index'] = Annotation.alpha_list(selection=query, label_id=self.label.id) # also filter by CSE
-        context['query'] = query
-        context['total_count'] = self.cse.annotation_count(label_id=self.label.id)
-        context['cse'] = self.cse
-        return context
+    def get_index(self):
+        return self.cse_context.alpha_list(self.query, label_id=self.label.id)
+
+    def get_total_count(self):
+        return self.cse_context.annotation_count(label_id=self.label.id)
 
 
 def _all_labels_to_bitmasks(all_labels):
@@ -22,6 +22,8 @@ try:
             "stw",
         ],
         SITE_ID=1,
+        # the tests run in a single process
+        GCSE_CONFIG={'CACHE_SHARED': True},
         NOSE_ARGS=['-s'],
         GOOGLE_MAPS_API_KEY='',
         SHRINK_THE_WEB={'stwaccesskeyid': '',
@@ -0,0 +1,28 @@
+"""
+test_benchmarks
+---------------
+
+Checks every gcse route against the query budgets of the benchmarks
+on a small dataset.
+"""
+from django.test import TestCase
+
+from benchmarks import routes
+from benchmarks.fixtures import seed
+from gcse import search
+
+
+class RouteBudgetsTest(TestCase):
+
+    def setUp(self):
+        self.cse = seed(200, 30, 3)[0]
+
+    def test_seed_indexes_annotations(self):
+        self.assertFalse(search.get_backend().is_empty())
+
+    def test_every_route_has_a_budget(self):
+        self.assertEqual(set(routes.route_names()), set(routes.load_budgets()))
+
+    def test_routes_are_within_query_budgets(self):
+        results = routes.run(self.cse, repeat=1)
+        self.assertEqual([], routes.over_budget(results, routes.load_budgets()))
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+test_counters
+-------------
+
+Tests for `django-gcse` counters module.
+"""
+from __future__ import unicode_literals
+
+from django.test import TestCase
+
+from gcse import counters
+from gcse.models import Annotation, AnnotationCount, CustomSearchEngine, Label, BulkAnnotationSAXHandler
+
+
+class CountersTest(TestCase):
+
+    def setUp(self):
+        self.background = Label.objects.create(name='_cse_g1', background=True)
+        self.other_background = Label.objects.create(name='blogs', background=True)
+        self.facet = Label.objects.create(name='facet')
+        self.cse = CustomSearchEngine.objects.create(gid='g1')
+        self.cse.background_labels.add(self.background, self.other_background)
+        self.annotation = self._add('Site', self.background, self.facet)
+        self._add('Submitted', self.background, status=Annotation.STATUS.submitted)
+        # read every count so the handlers have counts to adjust
+        self._counts()
+
+    def _add(self, comment, *labels, **kwargs):
+        annotation = Annotation.objects.create(comment=comment,
+                                               status=kwargs.get('status', Annotation.STATUS.active))
+        annotation.labels.add(*labels)
+        return annotation
+
+    def _counts(self):
+        return (counters.count(counters.ALL),
+                counters.count(counters.LABEL, self.background.id),
+                counters.count(counters.LABEL, self.facet.id),
+                self.cse.annotation_count())
+
+    def _queried(self):
+        active = Annotation.objects.active()
+        return (active.count(),
+                active.filter(labels=self.background).count(),
+                active.filter(labels=self.facet).count(),
+                self.cse.annotations().distinct().count())
+
+    def test_counts_are_computed_when_first_read(self):
+        AnnotationCount.objects.all().delete()
+        self.assertEqual((1, 1, 1, 1), self._counts())
+        self.assertEqual(4, AnnotationCount.objects.count())
+
+    def test_counts_are_read_in_one_query(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(1, self.cse.annotation_count())
+
+    def test_status_changes_are_counted(self):
+        self.annotation.status = Annotation.STATUS.deleted
+        self.annotation.save()
+        self.assertEqual((0, 0, 0, 0), self._counts())
+        self.annotation.status = Annotation.STATUS.active
+        self.annotation.save()
+        self.assertEqual((1, 1, 1, 1), self._counts())
+
+    def test_saving_without_status_change_keeps_counts(self):
+        self.annotation.comment = 'Renamed'
+        self.annotation.save()
+        self.assertEqual((1, 1, 1, 1), self._counts())
+
+    def test_new_annotations_are_counted(self):
+        self._add('New', self.facet)
+        self.assertEqual((2, 1, 2, 1), self._counts())
+        self.assertEqual(self._queried(), self._counts())
+
+    def test_label_changes_are_counted(self):
+        self.annotation.labels.remove(self.facet)
+        self.assertEqual((1, 1, 0, 1), self._counts())
+        # still in the CustomSearchEngine through its other background Label
+        self.annotation.labels.add(self.other_background)
+        self.annotation.labels.remove(self.background)
+        self.assertEqual((1, 0, 0, 1), self._counts())
+        self.annotation.labels.clear()
+        self.assertEqual((1, 0, 0, 0), self._counts())
+        self.assertEqual(self._queried(), self._counts())
+
+    def test_annotations_are_counted_once_per_cse(self):
+        self.annotation.labels.add(self.other_background)
+        self.assertEqual(1, self.cse.annotation_count())
+        self.assertEqual(1, self.cse.annotations().distinct().count())
+
+    def test_inactive_label_changes_are_not_counted(self):
+        submitted = self._add('Submitted', status=Annotation.STATUS.submitted)
+        submitted.labels.add(self.facet)
+        self.assertEqual((1, 1, 1, 1), self._counts())
+
+    def test_deleted_annotations_are_uncounted(self):
+        self.annotation.delete()
+        self.assertEqual((0, 0, 0, 0), self._counts())
+
+    def test_label_annotations_changes_are_counted(self):
+        self.facet.annotation_set.clear()
+        self.assertEqual((1, 1, 0, 1), self._counts())
+        self.other_background.annotation_set.add(self._add('Other'))
+        self.assertEqual(self._queried(), self._counts())
+
+    def test_background_label_changes_are_counted(self):
+        self.cse.background_labels.remove(self.background)
+        self.assertEqual(0, self.cse.annotation_count())
+        self.background.background_cses.add(self.cse)
+        self.assertEqual(1, self.cse.annotation_count())
+
+    def test_deleted_labels_are_uncounted(self):
+        self.background.delete()
+        self.assertEqual(0, self.cse.annotation_count())
+
+    def test_bulk_imports_are_counted(self):
+        handler = BulkAnnotationSAXHandler()
+        handler.parseString(b"""<Annotations>
+  <Annotation about="www.example.com/*" score="1">
+    <Label name="_cse_g1"/>
+  </Annotation>
+</Annotations>""")
+        self.assertEqual((2, 2, 1, 2), self._counts())
+
+    def test_reactivated_annotations_are_counted(self):
+        xml = b"""<Annotations>
+  <Annotation about="www.example.com/*" timestamp="0x0004d956807a35fd">
+    <Label name="_cse_g1"/>%s
+  </Annotation>
+</Annotations>"""
+        BulkAnnotationSAXHandler().parseString(xml % b'<Label name="facet"/>')
+        Annotation.objects.filter(about="www.example.com/*").update(status=Annotation.STATUS.deleted)
+        counters.clear()
+        self.assertEqual((1, 1, 1, 1), self._counts())
+        # the import doesn't list the facet Label the Annotation still has
+        BulkAnnotationSAXHandler().parseString(xml % b'')
+        self.assertEqual((2, 2, 2, 2), self._counts())
+
+    def test_rebuild_repairs_counts(self):
+        AnnotationCount.objects.update(count=10)
+        self.assertEqual(4, counters.rebuild())
+        self.assertEqual((1, 1, 1, 1), self._counts())
+
+    def test_cses_without_annotations_count_zero(self):
+        cse = CustomSearchEngine.objects.create(gid='g2')
+        self.assertEqual(0, cse.annotation_count())
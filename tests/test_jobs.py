@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+test_jobs
+---------
+
+Tests for `django-gcse` jobs module.
+"""
+from __future__ import unicode_literals
+
+import datetime
+import io
+import os
+import shutil
+import tempfile
+try:
+    from StringIO import StringIO as SIO
+except ImportError:
+    from io import StringIO as SIO
+
+from mock import Mock, patch
+
+from django.conf import settings
+from django.core import management
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.test import TestCase
+from django.utils import timezone
+from django.utils.six.moves.urllib.error import HTTPError, URLError
+
+from gcse import jobs
+from gcse.models import Annotation, CustomSearchEngine, Job
+
+
+ANNOTATIONS_XML = """<?xml version="1.0" encoding="UTF-8" ?>
+<Annotations>
+  <Annotation about="example.com/*">
+    <Label name="_cse_g1" />
+    <Comment>Example</Comment>
+  </Annotation>
+  <Annotation about="example.org/*">
+    <Label name="_cse_g1" />
+    <Comment>Other example</Comment>
+  </Annotation>
+</Annotations>"""
+
+
+class JobsTest(TestCase):
+
+    def test_import_annotations_from_data(self):
+        job = jobs.enqueue(Job.KIND.import_annotations, data=ANNOTATIONS_XML)
+        self.assertEqual(job, jobs.run_next())
+        job = Job.objects.get(pk=job.pk)
+        self.assertEqual(Job.STATUS.done, job.status)
+        self.assertEqual('Imported 2 Annotations', job.message)
+        self.assertEqual((2, 2, 1), (job.progress, job.total, job.attempts))
+        self.assertTrue(job.finished)
+        self.assertEqual(2, Annotation.objects.filter(labels__name='_cse_g1').count())
+
+    def test_import_annotations_from_upload(self):
+        storage = FileSystemStorage(location=tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, storage.location)
+        xml = ('<?xml version="1.0" encoding="ISO-8859-1" ?>\n' +
+               ANNOTATIONS_XML.split('\n', 1)[1].replace('Other example', 'Caf\xe9')).encode('iso-8859-1')
+        with patch.object(Job._meta.get_field('upload'), 'storage', storage):
+            job = Job(kind=Job.KIND.import_annotations)
+            job.upload.save('annotations.xml', ContentFile(xml))
+            with storage.open(job.upload.name, 'rb') as upload:
+                self.assertEqual(xml, upload.read())
+            jobs.run_next()
+        self.assertFalse(storage.exists(job.upload.name))
+        job = Job.objects.get(pk=job.pk)
+        self.assertEqual((Job.STATUS.done, ''), (job.status, job.upload.name))
+        self.assertTrue(Annotation.objects.filter(comment='Caf\xe9').exists())
+
+    def test_failed_upload_is_deleted(self):
+        storage = FileSystemStorage(location=tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, storage.location)
+        with patch.object(Job._meta.get_field('upload'), 'storage', storage):
+            job = Job(kind=Job.KIND.import_annotations)
+            job.upload.save('annotations.xml', ContentFile(b'<Annotations>'))
+            name = job.upload.name
+            jobs.run_next()
+        self.assertEqual(Job.STATUS.failed, Job.objects.get(pk=job.pk).status)
+        self.assertFalse(storage.exists(name))
+
+    def test_import_reports_progress(self):
+        job = jobs.enqueue(Job.KIND.import_annotations, data=ANNOTATIONS_XML, bulk=False)
+        progress = []
+        with patch.object(Job, 'report_progress', autospec=True,
+                          side_effect=lambda job, count, total=None: progress.append(count)), \
+                patch('gcse.models.AnnotationSAXHandler.progress_interval', 1):
+            jobs.run_next()
+        self.assertEqual([1, 2, 2], progress)
+
+    @patch('gcse.jobs._download')
+    def test_import_annotations_from_url(self, download):
+        download.return_value = io.BytesIO(ANNOTATIONS_XML.encode('utf-8'))
+        job = jobs.enqueue(Job.KIND.import_annotations, source='http://example.com/a.xml')
+        jobs.run_next()
+        download.assert_called_once_with('http://example.com/a.xml')
+        self.assertEqual(Job.STATUS.done, Job.objects.get(pk=job.pk).status)
+
+    @patch('gcse.jobs._download', side_effect=URLError('timed out'))
+    def test_fetch_failures_are_retried(self, download):
+        job = jobs.enqueue(Job.KIND.import_annotations, source='http://example.com/a.xml')
+        with patch.dict(settings.GCSE_CONFIG, {'JOB_MAX_ATTEMPTS': 2, 'JOB_RETRY_DELAY': 60}):
+            jobs.run_next()
+            job = Job.objects.get(pk=job.pk)
+            self.assertEqual((Job.STATUS.queued, 1), (job.status, job.attempts))
+            self.assertTrue(job.message.startswith('Attempt 1 failed, retrying in 60 seconds'))
+            self.assertTrue(job.run_after > timezone.now() + datetime.timedelta(seconds=50))
+            # not due yet
+            self.assertIsNone(jobs.run_next())
+
+            Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+            jobs.run_next()
+        job = Job.objects.get(pk=job.pk)
+        self.assertEqual((Job.STATUS.failed, 2), (job.status, job.attempts))
+        self.assertTrue('timed out' in job.message)
+        self.assertEqual(2, download.call_count)
+
+    @patch('gcse.jobs._download',
+           side_effect=HTTPError('http://example.com/a.xml', 404, 'Not Found', {}, None))
+    def test_missing_file_is_not_retried(self, download):
+        job = jobs.enqueue(Job.KIND.import_annotations, source='http://example.com/a.xml')
+        jobs.run_next()
+        job = Job.objects.get(pk=job.pk)
+        self.assertEqual((Job.STATUS.failed, 1), (job.status, job.attempts))
+        self.assertTrue('HTTP Error 404' in job.message)
+
+    def test_missing_local_file_is_not_retried(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, directory)
+        job = jobs.enqueue(Job.KIND.import_annotations, source=os.path.join(directory, 'missing.xml'))
+        jobs.run_next()
+        job = Job.objects.get(pk=job.pk)
+        self.assertEqual((Job.STATUS.failed, 1), (job.status, job.attempts))
+
+    def test_invalid_data_fails(self):
+        job = jobs.enqueue(Job.KIND.import_annotations, data='<Annotations>')
+        jobs.run_next()
+        job = Job.objects.get(pk=job.pk)
+        self.assertEqual(Job.STATUS.failed, job.status)
+        self.assertTrue('XMLSyntaxError' in job.message)
+
+    def test_rebuild_cse_xml(self):
+        cse = CustomSearchEngine.objects.create(gid='g1')
+        CustomSearchEngine.objects.create(gid='g2')
+        CustomSearchEngine.objects.filter(pk=cse.pk).update(output_xml='')
+        job = jobs.enqueue(Job.KIND.rebuild_cse_xml, gid='g1')
+        jobs.run_next()
+        job = Job.objects.get(pk=job.pk)
+        self.assertEqual('Rebuilt 1 of 1 Custom Search Engines', job.message)
+        self.assertEqual((1, 1), (job.progress, job.total))
+        self.assertTrue(CustomSearchEngine.objects.get(pk=cse.pk).output_xml)
+
+    def test_claim_is_exclusive(self):
+        job = jobs.enqueue(Job.KIND.rebuild_cse_xml)
+        jobs.enqueue(Job.KIND.rebuild_cse_xml, run_after=timezone.now() + datetime.timedelta(hours=1))
+        self.assertEqual(job, jobs.claim())
+        self.assertEqual(Job.STATUS.running, Job.objects.get(pk=job.pk).status)
+        self.assertIsNone(jobs.claim())
+
+    def test_stale_running_job_is_reclaimed(self):
+        job = jobs.enqueue(Job.KIND.rebuild_cse_xml, status=Job.STATUS.running, attempts=1)
+        with patch.dict(settings.GCSE_CONFIG, {'JOB_STALE_TIMEOUT': 60}):
+            self.assertIsNone(jobs.claim())
+            Job.objects.filter(pk=job.pk).update(modified=timezone.now() - datetime.timedelta(seconds=120))
+            self.assertEqual(job, jobs.claim())
+        job = Job.objects.get(pk=job.pk)
+        self.assertEqual((Job.STATUS.running, 2), (job.status, job.attempts))
+
+    def test_reclaimed_job_keeps_its_new_claim(self):
+        job = jobs.enqueue(Job.KIND.rebuild_cse_xml)
+        job = jobs.claim()
+        # taken as abandoned and claimed by another worker
+        started = timezone.now() + datetime.timedelta(seconds=1)
+        Job.objects.filter(pk=job.pk).update(started=started, attempts=2)
+        jobs.run(job)
+        job = Job.objects.get(pk=job.pk)
+        self.assertEqual((Job.STATUS.running, started, 0), (job.status, job.started, job.progress))
+
+    @patch('gcse.jobs.CustomSearchEngine.from_url')
+    def test_import_cse_reports_progress(self, from_url):
+        from_url.return_value = Mock(gid='g1')
+        job = jobs.enqueue(Job.KIND.import_cse, source='http://example.com/cse.xml')
+        jobs.run_next()
+        job = Job.objects.get(pk=job.pk)
+        from_url.assert_called_once_with('http://example.com/cse.xml', import_linked_annotations=True,
+                                         bulk=True, progress=job.report_progress)
+        self.assertEqual((Job.STATUS.done, 'Imported Custom Search Engine g1'), (job.status, job.message))
+
+    def test_stale_job_out_of_attempts_fails(self):
+        job = jobs.enqueue(Job.KIND.rebuild_cse_xml, status=Job.STATUS.running, attempts=2)
+        Job.objects.filter(pk=job.pk).update(modified=timezone.now() - datetime.timedelta(seconds=120))
+        with patch.dict(settings.GCSE_CONFIG, {'JOB_STALE_TIMEOUT': 60, 'JOB_MAX_ATTEMPTS': 2}):
+            self.assertIsNone(jobs.claim())
+        job = Job.objects.get(pk=job.pk)
+        self.assertEqual((Job.STATUS.failed, 'Abandoned by its worker'), (job.status, job.message))
+        self.assertTrue(job.finished)
+
+    def test_stale_timeout_can_be_disabled(self):
+        job = jobs.enqueue(Job.KIND.rebuild_cse_xml, status=Job.STATUS.running)
+        Job.objects.filter(pk=job.pk).update(modified=timezone.now() - datetime.timedelta(days=7))
+        with patch.dict(settings.GCSE_CONFIG, {'JOB_STALE_TIMEOUT': None}):
+            self.assertIsNone(jobs.claim())
+        self.assertEqual(Job.STATUS.running, Job.objects.get(pk=job.pk).status)
+
+    @patch('gcse.models.urlopen')
+    def test_fetch_timeout(self, urlopen):
+        urlopen.return_value = io.BytesIO(ANNOTATIONS_XML.encode('utf-8'))
+        job = jobs.enqueue(Job.KIND.import_annotations, source='http://example.com/a.xml')
+        with patch.dict(settings.GCSE_CONFIG, {'FETCH_TIMEOUT': 5}):
+            jobs.run_next()
+        urlopen.assert_called_once_with('http://example.com/a.xml', timeout=5)
+        self.assertEqual(Job.STATUS.done, Job.objects.get(pk=job.pk).status)
+
+
+class RunJobsCommandTest(TestCase):
+
+    def test_runs_queued_jobs(self):
+        job = jobs.enqueue(Job.KIND.rebuild_cse_xml)
+        output = SIO()
+        management.call_command('run_gcse_jobs', once=True, stdout=output)
+        self.assertEqual('Job %d Rebuild Custom Search Engine XML  Done: Rebuilt 0 of 0 Custom Search Engines\n'
+                         'Ran 1 Jobs\n' % job.pk, output.getvalue())
+
+    @patch('gcse.management.commands.run_gcse_jobs.time.sleep')
+    def test_waits_for_jobs(self, sleep):
+        sleep.side_effect = lambda seconds: jobs.enqueue(Job.KIND.rebuild_cse_xml)
+        output = SIO()
+        management.call_command('run_gcse_jobs', max_jobs=1, sleep=2, stdout=output)
+        sleep.assert_called_once_with(2)
+        self.assertTrue(output.getvalue().endswith('Ran 1 Jobs\n'))
+
+
+class JobAdminTest(TestCase):
+
+    def test_retry_failed_jobs(self):
+        from django.contrib.admin.sites import AdminSite
+        from gcse.admin import JobAdmin
+
+        failed = jobs.enqueue(Job.KIND.rebuild_cse_xml, status=Job.STATUS.failed, attempts=3, message='Error')
+        done = jobs.enqueue(Job.KIND.rebuild_cse_xml, status=Job.STATUS.done)
+        admin = JobAdmin(Job, AdminSite())
+        admin.message_user = Mock()
+        admin.retry(Mock(), Job.objects.all())
+        failed = Job.objects.get(pk=failed.pk)
+        self.assertEqual((Job.STATUS.queued, 0, ''), (failed.status, failed.attempts, failed.message))
+        self.assertEqual(Job.STATUS.done, Job.objects.get(pk=done.pk).status)
+
+    def test_retry_stuck_jobs(self):
+        from django.contrib.admin.sites import AdminSite
+        from gcse.admin import JobAdmin
+
+        stuck = jobs.enqueue(Job.KIND.rebuild_cse_xml, status=Job.STATUS.running, attempts=3)
+        running = jobs.enqueue(Job.KIND.rebuild_cse_xml, status=Job.STATUS.running, attempts=1)
+        Job.objects.filter(pk=stuck.pk).update(modified=timezone.now() - datetime.timedelta(seconds=120))
+        admin = JobAdmin(Job, AdminSite())
+        admin.message_user = Mock()
+        with patch.dict(settings.GCSE_CONFIG, {'JOB_STALE_TIMEOUT': 60}):
+            admin.retry(Mock(), Job.objects.all())
+        stuck = Job.objects.get(pk=stuck.pk)
+        self.assertEqual((Job.STATUS.queued, 0), (stuck.status, stuck.attempts))
+        self.assertEqual(Job.STATUS.running, Job.objects.get(pk=running.pk).status)
+
+    def test_rebuild_xml_action_queues_jobs(self):
+        from django.contrib.admin.sites import AdminSite
+        from gcse.admin import CustomSearchEngineAdmin
+
+        CustomSearchEngine.objects.create(gid='g1')
+        admin = CustomSearchEngineAdmin(CustomSearchEngine, AdminSite())
+        admin.message_user = Mock()
+        admin.rebuild_xml(Mock(), CustomSearchEngine.objects.all())
+        self.assertEqual([(Job.KIND.rebuild_cse_xml, 'g1')], list(Job.objects.values_list('kind', 'gid')))
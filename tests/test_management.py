@@ -9,8 +9,10 @@ try:
     from StringIO import StringIO as SIO
 except ImportError:
     from io import StringIO as SIO
-from django.test import TestCase
+from django.conf import settings
 from django.core import management
+from django.core.urlresolvers import reverse
+from django.test import TestCase
 
 from mock import Mock, patch
 from gcse.models import CustomSearchEngine, Label, Annotation
@@ -121,3 +123,139 @@ class TestImportCommand(TestCase):
         self.assertFalse(output.getvalue())
         self.assertTrue(CustomSearchEngine.from_url.wasCalled)
         self.assertTrue(CustomSearchEngine.save.wasCalled)
+
+    @patch('gcse.models.CustomSearchEngine.from_url')
+    def test_bulk_option_is_passed_to_import(self, from_url):
+        management.call_command('import_cse', 'http://example.com', bulk=True)
+        from_url.assert_called_once_with('http://example.com',
+                                         import_linked_annotations=True,
+                                         bulk=True,
+                                         threads=None)
+
+    @patch('gcse.models.CustomSearchEngine.from_url')
+    def test_threads_option_is_passed_to_import(self, from_url):
+        management.call_command('import_cse', 'http://example.com', threads=2)
+        from_url.assert_called_once_with('http://example.com',
+                                         import_linked_annotations=True,
+                                         bulk=False,
+                                         threads=2)
+
+    @patch('gcse.models.CustomSearchEngine.sync_from_url')
+    def test_incremental_option_reports_changes(self, sync_from_url):
+        sync_from_url.return_value = (Mock(), {'inserted': 1, 'updated': 2,
+                                               'deleted': 3, 'unchanged': 4})
+        output = SIO()
+        management.call_command('import_cse', 'http://example.com', incremental=True,
+                                stdout=output)
+        sync_from_url.assert_called_once_with('http://example.com', threads=None)
+        self.assertEqual('Annotations inserted: 1 updated: 2 deleted: 3 unchanged: 4\n',
+                         output.getvalue())
+
+
+class TestBackfillAnnotationsCommand(TestCase):
+
+    def test_derived_fields_are_set(self):
+        annotation = Annotation.objects.create(comment='Fün')
+        Annotation.objects.create(comment='unchanged')
+        Annotation.objects.filter(pk=annotation.pk).update(first_letter='', sort_key='')
+        output = SIO()
+        management.call_command('backfill_annotations', stdout=output)
+        self.assertEqual('Updated 1 Annotations\n', output.getvalue())
+        annotation = Annotation.objects.get(pk=annotation.pk)
+        self.assertEqual('F', annotation.first_letter)
+        self.assertEqual('fun', annotation.sort_key)
+
+
+class TestRebuildCountersCommand(TestCase):
+
+    def test_counts_are_rebuilt(self):
+        label = Label.objects.create(name='background', background=True)
+        annotation = Annotation.objects.create(comment='Site', status=Annotation.STATUS.active)
+        annotation.labels.add(label)
+        Annotation.objects.filter(pk=annotation.pk).update(status=Annotation.STATUS.deleted)
+        output = SIO()
+        management.call_command('rebuild_gcse_counters', stdout=output)
+        self.assertEqual('Rebuilt 1 counts\n', output.getvalue())
+        self.assertEqual(0, label.annotation_count())
+
+
+class TestRebuildCSEXMLCommand(TestCase):
+
+    def setUp(self):
+        self.label = Label.objects.create(name='background', background=True)
+        self.cse = CustomSearchEngine.objects.create(gid='g1')
+        self.cse.background_labels.add(self.label)
+        for i in range(3):
+            annotation = Annotation.objects.create(comment='Site %d' % i, status=Annotation.STATUS.active)
+            annotation.labels.add(self.label)
+        self.other = CustomSearchEngine.objects.create(gid='g2')
+
+    def _includes(self, gid):
+        return CustomSearchEngine.objects.get(gid=gid).output_xml.count('<Include ')
+
+    def _call(self, *args, **options):
+        output = SIO()
+        management.call_command('rebuild_cse_xml', *args, stdout=output, processes=1, **options)
+        return output.getvalue()
+
+    def test_output_xml_is_rebuilt(self):
+        with patch.dict(settings.GCSE_CONFIG, {'NUM_ANNOTATIONS_PER_FILE': 2}):
+            output = self._call()
+        self.assertEqual('[1/2] g1 changed\n[2/2] g2 unchanged\n'
+                         'Rebuilt 1 of 2 Custom Search Engines\n', output)
+        self.assertEqual(2, self._includes('g1'))
+
+    def test_gid_filter(self):
+        with patch.dict(settings.GCSE_CONFIG, {'NUM_ANNOTATIONS_PER_FILE': 2}):
+            output = self._call(gids=['g2'])
+        self.assertEqual('[1/1] g2 unchanged\nRebuilt 0 of 1 Custom Search Engines\n', output)
+        self.assertEqual(1, self._includes('g1'))
+
+    def test_dry_run_shows_diff(self):
+        with patch.dict(settings.GCSE_CONFIG, {'NUM_ANNOTATIONS_PER_FILE': 2}):
+            output = self._call(dry_run=True)
+        self.assertTrue('--- g1 (current)\n+++ g1 (rebuilt)\n' in output)
+        self.assertTrue('+<Include type="Annotations" href="//example.com/annotations/g1.2.xml"/>' in
+                        output.replace('/><Include', '/>\n+<Include'))
+        self.assertTrue(output.endswith('1 of 2 Custom Search Engines would change\n'))
+        self.assertEqual(1, self._includes('g1'))
+
+    def test_feeds_are_rendered(self):
+        with patch.dict(settings.GCSE_CONFIG, {'NUM_ANNOTATIONS_PER_FILE': 2,
+                                               'ANNOTATION_FEED_KEYSET_PAGINATION': True}):
+            output = self._call(gids=['g1'], feeds=True)
+            self.assertTrue(output.endswith('Rendered 2 Annotations files\n'))
+            with self.assertNumQueries(0):
+                response = self.client.get(reverse('gcse_annotations', args=('g1', 1)) + '?after=0')
+        self.assertTrue(b'Site 0' in response.content)
+
+    def test_skipped_feeds_are_reported(self):
+        urls = CustomSearchEngine.annotations_urls
+        with patch.object(CustomSearchEngine, 'annotations_urls', autospec=True,
+                          side_effect=lambda cse: urls(cse) + ['//example.com/annotations/%s.9.xml' % cse.gid]):
+            output = self._call(gids=['g1'], feeds=True)
+        self.assertTrue('Skipped //example.com/annotations/g1.9.xml\n' in output)
+        self.assertTrue(output.endswith('Rendered 1 Annotations files\nSkipped 1 Annotations files\n'))
+
+    def test_feeds_need_feed_cache(self):
+        with patch.dict(settings.GCSE_CONFIG, {'ANNOTATION_FEED_CACHE_TIMEOUT': 0}):
+            self.assertRaises(management.CommandError, self._call, feeds=True)
+
+    def test_feeds_need_shared_cache(self):
+        with patch.dict(settings.GCSE_CONFIG, {'CACHE_SHARED': None}):
+            self.assertRaises(management.CommandError, self._call, feeds=True)
+
+    @patch('gcse.management.commands.rebuild_cse_xml.Pool')
+    def test_process_pool(self, pool):
+        pool.return_value.imap_unordered.side_effect = lambda func, tasks: map(func, tasks)
+        output = SIO()
+        management.call_command('rebuild_cse_xml', stdout=output, processes=4)
+        pool.assert_called_once_with(4)
+        self.assertTrue(output.getvalue().endswith('Rebuilt 0 of 2 Custom Search Engines\n'))
+        self.assertTrue(pool.return_value.join.called)
+
+    @patch('gcse.management.commands.rebuild_cse_xml.Pool')
+    def test_processes_must_be_positive(self, pool):
+        self.assertRaises(management.CommandError, management.call_command,
+                          'rebuild_cse_xml', stdout=SIO(), processes=0)
+        self.assertFalse(pool.called)
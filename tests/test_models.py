@@ -8,12 +8,17 @@ Tests for `django-gcse` model module.
 from __future__ import unicode_literals
 from io import StringIO
 from lxml import etree as ET
+import threading
 import mock
 
+from django.utils.six.moves import BaseHTTPServer, socketserver
+
+from django.conf import settings
+from django.core.cache import cache
 from django.db import IntegrityError
 from django.test import TestCase
 from django.test.utils import override_settings
-from gcse.models import CustomSearchEngine, CSESAXHandler, Label, FacetItem, Annotation, AnnotationSAXHandler
+from gcse.models import CustomSearchEngine, CSESAXHandler, Label, FacetItem, Annotation, AnnotationSAXHandler, BulkAnnotationSAXHandler, SyncAnnotationSAXHandler
 
 # Default CSE XML created by google
 CSE_XML = b"""<CustomSearchEngine id="c12345-r678" creator="creatorid" keywords="" language="en" domain="www.google.com" safesearch="true" encoding="utf-8">
@@ -268,7 +273,7 @@ class TestCSEUpdateXML(TestCase):
         self.assertEqual(1,
                          len(_extractPath(cse.output_xml,
                                           "/GoogleCustomizations/Include")))
-        self.assertEqual('<Include type="Annotations" href="//example.com/annotations/c12345-r678.0.xml"/>',
+        self.assertEqual('<Include type="Annotations" href="//example.com/annotations/c12345-r678.1.xml"/>',
                          _extractPathAsString(cse.output_xml,
                                               "/GoogleCustomizations/Include"))
 
@@ -281,10 +286,10 @@ class TestCSEUpdateXML(TestCase):
         self.assertEqual(2,
                          len(_extractPath(cse.output_xml,
                                           "/GoogleCustomizations/Include")))
-        self.assertEqual('<Include type="Annotations" href="//example.com/annotations/c12345-r678.0.xml"/>',
+        self.assertEqual('<Include type="Annotations" href="//example.com/annotations/c12345-r678.1.xml"/>',
                          _extractPathAsString(cse.output_xml,
                                               "/GoogleCustomizations/Include[1]"))
-        self.assertEqual('<Include type="Annotations" href="//example.com/annotations/c12345-r678.1.xml"/>',
+        self.assertEqual('<Include type="Annotations" href="//example.com/annotations/c12345-r678.2.xml"/>',
                          _extractPathAsString(cse.output_xml,
                                               "/GoogleCustomizations/Include[2]"))
 
@@ -366,7 +371,7 @@ class TestCSEUpdateXML(TestCase):
         cse.save()
         with override_settings(GCSE_CONFIG={'NUM_FACET_ITEMS_PER_FACET': 2,
                                             'NUM_ANNOTATIONS_PER_FILE': 1000}):
-            cse.save()
+            cse.rebuild_xml()
 
         self.assertEqual(6,
                          len(_extractPath(cse.output_xml,
@@ -409,6 +414,235 @@ class TestCSEUpdateXML(TestCase):
         self.assertEqual("GoogleCustomizations", new_doc.tag)
 
 
+
+class TestCSEXMLSections(TestCase):
+
+    def setUp(self):
+        self.cse = CustomSearchEngine(gid="c12345-r678",
+                                      input_xml=FACETED_XML)
+        self.cse.save()
+        self.label = Label.objects.create(name="Dogs", mode=Label.MODE.filter)
+
+    def test_new_cse_inserted_once(self):
+        with self.assertNumQueries(1):
+            CustomSearchEngine(gid="c1", title="New").save()
+
+    def test_description_change_updates_only_description(self):
+        self.cse.description = "New description"
+        with mock.patch.object(CustomSearchEngine, '_background_labels_xml') as background_labels, \
+                mock.patch.object(CustomSearchEngine, '_facets_xml') as facets, \
+                mock.patch.object(CustomSearchEngine, '_includes_xml') as includes:
+            with self.assertNumQueries(1):
+                self.cse.save()
+        self.assertFalse(background_labels.called or facets.called or includes.called)
+        self.assertEqual("New description",
+                         _extractPathElementText(self.cse.output_xml,
+                                                 "/GoogleCustomizations/CustomSearchEngine/Description"))
+        self.assertEqual(self.cse.output_xml,
+                         CustomSearchEngine.objects.get(pk=self.cse.pk).output_xml)
+
+    def test_unchanged_cse_not_rebuilt(self):
+        cse = CustomSearchEngine.objects.get(pk=self.cse.pk)
+        with mock.patch.object(CustomSearchEngine, '_update_xml') as update_xml:
+            cse.save()
+        self.assertFalse(update_xml.called)
+
+    def test_gid_change_updates_includes(self):
+        self.cse.gid = "c1"
+        self.cse.save()
+        self.assertEqual('<Include type="Annotations" href="//example.com/annotations/c1.1.xml"/>',
+                         _extractPathAsString(self.cse.output_xml,
+                                              "/GoogleCustomizations/Include"))
+
+    def test_input_xml_change_rebuilds_all(self):
+        self.cse.input_xml = "<CustomSearchEngine><Context/></CustomSearchEngine>"
+        self.cse.save()
+        self.assertEqual(0, len(_extractPath(self.cse.output_xml, ".//LookAndFeel")))
+        self.assertEqual("c12345-r678",
+                         _extractPath(self.cse.output_xml, ".//CustomSearchEngine")[0].get('id'))
+
+    def test_adding_background_label_updates_background_labels(self):
+        self.cse.background_labels.add(self.label)
+        self.assertEqual(self.label.xml(),
+                         _extractPathAsString(self.cse.output_xml, ".//BackgroundLabels/Label"))
+        self.assertEqual(self.cse.output_xml,
+                         CustomSearchEngine.objects.get(pk=self.cse.pk).output_xml)
+
+    def test_adding_facet_item_updates_facets(self):
+        facet = FacetItem.objects.create(title="Dogs", label=self.label, cse=self.cse)
+        self.assertEqual(facet.xml(),
+                         _extractPathAsString(self.cse.output_xml, ".//Context/Facet/FacetItem"))
+
+    def test_facets_read_with_their_labels(self):
+        for i in range(3):
+            label = Label.objects.create(name='facet%d & more' % i)
+            FacetItem.objects.create(title='Facet %d' % i, label=label, cse=self.cse)
+        self.cse.background_labels.add(self.label)
+        cse = CustomSearchEngine.objects.get(pk=self.cse.pk)
+        with self.assertNumQueries(2):
+            background_labels, facets = cse._background_labels_xml(), cse._facets_xml()
+        self.assertEqual(3, len(ET.fromstring('<Context>%s</Context>' % facets).findall('Facet/FacetItem/Label')))
+        self.assertEqual('facet0 & more', _extractPath(cse.output_xml, './/FacetItem/Label')[0].get('name'))
+
+    def test_stale_instance_keeps_regenerated_xml(self):
+        stale = CustomSearchEngine.objects.get(pk=self.cse.pk)
+        FacetItem.objects.create(title="Dogs", label=self.label, cse=self.cse)
+        stale.creator = "creator"
+        stale.save()
+        output_xml = CustomSearchEngine.objects.get(pk=self.cse.pk).output_xml
+        self.assertEqual(1, len(_extractPath(output_xml, ".//Context/Facet/FacetItem")))
+
+    def test_deferred_xml_updates_rebuild_once(self):
+        with mock.patch.object(CustomSearchEngine, '_update_xml', autospec=True,
+                               side_effect=CustomSearchEngine._update_xml) as update_xml:
+            with CustomSearchEngine.deferred_xml_updates():
+                self.cse.title = "New title"
+                self.cse.save()
+                self.cse.background_labels.add(self.label)
+                FacetItem.objects.create(title="Dogs", label=self.label, cse=self.cse)
+                self.assertEqual(0, update_xml.call_count)
+        self.assertEqual(1, update_xml.call_count)
+        self.assertEqual(set(['title', 'background_labels', 'facets', 'includes']), update_xml.call_args[0][1])
+        self.assertEqual("New title",
+                         _extractPathElementText(self.cse.output_xml,
+                                                 "/GoogleCustomizations/CustomSearchEngine/Title"))
+        self.assertEqual(1, len(_extractPath(self.cse.output_xml, ".//Context/Facet/FacetItem")))
+
+    def test_annotation_import_refreshes_includes_once(self):
+        self.cse.background_labels.add(self.label)
+        xml = '<Annotations>%s</Annotations>' % ''.join(
+            '<Annotation about="example.com/%d/*"><Label name="Dogs"/></Annotation>' % i for i in range(3))
+        with mock.patch.object(CustomSearchEngine, '_update_xml', autospec=True,
+                               side_effect=CustomSearchEngine._update_xml) as update_xml:
+            Annotation.from_string(xml)
+        self.assertEqual(1, update_xml.call_count)
+        self.assertEqual(set(['includes']), update_xml.call_args[0][1])
+
+    def test_background_label_change_rebuilds_once(self):
+        with mock.patch.object(CustomSearchEngine, '_update_xml', autospec=True,
+                               side_effect=CustomSearchEngine._update_xml) as update_xml:
+            self.cse.background_labels.add(self.label)
+        self.assertEqual(1, update_xml.call_count)
+        self.assertEqual(set(['background_labels', 'includes']), update_xml.call_args[0][1])
+
+    @mock.patch.dict(settings.GCSE_CONFIG, {'NUM_ANNOTATIONS_PER_FILE': 2})
+    def test_annotation_changes_refresh_includes(self):
+        self.cse.background_labels.add(self.label)
+        for i in range(3):
+            annotation = Annotation.objects.create(about="example.com/%d/*" % i, status=Annotation.STATUS.active)
+            annotation.labels.add(self.label)
+        output_xml = CustomSearchEngine.objects.get(pk=self.cse.pk).output_xml
+        self.assertEqual(2, output_xml.count('<Include type="Annotations"'))
+
+    def test_deferred_xml_updates_discarded_on_error(self):
+        with mock.patch.object(CustomSearchEngine, '_update_xml') as update_xml:
+            with self.assertRaises(ValueError):
+                with CustomSearchEngine.deferred_xml_updates():
+                    self.cse.background_labels.add(self.label)
+                    raise ValueError
+        self.assertFalse(update_xml.called)
+
+
+class AnnotationsHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves an Annotations file for each path and records how many
+    requests it is handling at once."""
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), AnnotationsRequestHandler)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.overlapped = threading.Event()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d/%s' % (self.server_port, path)
+
+
+class AnnotationsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            if server.in_flight > 1:
+                server.overlapped.set()
+        # hold the response until another request arrives (or give up)
+        server.overlapped.wait(2)
+        name = self.path.strip('/')
+        body = ('<Annotations><Annotation about="%s.example.com/*">'
+                '<Label name="_cse_csekeystring" /><Comment>%s</Comment>'
+                '</Annotation></Annotations>' % (name, name)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with server.lock:
+            server.in_flight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class TestImportLinkedAnnotations(TestCase):
+
+    def setUp(self):
+        self.server = AnnotationsHTTPServer()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _xml(self, names):
+        includes = ''.join('<Include type="Annotations" href="%s"/>' % self.server.url(name)
+                           for name in names)
+        return FACETED_XML.replace(b'<Include type="Annotations" href="http://googility.com/googility_annotations.xml"/>',
+                                   includes.encode('utf-8'))
+
+    def test_linked_files_are_fetched_concurrently(self):
+        names = ['one', 'two', 'three', 'four']
+        CustomSearchEngine.from_string(self._xml(names), import_linked_annotations=True, threads=4)
+        self.assertTrue(self.server.max_in_flight > 1)
+        # imported in the order of the Include elements
+        self.assertEqual(names, list(Annotation.objects.order_by('id').values_list('comment', flat=True)))
+        self.assertEqual(4, Annotation.objects.filter(labels__name='_cse_csekeystring').count())
+
+    def test_bulk_import_of_linked_files(self):
+        names = ['one', 'two']
+        CustomSearchEngine.from_string(self._xml(names), import_linked_annotations=True,
+                                       bulk=True, threads=2)
+        self.assertEqual(names, list(Annotation.objects.order_by('id').values_list('comment', flat=True)))
+
+    def test_linked_files_refresh_includes_once(self):
+        self.server.overlapped.set()
+        with mock.patch.object(CustomSearchEngine, '_update_xml', autospec=True,
+                               side_effect=CustomSearchEngine._update_xml) as update_xml:
+            CustomSearchEngine.from_string(self._xml(['one', 'two']), import_linked_annotations=True, threads=1)
+        # written with the new CustomSearchEngine and once after the import
+        self.assertEqual(2, update_xml.call_count)
+        self.assertTrue('includes' in update_xml.call_args[0][1])
+
+    def test_linked_files_report_progress(self):
+        self.server.overlapped.set()
+        progress = []
+        with mock.patch('gcse.models.AnnotationSAXHandler.progress_interval', 1):
+            CustomSearchEngine.from_string(self._xml(['one', 'two']), import_linked_annotations=True,
+                                           threads=1, progress=progress.append)
+        # as each Annotation and each file is imported
+        self.assertEqual([1, 1, 2, 2], progress)
+
+    def test_single_thread_fetches_serially(self):
+        self.server.overlapped.set()
+        CustomSearchEngine.from_string(self._xml(['one', 'two']), import_linked_annotations=True, threads=1)
+        self.assertEqual(1, self.server.max_in_flight)
+        self.assertEqual(2, Annotation.objects.count())
+
+
 class TestCSESAXHandler(TestCase):
 
     def setUp(self):
@@ -512,6 +746,14 @@ class TestLabel(TestCase):
         self.assertEqual('<Label name="blog" mode="FILTER" weight="0.4"/>',
                          label.xml())
 
+    def test_xml_escapes_attributes(self):
+        label = Label(name='"cats" & <dogs>')
+        self.assertEqual('<Label name="&quot;cats&quot; &amp; &lt;dogs&gt;" mode="FILTER"/>',
+                         label.xml())
+        facet_item = FacetItem(title='Cats & Dogs', label=label)
+        self.assertEqual('<FacetItem title="Cats &amp; Dogs"><Label name="&quot;cats&quot; &amp; &lt;dogs&gt;" mode="FILTER"/></FacetItem>',
+                         facet_item.xml())
+
 
 class TestCSEAddingAnnotations(TestCase):
 
@@ -554,6 +796,65 @@ class TestCSEAddingAnnotations(TestCase):
         self.assertEqual(self.cse.annotations()[0],
                          annotation)
 
+
+class TestLabelAnnotationCounts(TestCase):
+
+    def setUp(self):
+        self.cse = CustomSearchEngine.objects.create(gid='g1')
+        self.background = Label.objects.create(name='_cse_g1', background=True)
+        self.other_background = Label.objects.create(name='blogs', background=True)
+        self.cse.background_labels.add(self.background, self.other_background)
+        self.facet = Label.objects.create(name='facet')
+        self.other_facet = Label.objects.create(name='other')
+
+    def _add(self, *labels, **kwargs):
+        annotation = Annotation.objects.create(comment="Annotation",
+                                               status=kwargs.get('status', Annotation.STATUS.active))
+        annotation.labels.add(*labels)
+        return annotation
+
+    def _counts(self):
+        return Label.objects.filter(pk__in=[self.background.pk, self.facet.pk, self.other_facet.pk]).\
+            annotation_counts(self.cse)
+
+    def test_labels_without_annotations_count_zero(self):
+        self.assertEqual([(self.background, 0), (self.facet, 0), (self.other_facet, 0)],
+                         self._counts())
+
+    def test_active_annotations_in_cse_are_counted(self):
+        self._add(self.background, self.facet)
+        self._add(self.other_background, self.facet)
+        self.assertEqual([(self.background, 1), (self.facet, 2), (self.other_facet, 0)],
+                         self._counts())
+
+    def test_annotations_not_in_cse_are_not_counted(self):
+        self._add(self.facet)
+        self._add(self.other_facet, Label.objects.create(name='_cse_other', background=True))
+        self.assertEqual([(self.background, 0), (self.facet, 0), (self.other_facet, 0)],
+                         self._counts())
+
+    def test_inactive_annotations_are_not_counted(self):
+        self._add(self.background, self.facet, status=Annotation.STATUS.submitted)
+        self._add(self.background, self.facet, status=Annotation.STATUS.deleted)
+        self.assertEqual([(self.background, 0), (self.facet, 0), (self.other_facet, 0)],
+                         self._counts())
+
+    def test_annotations_with_several_background_labels_are_counted_once(self):
+        self._add(self.background, self.other_background, self.facet)
+        self.assertEqual([(self.background, 1), (self.facet, 1), (self.other_facet, 0)],
+                         self._counts())
+
+    def test_counts_are_a_single_query(self):
+        for i in range(3):
+            self._add(self.background, self.facet)
+        with self.assertNumQueries(2):
+            self._counts()
+
+    def test_cse_labels_counts(self):
+        FacetItem.objects.create(cse=self.cse, title='Facet', label=self.facet)
+        self._add(self.background, self.facet)
+        self.assertEqual([(self.facet, 1)], self.cse.facet_item_labels_counts())
+
 # TODO move to googility
 # class TestCSEAddingPlaces(TestCase):
 
@@ -689,6 +990,253 @@ class TestAnnotationParsing(TestCase):
         self.assertEqual("_cse_keystring", a5.labels.all()[0].name)
 
 
+class TestBulkAnnotationParsing(TestAnnotationParsing):
+
+    def setUp(self):
+        self.handler = BulkAnnotationSAXHandler(batch_size=4)
+
+    def test_parse_annotations_from_string(self):
+        annotations = Annotation.from_string(ANNOTATION_XML, bulk=True)
+        self._validate(annotations)
+
+    def test_same_data_as_unbatched_import(self):
+        def dump():
+            return sorted((a.about, a.original_url, a.comment, a.score, a.status,
+                           tuple(a.labels.values_list('name', flat=True)))
+                          for a in Annotation.objects.all())
+        AnnotationSAXHandler().parseString(ANNOTATION_XML)
+        expected = dump()
+        Annotation.objects.all().delete()
+        Label.objects.all().delete()
+
+        self.handler.parseString(ANNOTATION_XML)
+        self.assertEqual(expected, dump())
+        self.assertEqual(3, Label.objects.count())
+
+    def test_reimport_updates_existing_annotations(self):
+        self.handler.parseString(ANNOTATION_XML)
+        Annotation.objects.update(status=Annotation.STATUS.deleted)
+
+        annotations = BulkAnnotationSAXHandler().parseString(ANNOTATION_XML.replace(b"here's", b"another"))
+        # the last Annotation has no timestamp so is imported again
+        self.assertEqual(7, Annotation.objects.count())
+        self.assertEqual(6, Annotation.objects.active().count())
+        self.assertEqual("another a comment", annotations[5].comment)
+        self.assertEqual(7, Annotation.labels.through.objects.count())
+        # Labels aren't duplicated on the existing Annotations
+        self.assertEqual(1, annotations[0].labels.count())
+
+    def test_existing_labels_are_reused(self):
+        label = Label.objects.create(name="_cse_keystring", background=True)
+        annotations = self.handler.parseString(ANNOTATION_XML)
+        self.assertEqual([label], list(annotations[5].labels.all()))
+
+    def test_queries_per_batch_not_per_annotation(self):
+        handler = BulkAnnotationSAXHandler(batch_size=100)
+        # Labels: 3, Annotations: 3, Label links: 1, search index: 2, savepoint: 2, invalidation: 1,
+        # counts: 2
+        with self.assertNumQueries(14):
+            handler.parseString(ANNOTATION_XML)
+
+    def test_repeated_about_in_batch(self):
+        xml = ('<Annotations>'
+               '<Annotation about="example.com/*" score="0.5"><Label name="a" /><Comment>Half</Comment></Annotation>'
+               '<Annotation about="example.com/*" score="1"><Label name="b" /><Comment>One</Comment></Annotation>'
+               '</Annotations>')
+        # inserted in the reverse order of the file
+        Annotation.objects.create(about="example.org/*")
+        annotations = self.handler.parseString(xml)
+        self.assertEqual([("Half", ["a"]), ("One", ["b"])],
+                         [(a.comment, list(a.labels.values_list('name', flat=True))) for a in annotations])
+
+    def test_concurrent_insert_is_detected(self):
+        bulk_create = Annotation.objects.bulk_create
+
+        def racing_bulk_create(annotations):
+            # another import inserts the same Annotation at the same time
+            result = bulk_create(annotations)
+            Annotation.objects.create(about=annotations[0].about, score=annotations[0].score,
+                                      created=annotations[0].created)
+            return result
+
+        with mock.patch.object(Annotation.objects, 'bulk_create', side_effect=racing_bulk_create):
+            self.assertRaises(IntegrityError, self.handler.parseString, ANNOTATION_XML)
+
+    def test_cse_includes_updated(self):
+        cse = CustomSearchEngine.from_string(FACETED_XML)
+        label = Label.objects.get(name="_cse_csekeystring")
+        xml = ANNOTATION_XML.replace(b'"_cse_keystring"', b'"_cse_csekeystring"')
+        with override_settings(GCSE_CONFIG={'NUM_ANNOTATIONS_PER_FILE': 1}):
+            self.handler.parseString(xml)
+            self.handler.parseString(xml.replace(b"tech.", b"www."))
+        cse = CustomSearchEngine.objects.get(pk=cse.pk)
+        self.assertEqual(2, cse.output_xml.count('<Include type="Annotations"'))
+
+
+class TestStreamingAnnotationParsing(TestCase):
+
+    def _xml(self, count):
+        annotations = ''.join('<Annotation about="example.com/%d/*" timestamp="0x0004d956807a35fd">'
+                              '<Label name="_cse_keystring" /><Comment>Site %d</Comment>'
+                              '</Annotation>' % (i, i) for i in range(count))
+        return '<Annotations>%s</Annotations>' % annotations
+
+    def test_parse_unicode_string(self):
+        annotations = AnnotationSAXHandler().parseString(self._xml(2))
+        self.assertEqual(["Site 0", "Site 1"], [a.comment for a in annotations])
+
+    def test_parse_file(self):
+        import tempfile
+        with tempfile.NamedTemporaryFile(suffix='.xml') as f:
+            f.write(ANNOTATION_XML)
+            f.flush()
+            annotations = Annotation.from_url(f.name, bulk=True)
+        self.assertEqual(6, len(annotations))
+
+    def test_namespaced_elements(self):
+        xml = ('<a:Annotations xmlns:a="http://example.com/ns">'
+               '<a:Annotation about="example.com/*"><a:Comment>Site</a:Comment></a:Annotation>'
+               '</a:Annotations>')
+        annotations = AnnotationSAXHandler().parseString(xml)
+        self.assertEqual("Site", annotations[0].comment)
+
+    def test_annotations_not_collected(self):
+        handler = BulkAnnotationSAXHandler(collect=False, batch_size=10)
+        self.assertEqual([], handler.parseString(self._xml(25)))
+        self.assertEqual(25, handler.count)
+        self.assertEqual(25, Annotation.objects.filter(labels__name="_cse_keystring").count())
+
+    def test_handled_elements_are_discarded(self):
+        roots = []
+        _iterparse = ET.iterparse
+
+        def iterparse(*args, **kwargs):
+            for event, element in _iterparse(*args, **kwargs):
+                if not roots:
+                    roots.append(element)
+                yield event, element
+
+        with mock.patch('lxml.etree.iterparse', iterparse):
+            AnnotationSAXHandler(collect=False).parseString(self._xml(5))
+        # only the last, emptied, Annotation element is left
+        self.assertEqual(1, len(roots[0]))
+        self.assertEqual(0, len(roots[0][0]))
+        self.assertFalse(roots[0][0].attrib)
+
+
+class TestSyncAnnotations(TestCase):
+
+    def setUp(self):
+        self.cse = CustomSearchEngine.from_string(FACETED_XML)
+
+    def _xml(self, *annotations):
+        return '<Annotations>%s</Annotations>' % ''.join(
+            '<Annotation about="%s"><Label name="_cse_csekeystring" />%s'
+            '<Comment>%s</Comment></Annotation>' % (about, ''.join('<Label name="%s" />' % l for l in labels), comment)
+            for about, comment, labels in annotations)
+
+    def _sync(self, *xmls):
+        handler = SyncAnnotationSAXHandler(self.cse)
+        for xml in xmls:
+            handler.parseString(xml)
+        return handler.sync()
+
+    def test_initial_sync_inserts(self):
+        counts = self._sync(self._xml(('a.com/*', 'A', ['blog'])),
+                            self._xml(('b.com/*', 'B', [])))
+        self.assertEqual({'inserted': 2, 'updated': 0, 'deleted': 0, 'unchanged': 0}, counts)
+        self.assertEqual(['A', 'B'], sorted(self.cse.annotations().values_list('comment', flat=True)))
+        self.assertEqual(['_cse_csekeystring', 'blog'],
+                         Annotation.label_names([Annotation.objects.get(comment='A').id]).popitem()[1])
+
+    def test_unchanged_sync_writes_nothing(self):
+        xml = self._xml(('a.com/*', 'A', ['blog']), ('b.com/*', 'B', []))
+        self._sync(xml)
+        # the CustomSearchEngines' Labels, Annotations and their Labels
+        with self.assertNumQueries(4):
+            counts = self._sync(xml)
+        self.assertEqual({'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 2}, counts)
+
+    def test_changes_are_applied(self):
+        self._sync(self._xml(('a.com/*', 'A', ['blog']), ('b.com/*', 'B', []), ('c.com/*', 'C', [])))
+        a = Annotation.objects.get(about='a.com/*')
+        counts = self._sync(self._xml(('a.com/*', 'A2', ['club']), ('b.com/*', 'B', []), ('d.com/*', 'D', [])))
+        self.assertEqual({'inserted': 1, 'updated': 1, 'deleted': 1, 'unchanged': 1}, counts)
+
+        # updated in place
+        a = Annotation.objects.get(pk=a.pk)
+        self.assertEqual('A2', a.comment)
+        self.assertEqual(['_cse_csekeystring', 'club'], sorted(a.labels.values_list('name', flat=True)))
+        self.assertEqual(Annotation.STATUS.deleted, Annotation.objects.get(about='c.com/*').status)
+        self.assertEqual(['A2', 'B', 'D'], sorted(self.cse.annotations().values_list('comment', flat=True)))
+
+    def test_deleted_annotation_is_restored(self):
+        self._sync(self._xml(('a.com/*', 'A', [])))
+        self._sync(self._xml())
+        counts = self._sync(self._xml(('a.com/*', 'A', [])))
+        self.assertEqual({'inserted': 0, 'updated': 1, 'deleted': 0, 'unchanged': 0}, counts)
+        self.assertEqual(1, Annotation.objects.active().count())
+
+    def test_other_annotations_are_untouched(self):
+        other = Annotation.objects.create(about='a.com/*', comment='Other', status=Annotation.STATUS.active)
+        submitted = Annotation.objects.create(about='b.com/*', comment='Submitted')
+        submitted.labels.add(Label.objects.get(name='_cse_csekeystring'))
+        self._sync(self._xml(('a.com/*', 'A', [])))
+        self.assertEqual('Other', Annotation.objects.get(pk=other.pk).comment)
+        self.assertEqual(Annotation.STATUS.submitted, Annotation.objects.get(pk=submitted.pk).status)
+
+    def _other_cse(self):
+        other = CustomSearchEngine.objects.create(gid='other')
+        other.background_labels.add(Label.objects.create(name='_cse_other', background=True))
+        return other
+
+    def _label_names(self, annotation):
+        return sorted(annotation.labels.values_list('name', flat=True))
+
+    def test_same_about_elsewhere_is_not_matched(self):
+        other = Annotation.objects.create(about='a.com/*', comment='Other', status=Annotation.STATUS.deleted)
+        counts = self._sync(self._xml(('a.com/*', 'A', [])))
+        self.assertEqual(1, counts['inserted'])
+        other = Annotation.objects.get(pk=other.pk)
+        self.assertEqual(('Other', Annotation.STATUS.deleted), (other.comment, other.status))
+        self.assertEqual([], self._label_names(other))
+
+    def test_labels_of_other_cses_are_kept(self):
+        self._sync(self._xml(('a.com/*', 'A', ['blog'])))
+        other = self._other_cse()
+        a = Annotation.objects.get(about='a.com/*')
+        a.labels.add(Label.objects.get(name='_cse_other'))
+        counts = self._sync(self._xml(('a.com/*', 'A', ['club'])))
+        self.assertEqual(1, counts['updated'])
+        self.assertEqual(['_cse_csekeystring', '_cse_other', 'club'], self._label_names(a))
+        self.assertEqual(['A'], list(other.annotations().values_list('comment', flat=True)))
+
+    def test_shared_annotations_leave_the_cse(self):
+        self._sync(self._xml(('a.com/*', 'A', []), ('b.com/*', 'B', [])))
+        other = self._other_cse()
+        a = Annotation.objects.get(about='a.com/*')
+        a.labels.add(Label.objects.get(name='_cse_other'))
+        counts = self._sync(self._xml(('b.com/*', 'B', [])))
+        self.assertEqual({'inserted': 0, 'updated': 0, 'deleted': 1, 'unchanged': 1}, counts)
+        a = Annotation.objects.get(pk=a.pk)
+        self.assertEqual(Annotation.STATUS.active, a.status)
+        self.assertEqual(['_cse_other'], self._label_names(a))
+        self.assertEqual(['B'], list(self.cse.annotations().values_list('comment', flat=True)))
+        self.assertEqual(['A'], list(other.annotations().values_list('comment', flat=True)))
+
+    def test_annotations_of_other_cses_are_unchanged(self):
+        self._sync(self._xml(('a.com/*', 'A', [])))
+        self._other_cse()
+        Annotation.objects.get(about='a.com/*').labels.add(Label.objects.get(name='_cse_other'))
+        counts = self._sync(self._xml(('a.com/*', 'A', [])))
+        self.assertEqual({'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 1}, counts)
+
+    def test_includes_are_updated(self):
+        with mock.patch.dict(settings.GCSE_CONFIG, {'NUM_ANNOTATIONS_PER_FILE': 1}):
+            self._sync(self._xml(('a.com/*', 'A', []), ('b.com/*', 'B', [])))
+        self.assertEqual(2, CustomSearchEngine.objects.get(pk=self.cse.pk).output_xml.count('<Include type="Annotations"'))
+
+
 class AnnotationSAXHandlerTests(TestCase):
 
     def testParseWithAmpersand(self):
@@ -742,6 +1290,53 @@ class AnnotationsLabelsLinks(TestCase):
         self.assertEqual('<a class="label-link" href="/labels/1/">Label & Name</a>',
                          self.annotation.labels_as_links(include_background_labels=False))
 
+    def test_labels_as_links_are_memoized(self):
+        with self.assertNumQueries(1):
+            self.annotation.labels_as_links()
+            self.annotation.facet_item_labels_as_links()
+            self.annotation.all_labels_as_links()
+
+    def test_labels_as_links_follow_label_changes(self):
+        self.annotation.labels_as_links()
+        self.annotation.labels.add(Label.objects.create(name="Another"))
+        self.assertTrue('>Another</a>' in self.annotation.labels_as_links())
+
+    @mock.patch.dict(settings.GCSE_CONFIG, {'LABEL_LINKS_CACHE_TIMEOUT': 60})
+    def test_labels_as_links_are_shared_through_cache(self):
+        links = self.annotation.labels_as_links()
+        annotation = Annotation.objects.get(pk=self.annotation.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(links, annotation.labels_as_links())
+
+    @mock.patch.dict(settings.GCSE_CONFIG, {'LABEL_LINKS_CACHE_TIMEOUT': 60})
+    def test_cached_labels_as_links_are_invalidated(self):
+        self.annotation.labels_as_links()
+        label = Label.objects.get(name="Background Label")
+        label.name = "Renamed"
+        label.save()
+        annotation = Annotation.objects.get(pk=self.annotation.pk)
+        self.assertTrue('>Renamed</a>' in annotation.labels_as_links())
+        label.annotation_set.remove(annotation)
+        annotation = Annotation.objects.get(pk=self.annotation.pk)
+        self.assertFalse('>Renamed</a>' in annotation.labels_as_links())
+
+    @mock.patch.dict(settings.GCSE_CONFIG, {'LABEL_LINKS_CACHE_TIMEOUT': 60})
+    def test_label_links_of_a_page_are_read_together(self):
+        for i in range(3):
+            Annotation.objects.create(comment="Annotation %d" % i).labels.add(Label.objects.get(name="Label & Name"))
+        Annotation.prefetch_label_links(Annotation.objects.all())
+        annotations = list(Annotation.objects.order_by('id'))
+        with mock.patch('gcse.caching.generation') as generation, \
+                mock.patch.object(cache, 'get_many', wraps=cache.get_many) as get_many, \
+                self.assertNumQueries(0):
+            Annotation.prefetch_label_links(annotations)
+            links = [annotation.labels_as_links() for annotation in annotations]
+        self.assertFalse(generation.called)
+        # the generations and then the links
+        self.assertEqual([5, 4], [len(args[0]) for args, kwargs in get_many.call_args_list])
+        self.assertTrue('>Background Label</a>' in links[0])
+        self.assertTrue('>Label & Name</a>' in links[3])
+
 
 class AnnotationsLabels(TestCase):
 
@@ -767,19 +1362,90 @@ class AnnotationsAlphaList(TestCase):
         results = Annotation.alpha_list()
         self.assertEqual(self.expected, results)
 
+    def _create(self, comment, status=Annotation.STATUS.active):
+        return Annotation.objects.create(comment=comment, status=status)
+
     def test_two_annotations_two_active_letters(self):
-        f = Annotation.objects.create(comment="Fun with Python")
-        five = Annotation.objects.create(comment="5 Python Anti-Patterns")
+        f = self._create("Fun with Python")
+        five = self._create("5 Python Anti-Patterns")
         results = Annotation.alpha_list()
         self.expected[5]['style'] = 'active'
         self.expected[-5]['style'] = 'active'
         self.assertEqual(self.expected, results)
 
     def test_two_annotations_two_active_letters_one_inactive_selected(self):
-        f = Annotation.objects.create(comment="Fun with Python")
-        five = Annotation.objects.create(comment="5 Python Anti-Patterns")
+        f = self._create("Fun with Python")
+        five = self._create("5 Python Anti-Patterns")
         results = Annotation.alpha_list(selection="B")
         self.expected[1]['style'] = 'selected'
         self.expected[5]['style'] = 'active'
         self.expected[-5]['style'] = 'active'
         self.assertEqual(self.expected, results)
+
+    def test_lower_case_letters_are_active(self):
+        self._create("fun with Python")
+        self.expected[5]['style'] = 'active'
+        self.assertEqual(self.expected, Annotation.alpha_list())
+
+    def test_inactive_annotations_are_ignored(self):
+        self._create("Fun with Python", status=Annotation.STATUS.submitted)
+        self._create("Gone", status=Annotation.STATUS.deleted)
+        self.assertEqual(self.expected, Annotation.alpha_list())
+
+    def test_first_letter_follows_comment(self):
+        f = self._create("Fun with Python")
+        f.comment = "Python Fun"
+        f.save()
+        self.expected[15]['style'] = 'active'
+        self.assertEqual(self.expected, Annotation.alpha_list())
+
+    def test_label_and_cse_scopes(self):
+        label = Label.objects.create(name="label")
+        background = Label.objects.create(name="background", background=True)
+        cse = CustomSearchEngine.objects.create(gid="alpha")
+        cse.background_labels.add(background)
+        self._create("Fun with Python").labels.add(label)
+        self._create("Another").labels.add(label, background)
+        self._create("Background").labels.add(background)
+
+        with self.assertNumQueries(1):
+            results = Annotation.alpha_list(label_id=label.id)
+        self.assertEqual(['A', 'F'], [r['i'] for r in results if r['style'] == 'active'])
+        results = Annotation.alpha_list(cse=cse)
+        self.assertEqual(['A', 'B'], [r['i'] for r in results if r['style'] == 'active'])
+        results = Annotation.alpha_list(cse=cse, label_id=label.id)
+        self.assertEqual(['A'], [r['i'] for r in results if r['style'] == 'active'])
+
+    def test_bulk_imports_set_first_letter(self):
+        Annotation.from_string('<Annotations><Annotation about="example.com/*">'
+                               '<Comment>zoom</Comment></Annotation></Annotations>', bulk=True)
+        self.assertEqual('Z', Annotation.objects.get().first_letter)
+
+
+class AnnotationsStartingWith(TestCase):
+
+    def setUp(self):
+        for comment in ["Émile's Agility", "emu farm", "Eagle", "Fun", "dog", "E"]:
+            Annotation.objects.create(comment=comment, status=Annotation.STATUS.active)
+
+    def _starting_with(self, prefix):
+        return list(Annotation.objects.filter(Annotation.starting_with(prefix)).
+                    order_by('sort_key').values_list('comment', flat=True))
+
+    def test_case_and_accents_are_ignored(self):
+        self.assertEqual(["E", "Eagle", "Émile's Agility", "emu farm"], self._starting_with("e"))
+        self.assertEqual(["Émile's Agility", "emu farm"], self._starting_with("ÉM"))
+
+    def test_matches_istartswith_for_ascii(self):
+        for prefix in ["E", "f", "Fu", "D", "x"]:
+            # accented comments are only found by starting_with()
+            self.assertEqual(sorted(Annotation.objects.filter(comment__istartswith=prefix).
+                                    values_list('comment', flat=True)),
+                             sorted(c for c in self._starting_with(prefix) if not c.startswith("É")))
+
+    def test_empty_prefix_matches_all(self):
+        self.assertEqual(6, len(self._starting_with("")))
+
+    def test_sort_key(self):
+        self.assertEqual("emile's agility", Annotation.objects.get(comment__startswith="É").sort_key)
+        self.assertEqual("E", Annotation.objects.get(comment__startswith="É").first_letter)
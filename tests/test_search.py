@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+test_search
+-----------
+
+Tests for `django-gcse` search module.
+"""
+from __future__ import unicode_literals
+from mock import patch
+
+from django.conf import settings
+from django.core import management
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from gcse import models, search
+from gcse.models import Annotation, AnnotationSearchTerm
+
+
+class SearchBackendTests(object):
+    """Tests run against every backend; mixed into a TestCase per backend."""
+    backend_name = None
+
+    def setUp(self):
+        self.patch = patch.dict(settings.GCSE_CONFIG, {'ANNOTATION_SEARCH_BACKEND': self.backend_name})
+        self.patch.start()
+        search._backends.clear()
+        self.backend = search.get_backend()
+        self.agility = self._add('Lucky Dog Agility', 'http://www.luckydogagility.com/')
+        self.blog = self._add('AgilityNerd Blog', 'http://agilitynerd.com/blog/')
+        self.club = self._add('Dog Club', 'http://example.com/agility/')
+
+    def tearDown(self):
+        self.patch.stop()
+        search._backends.clear()
+
+    def _add(self, comment, url, status=Annotation.STATUS.active):
+        return Annotation.objects.create(comment=comment, original_url=url, status=status)
+
+    def _search(self, query):
+        return list(self.backend.search(Annotation.objects.active(), query))
+
+    def test_backend(self):
+        self.assertEqual(self.backend_class, type(self.backend))
+
+    def test_word_prefix(self):
+        self.assertEqual([self.agility, self.club], sorted(self._search('dog'), key=lambda a: a.id))
+        self.assertEqual([self.agility], self._search('luck'))
+
+    def test_all_words_must_match(self):
+        self.assertEqual([self.club], self._search('dog club'))
+        self.assertEqual([], self._search('dog blog'))
+
+    def test_case_and_punctuation_are_ignored(self):
+        self.assertEqual([self.blog], self._search('AGILITYNERD.com/'))
+        self.assertEqual([], self._search('://'))
+
+    def test_comment_ranks_above_url(self):
+        self.assertEqual(self.club, self._search('agility')[-1])
+
+    def test_inactive_annotations_are_not_found(self):
+        self._add('Dog Park', 'http://park.example.com/', status=Annotation.STATUS.submitted)
+        self.assertEqual([], self._search('park'))
+
+    def test_index_follows_changes(self):
+        self.club.comment = 'Dog Training Club'
+        self.club.save()
+        self.assertEqual([self.club], self._search('training'))
+        self.club.delete()
+        self.assertEqual([], self._search('training'))
+
+    def test_bulk_imports_are_indexed(self):
+        Annotation.from_string('<Annotations><Annotation about="flyball.example.com/*">'
+                               '<Comment>Flyball</Comment></Annotation></Annotations>', bulk=True)
+        self.assertEqual(['Flyball'], [a.comment for a in self._search('flyball')])
+
+    def test_rebuild(self):
+        self.backend.clear()
+        self.assertEqual([], self._search('dog'))
+        management.call_command('rebuild_search_index', stdout=open('/dev/null', 'w'))
+        self.assertEqual(2, len(self._search('dog')))
+
+    def test_search_view_uses_index(self):
+        response = self.client.get(reverse('gcse_search') + '?q=dog+clu')
+        self.assertEqual([self.club], list(response.context['object_list']))
+
+
+class SQLiteSearchTest(SearchBackendTests, TestCase):
+    backend_name = 'sqlite'
+    backend_class = search.SQLiteBackend
+
+
+class PythonSearchTest(SearchBackendTests, TestCase):
+    backend_name = 'python'
+    backend_class = search.PythonBackend
+
+    def test_terms_are_stored(self):
+        self.assertEqual(['agility', 'club', 'com', 'dog', 'example', 'http'],
+                         sorted(AnnotationSearchTerm.objects.filter(annotation=self.club).
+                                values_list('term', flat=True)))
+
+    def test_max_results(self):
+        with patch.dict(settings.GCSE_CONFIG, {'ANNOTATION_SEARCH_MAX_RESULTS': 1}):
+            self.assertEqual(1, len(self._search('dog')))
+
+    def test_max_results_are_of_the_queryset(self):
+        # the word in its comment ranks it above the active Annotation
+        self._add('Example Dogs', 'http://dogs.example.org/', status=Annotation.STATUS.deleted)
+        with patch.dict(settings.GCSE_CONFIG, {'ANNOTATION_SEARCH_MAX_RESULTS': 1}):
+            self.assertEqual([self.club], self._search('example'))
+
+    def test_scores_are_summed_over_the_words(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual([self.agility, self.club], self._search('dog agility'))
+        # ranked and limited in the database, then the Annotations read
+        self.assertEqual(2, len(queries))
+        self.assertTrue('LIMIT' in queries.captured_queries[0]['sql'])
+
+    def test_long_words_match_their_truncated_terms(self):
+        word = 'agility' * 10
+        annotation = self._add('%s Dogs' % word, 'http://long.example.com/')
+        self.assertEqual([annotation], self._search(word))
+
+
+class SearchBackendTest(TestCase):
+
+    def test_search_must_be_implemented(self):
+        class IndexOnlyBackend(search.SearchBackend):
+            def index(self, annotations):
+                pass
+
+        self.assertRaises(TypeError, IndexOnlyBackend)
+
+
+class AutoSearchTest(TestCase):
+
+    def test_auto_uses_fts5_on_sqlite(self):
+        with patch.dict(settings.GCSE_CONFIG, {'ANNOTATION_SEARCH_BACKEND': 'auto'}):
+            search._backends.clear()
+            self.assertEqual(search.SQLiteBackend, type(search.get_backend()))
+        search._backends.clear()
+
+    def test_disabled(self):
+        with patch.dict(settings.GCSE_CONFIG, {'ANNOTATION_SEARCH_BACKEND': None}):
+            self.assertEqual(None, search.get_backend())
+            Annotation.objects.create(comment='Lucky Dog', status=Annotation.STATUS.active)
+            response = self.client.get(reverse('gcse_search') + '?q=ky+Do')
+        self.assertEqual(1, len(response.context['object_list']))
+
+
+@patch.dict(settings.GCSE_CONFIG, {'ANNOTATION_SEARCH_BACKEND': 'python'})
+class InstallIndexTest(TestCase):
+
+    def setUp(self):
+        search._backends.clear()
+        self.annotation = Annotation.objects.create(comment='Lucky Dog', status=Annotation.STATUS.active)
+        search.get_backend().clear()
+
+    def tearDown(self):
+        search._backends.clear()
+
+    def _search(self, query):
+        return list(search.get_backend().search(Annotation.objects.active(), query))
+
+    def test_existing_annotations_are_indexed(self):
+        search.install_index(sender=models, db='default')
+        self.assertEqual([self.annotation], self._search('lucky'))
+
+    def test_other_apps_are_ignored(self):
+        with patch.object(search.PythonBackend, 'install') as install:
+            search.install_index(sender=management, db='default')
+        self.assertFalse(install.called)
+        self.assertEqual([], self._search('lucky'))
+
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+test_skeletons
+--------------
+
+Tests for `django-gcse` skeletons module.
+"""
+from __future__ import unicode_literals
+
+import mock
+from lxml import etree as ET
+
+from django.test import TestCase
+
+from gcse import skeletons
+from gcse.models import CustomSearchEngine, FacetItem, Label
+
+
+INPUT_XML = """<CustomSearchEngine id="old" language="en">
+  <Title>Old title</Title>
+  <Context>
+    <Facet><FacetItem title="Old"><Label name="old" mode="FILTER"/></FacetItem></Facet>
+    <BackgroundLabels>
+      <Label name="_cse_old" mode="FILTER"/>
+    </BackgroundLabels>
+  </Context>
+  <LookAndFeel nonprofit="false"/>
+</CustomSearchEngine>"""
+
+VALUES = {
+    'title': '<Title>New</Title>',
+    'description': '<Description>About</Description>',
+    'background_labels': '<BackgroundLabels><Label name="a" mode="FILTER"/></BackgroundLabels>',
+    'facets': '<Facet><FacetItem title="B"><Label name="b" mode="FILTER"/></FacetItem></Facet>',
+    'includes': '<Include type="Annotations" href="//example.com/annotations/g1.1.xml"/>',
+    }
+
+
+class SkeletonTest(TestCase):
+
+    def setUp(self):
+        skeletons.clear()
+        self.skeleton = skeletons.get('g1', INPUT_XML)
+
+    def test_render_splices_slots(self):
+        doc = ET.fromstring(self.skeleton.render(VALUES))
+        self.assertEqual('GoogleCustomizations', doc.tag)
+        self.assertEqual('g1', doc.find('CustomSearchEngine').get('id'))
+        self.assertEqual('New', doc.findtext('CustomSearchEngine/Title'))
+        self.assertEqual('About', doc.findtext('CustomSearchEngine/Description'))
+        self.assertEqual(['a'], [el.get('name') for el in doc.findall('.//BackgroundLabels/Label')])
+        self.assertEqual(['B'], [el.get('title') for el in doc.findall('.//Context/Facet/FacetItem')])
+        self.assertEqual(1, len(doc.findall('Include')))
+        self.assertEqual(1, len(doc.findall('.//LookAndFeel')))
+
+    def test_render_defaults(self):
+        doc = ET.fromstring(self.skeleton.render({}))
+        self.assertEqual('Old title', doc.findtext('CustomSearchEngine/Title'))
+        self.assertIsNone(doc.find('CustomSearchEngine/Description'))
+        self.assertEqual(0, len(doc.findall('.//BackgroundLabels/Label')))
+        self.assertEqual(0, len(doc.findall('.//Facet')))
+
+    def test_slot_values_round_trip(self):
+        output_xml = self.skeleton.render(VALUES)
+        self.assertEqual(VALUES, self.skeleton.slot_values(output_xml))
+        self.assertEqual(VALUES, self.skeleton.slot_values(output_xml.decode('utf-8')))
+
+    def test_slot_values_of_adjacent_empty_slots(self):
+        skeleton = skeletons.get('g1', '<CustomSearchEngine><Context/></CustomSearchEngine>')
+        values = dict(VALUES, title=None, description=None)
+        output_xml = skeleton.render(values)
+        self.assertEqual(dict(values, title='', description=''), skeleton.slot_values(output_xml))
+
+    def test_slot_values_of_other_output(self):
+        self.assertIsNone(self.skeleton.slot_values(''))
+        self.assertIsNone(skeletons.get('g2', INPUT_XML).slot_values(self.skeleton.render(VALUES)))
+        self.assertIsNone(self.skeleton.slot_values(self.skeleton.render(VALUES) + b'<!-- -->'))
+
+    def test_slot_values_of_output_missing_a_slot(self):
+        output_xml = self.skeleton.render(dict(VALUES, background_labels='<Labels/>'))
+        self.assertIsNone(self.skeleton.slot_values(output_xml))
+
+    def test_input_xml_parsed_once(self):
+        with mock.patch.object(skeletons.ET, 'fromstring', wraps=ET.fromstring) as fromstring:
+            skeletons.get('g3', INPUT_XML)
+            skeletons.get('g3', INPUT_XML)
+        self.assertEqual(1, fromstring.call_count)
+        self.assertIsNot(self.skeleton, skeletons.get('g1', INPUT_XML.replace('Old', 'Older')))
+
+    def test_text_with_encoding_declaration(self):
+        skeleton = skeletons.get('g1', '<?xml version="1.0" encoding="UTF-8"?>\n' + INPUT_XML)
+        self.assertEqual('New', ET.fromstring(skeleton.render(VALUES)).findtext('.//Title'))
+
+
+class CustomSearchEngineSkeletonTest(TestCase):
+
+    def setUp(self):
+        self.cse = CustomSearchEngine.objects.create(gid='g1', title='A & B', input_xml=INPUT_XML)
+        self.label = Label.objects.create(name='dogs')
+
+    def test_output_xml_escapes_title(self):
+        self.assertEqual('A & B', ET.fromstring(self.cse.output_xml).findtext('.//Title'))
+
+    def test_sections_regenerated_without_parsing(self):
+        FacetItem.objects.create(title='Dogs', label=self.label, cse=self.cse)
+        with mock.patch.object(skeletons.ET, 'fromstring') as fromstring:
+            self.cse.background_labels.add(self.label)
+            self.cse.title = 'New title'
+            self.cse.save()
+        self.assertFalse(fromstring.called)
+        doc = ET.fromstring(self.cse.output_xml)
+        self.assertEqual('New title', doc.findtext('.//Title'))
+        self.assertEqual(['dogs'], [el.get('name') for el in doc.findall('.//BackgroundLabels/Label')])
+        self.assertEqual(['Dogs'], [el.get('title') for el in doc.findall('.//Facet/FacetItem')])
+
+    def test_update_output_xml_includes(self):
+        self.assertFalse(self.cse.update_output_xml_includes())
+        with mock.patch.object(CustomSearchEngine, 'annotation_count', return_value=2500):
+            self.assertTrue(self.cse.update_output_xml_includes())
+        self.assertEqual(3, len(ET.fromstring(self.cse.output_xml).findall('Include')))
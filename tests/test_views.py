@@ -1,16 +1,26 @@
+import warnings
+
 from django.test import TestCase
-from django.test.client import Client
-from django.test.utils import override_settings
+from django.test.client import Client, RequestFactory
+from django.test.utils import override_settings, CaptureQueriesContext
 
 from django.conf import settings
+from django.db import connection
+from django.core.cache import cache
+from django.core.paginator import Paginator
 from django.core.urlresolvers import reverse
-from gcse.models import CustomSearchEngine, Label, Annotation
-from gcse.views import CSEAnnotations, AnnotationList
+from django.template.loader import render_to_string
+from mock import Mock, patch
+from django.http import Http404
+from gcse import caching
+from gcse.models import CustomSearchEngine, FacetItem, Label, Annotation
+from gcse.views import CSEAnnotations, CSEContext, AnnotationList, CustomSearchEngineDetail
 
 
 class ViewsTemplatesTestCase(TestCase):
 
     def setUp(self):
+        cache.clear()
         self.client = Client()
         self.ROOT_URLCONF = settings.ROOT_URLCONF
         self.TEMPLATE_CONTEXT_PROCESSORS = settings.TEMPLATE_CONTEXT_PROCESSORS
@@ -45,28 +55,139 @@ class ViewsTemplatesTestCase(TestCase):
         annotation.save()
         annotation.labels.add(self.label)
 
+    def _get_annotations_xml(self, page, after=None):
+        url = reverse('gcse_annotations', args=(self.cse.gid, page))
+        if after is not None:
+            url += '?after=%d' % after
+        # streamed content can only be consumed once
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        if response.streaming:
+            return b''.join(response.streaming_content).decode('utf-8')
+        return response.content.decode('utf-8')
+
     def test_cse_xml(self):
         response = self.client.get(reverse('gcse_cse', args=(self.cse.gid,)))
         self.assertEqual(200, response.status_code)
         self.assertContains(response,
                             '<CustomSearchEngine id="g123-456-AZ0" language="en" encoding="utf-8" enable_suggest="true">')
         self.assertContains(response,
-                            '<Include type="Annotations" href="//example.com/annotations/g123-456-AZ0.0.xml"/>')
+                            '<Include type="Annotations" href="//example.com/annotations/g123-456-AZ0.1.xml"/>')
 
     def test_cse_xml_multiple_annotations(self):
-        self._add_annotation('Site Name 2')
-        # force update of CSE... change to signal on Annotation insert/delete?
+        # the Includes are updated as Annotations are added
         with override_settings(GCSE_CONFIG={'NUM_FACET_ITEMS_PER_FACET': 2,
                                             'NUM_ANNOTATIONS_PER_FILE': 1}):
-            response = self.client.get(reverse('gcse_cse', args=(self.cse.gid,)))
+            self._add_annotation('Site Name 2')
+        response = self.client.get(reverse('gcse_cse', args=(self.cse.gid,)))
 
         self.assertEqual(200, response.status_code)
         self.assertContains(response,
                             '<CustomSearchEngine id="g123-456-AZ0" language="en" encoding="utf-8" enable_suggest="true">')
-        self.assertContains(response,
-                            '<Include type="Annotations" href="//example.com/annotations/g123-456-AZ0.0.xml"/>')
         self.assertContains(response,
                             '<Include type="Annotations" href="//example.com/annotations/g123-456-AZ0.1.xml"/>')
+        self.assertContains(response,
+                            '<Include type="Annotations" href="//example.com/annotations/g123-456-AZ0.2.xml"/>')
+
+    def test_cse_xml_includes_updated_when_annotation_deleted(self):
+        with override_settings(GCSE_CONFIG={'NUM_FACET_ITEMS_PER_FACET': 2,
+                                            'NUM_ANNOTATIONS_PER_FILE': 1}):
+            self._add_annotation('Site Name 2')
+            self.annotation.status = Annotation.STATUS.deleted
+            self.annotation.save()
+        response = self.client.get(reverse('gcse_cse', args=(self.cse.gid,)))
+
+        self.assertContains(response, '<Include type="Annotations"', count=1)
+
+    def test_cse_xml_is_a_single_read(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('gcse_cse', args=(self.cse.gid,)))
+        self.assertEqual(200, response.status_code)
+
+    def test_cse_xml_unknown_gid(self):
+        response = self.client.get(reverse('gcse_cse', args=('unknown',)))
+        self.assertEqual(404, response.status_code)
+
+    @patch.dict(settings.GCSE_CONFIG, {'ANNOTATION_FEED_KEYSET_PAGINATION': True,
+                                       'NUM_ANNOTATIONS_PER_FILE': 1})
+    def test_cse_xml_keyset_includes(self):
+        self._add_annotation('Site Name 2')
+        response = self.client.get(reverse('gcse_cse', args=(self.cse.gid,)))
+
+        self.assertContains(response,
+                            '<Include type="Annotations" href="//example.com/annotations/g123-456-AZ0.1.xml?after=0"/>')
+        self.assertContains(response,
+                            '<Include type="Annotations" href="//example.com/annotations/g123-456-AZ0.2.xml?after=%d"/>' % self.annotation.id)
+
+    def _later(self, seconds=2):
+        """Patch the clock of gcse.caching forward by the seconds."""
+        now = caching._now()
+        return patch('gcse.caching._now', return_value=now + seconds * 1000)
+
+    def test_cse_xml_not_modified(self):
+        caching.generation(self.cse.gid)
+        with self._later():
+            response = self.client.get(reverse('gcse_cse', args=(self.cse.gid,)))
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('gcse_cse', args=(self.cse.gid,)),
+                                       HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(304, response.status_code)
+
+    @patch.dict(settings.GCSE_CONFIG, {'CACHE_SHARED': None})
+    def test_cse_xml_not_modified_needs_shared_cache(self):
+        response = self.client.get(reverse('gcse_cse', args=(self.cse.gid,)))
+        self.assertFalse(response.has_header('ETag'))
+        self.assertFalse(response.has_header('Last-Modified'))
+
+    def test_cse_xml_modified_in_the_same_second(self):
+        url = reverse('gcse_cse', args=(self.cse.gid,))
+        # the generation's second hasn't passed
+        self.assertFalse(self.client.get(url).has_header('Last-Modified'))
+        with self._later():
+            last_modified = self.client.get(url)['Last-Modified']
+            self.assertEqual(304, self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code)
+            self.cse.title = 'New Title'
+            self.cse.save()
+            response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertContains(response, '<Title>New Title</Title>')
+
+    def test_cse_xml_modified_after_change(self):
+        response = self.client.get(reverse('gcse_cse', args=(self.cse.gid,)))
+        self.cse.title = 'New Title'
+        self.cse.save()
+
+        response = self.client.get(reverse('gcse_cse', args=(self.cse.gid,)),
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertContains(response, '<Title>New Title</Title>')
+
+    def test_annotations_xml_not_modified(self):
+        url = reverse('gcse_annotations', args=(self.cse.gid, 1))
+        response = self.client.get(url)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(304, response.status_code)
+
+        self._add_annotation('Site Name 2')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertContains(response, '<Comment>Site Name 2</Comment>')
+
+    def test_annotations_xml_invalidated_by_facet_label_change(self):
+        facet = Label.objects.create(name='facet', description='facet')
+        url = reverse('gcse_annotations', args=(self.cse.gid, 1))
+        etag = self.client.get(url)['ETag']
+
+        self.annotation.labels.add(facet)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, '<Label name="facet" />')
+        etag = response['ETag']
+
+        facet.annotation_set.remove(self.annotation)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotContains(response, '<Label name="facet" />')
 
     def test_cse_list_view(self):
         response = self.client.get(reverse('gcse_cse_list'))
@@ -78,29 +199,113 @@ class ViewsTemplatesTestCase(TestCase):
         self.assertContains(response, 'Description')
         self.assertContains(response, 'Page 1 of 1')
 
+    @patch.dict(settings.GCSE_CONFIG, {'ANNOTATION_FEED_CACHE_TIMEOUT': 0})
     def test_annotations_xml(self):
         response = self.client.get(reverse('gcse_annotations', args=(self.cse.gid, 1)))
 
         self.assertEqual(200, response.status_code)
-        self.assertTemplateUsed(response, 'gcse/annotation.xml')
+        self.assertTrue(response.streaming)
         self.assertContains(response, '<Annotations start="1" num="1" total="1">', count=1)
 
+    @patch.dict(settings.GCSE_CONFIG, {'ANNOTATION_FEED_CACHE_TIMEOUT': 0})
+    def test_annotations_xml_matches_template(self):
+        self._add_annotation('Site & "Name" <2>')
+        annotation = Annotation(comment='',
+                                original_url='',
+                                about="example.com/*",
+                                status=Annotation.STATUS.active)
+        annotation.save()
+        annotation.labels.add(self.label)
+
+        response = self.client.get(reverse('gcse_annotations', args=(self.cse.gid, 1)))
+
+        page = Paginator(self.cse.annotations().order_by('id'), CSEAnnotations.paginate_by).page(1)
+        expected = render_to_string('gcse/annotation.xml', {'page_obj': page,
+                                                            'annotations': page.object_list})
+        self.assertEqual(expected.encode('utf-8'), b''.join(response.streaming_content))
+
+    @patch.dict(settings.GCSE_CONFIG, {'ANNOTATION_FEED_CACHE_TIMEOUT': 0})
+    def test_annotations_xml_query_count_is_independent_of_page_size(self):
+        other = Label.objects.create(name='other', description='other')
+        for i in range(5):
+            self._add_annotation('Site Name %d' % i)
+        self.annotation.labels.add(other)
+
+        counts = []
+        for per_page in (1, 6):
+            CSEAnnotations.paginate_by = per_page
+            with CaptureQueriesContext(connection) as queries:
+                content = self._get_annotations_xml(1)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(6, content.count('<Label name="name" />'))
+        self.assertEqual(1, content.count('<Label name="other" />'))
+
+    def test_annotations_xml_is_served_from_cache(self):
+        first = self.client.get(reverse('gcse_annotations', args=(self.cse.gid, 1)))
+        with self.assertNumQueries(0), self._later():
+            second = self.client.get(reverse('gcse_annotations', args=(self.cse.gid, 1)))
+
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(first['ETag'], second['ETag'])
+        self.assertTrue(second.has_header('Last-Modified'))
+
+    def test_cached_annotations_xml_invalidated_by_new_annotation(self):
+        self._get_annotations_xml(1)
+        self._add_annotation('Site Name 2')
+
+        self.assertTrue('<Comment>Site Name 2</Comment>' in self._get_annotations_xml(1))
+
+    def test_cached_annotations_xml_invalidated_by_label_change(self):
+        self._get_annotations_xml(1)
+        self.label.name = 'renamed'
+        self.label.save()
+
+        self.assertTrue('<Label name="renamed" />' in self._get_annotations_xml(1))
+
+    def test_cached_annotations_xml_invalidated_by_background_label_removal(self):
+        self._get_annotations_xml(1)
+        self.cse.background_labels.remove(self.label)
+
+        self.assertFalse('<Comment>A Site Name</Comment>' in self._get_annotations_xml(1))
+
+    def test_keyset_annotations_xml(self):
+        self._add_annotation('Site Name 2')
+        CSEAnnotations.paginate_by = 1
+        # the total is read from gcse.counters
+        self.cse.annotation_count()
+
+        with CaptureQueriesContext(connection) as queries:
+            content = self._get_annotations_xml(2, after=self.annotation.id)
+        self.assertEqual(1, content.count('<Annotations start="2" num="2" total="2">'))
+        self.assertEqual(1, content.count('<Comment>Site Name 2</Comment>'))
+        self.assertFalse([q for q in queries.captured_queries if 'OFFSET' in q['sql'] or 'COUNT(' in q['sql']])
+
+        content = self._get_annotations_xml(1, after=0)
+        self.assertEqual(1, content.count('<Annotations start="1" num="1" total="2">'))
+        self.assertEqual(1, content.count('<Comment>A Site Name</Comment>'))
+
+    def test_keyset_annotations_xml_invalid_after(self):
+        response = self.client.get(reverse('gcse_annotations', args=(self.cse.gid, 1)) + '?after=x')
+        self.assertEqual(404, response.status_code)
+
+    def test_annotations_xml_pages_start_at_one(self):
+        for after in ('', '?after=0'):
+            response = self.client.get(reverse('gcse_annotations', args=(self.cse.gid, 0)) + after)
+            self.assertEqual(404, response.status_code)
+
     def test_multiple_page_annotations_xml(self):
         self._add_annotation('Site Name 2')
         CSEAnnotations.paginate_by = 1 # one per page
 
-        response = self.client.get(reverse('gcse_annotations', args=(self.cse.gid, 1)))
-        self.assertEqual(200, response.status_code)
-        self.assertTemplateUsed(response, 'gcse/annotation.xml')
-        self.assertContains(response, '<Annotations start="1" num="1" total="2">', count=1)
-        self.assertContains(response, '<Comment>A Site Name</Comment>', count=1)
+        content = self._get_annotations_xml(1)
+        self.assertEqual(1, content.count('<Annotations start="1" num="1" total="2">'))
+        self.assertEqual(1, content.count('<Comment>A Site Name</Comment>'))
 
         # get page 2
-        response = self.client.get(reverse('gcse_annotations', args=(self.cse.gid, 2)))
-        self.assertEqual(200, response.status_code)
-        self.assertTemplateUsed(response, 'gcse/annotation.xml')
-        self.assertContains(response, '<Annotations start="2" num="2" total="2">', count=1)
-        self.assertContains(response, '<Comment>Site Name 2</Comment>', count=1)
+        content = self._get_annotations_xml(2)
+        self.assertEqual(1, content.count('<Annotations start="2" num="2" total="2">'))
+        self.assertEqual(1, content.count('<Comment>Site Name 2</Comment>'))
 
     def test_annotation_list_for_cse(self):
         response = self.client.get(reverse('gcse_cse_annotation_list', kwargs={'gid': self.cse.gid}))
@@ -184,6 +389,86 @@ class ViewsTemplatesTestCase(TestCase):
         self.assertContains(response, "disabled", 35)
         self.assertContains(response, "selected", 1)
 
+    def _count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        return len(queries)
+
+    def test_annotation_list_queries_independent_of_page_size(self):
+        facet = Label.objects.create(name='facet', description='facet')
+        urls = [reverse('gcse_annotation_list'),
+                reverse('gcse_search') + '?q=example',
+                reverse('gcse_label_detail', args=(self.label.id,)),
+                reverse('gcse_cse_annotation_list', args=(self.cse.gid,)),
+                reverse('gcse_cse_label_detail', args=(self.cse.gid, self.label.id))]
+        # the first requests compute the Annotation counts
+        [self._count_queries(url) for url in urls]
+        counts = [self._count_queries(url) for url in urls]
+        for i in range(5):
+            annotation = Annotation.objects.create(comment='Another %d' % i,
+                                                   original_url='http://example.com/',
+                                                   status=Annotation.STATUS.active)
+            annotation.labels.add(self.label, facet)
+        self.assertEqual(counts, [self._count_queries(url) for url in urls])
+
+    def _add_labels(self, start, stop):
+        for i in range(start, stop):
+            background = Label.objects.create(name='background %d' % i, background=True)
+            self.cse.background_labels.add(background)
+            facet = Label.objects.create(name='facet %d' % i)
+            FacetItem.objects.create(cse=self.cse, title='Facet %d' % i, label=facet)
+            self.annotation.labels.add(background, facet)
+
+    def test_cse_pages_queries_independent_of_labels(self):
+        urls = [reverse('gcse_cse_detail', args=(self.cse.gid,)),
+                reverse('gcse_cse_annotation_list', args=(self.cse.gid,)),
+                reverse('gcse_cse_label_list', args=(self.cse.gid,)),
+                reverse('gcse_cse_label_detail', args=(self.cse.gid, self.label.id))]
+        self._add_labels(0, 1)
+        # the first requests compute the Annotation counts
+        [self._count_queries(url) for url in urls]
+        counts = [self._count_queries(url) for url in urls]
+        self._add_labels(1, 4)
+        [self._count_queries(url) for url in urls]
+        self.assertEqual(counts, [self._count_queries(url) for url in urls])
+
+    def test_cse_context_loads_once(self):
+        self._add_labels(0, 1)
+        facet_labels = list(self.cse.facet_item_labels())
+        labels_counts = self.cse.labels_counts()
+        background_label_ids = set(self.cse.background_labels.values_list('id', flat=True))
+        context = CSEContext(self.cse.gid)
+        context.annotation_count()
+        context.facet_labels
+        context.labels_counts
+        context.background_label_ids
+        with self.assertNumQueries(0):
+            self.assertEqual(1, context.annotation_count())
+            self.assertEqual(facet_labels, context.facet_labels)
+            self.assertEqual(labels_counts, context.labels_counts)
+            self.assertEqual(background_label_ids, set(context.background_label_ids))
+
+    def test_cse_context_unknown_gid(self):
+        self.assertRaises(Http404, CSEContext, 'unknown')
+
+    def test_label_list_prefetched_cses(self):
+        url = reverse('gcse_label_list')
+        count = self._count_queries(url)
+        self._add_labels(0, 3)
+        self.assertEqual(count, self._count_queries(url))
+        label, = Label.prefetch_cses(Label.objects.filter(name='facet 0'))
+        with self.assertNumQueries(0):
+            self.assertEqual([self.cse], label.cses())
+
+    def test_annotation_list_prefetched_cses(self):
+        other = CustomSearchEngine.objects.create(gid="other", title="Other CSE")
+        other.background_labels.add(self.label)
+        annotation, = Annotation.prefetch_cses(Annotation.objects.filter(pk=self.annotation.pk))
+        with self.assertNumQueries(0):
+            self.assertEqual([self.cse, other], annotation.cses())
+            self.assertTrue('>name</a>' in annotation.labels_as_links())
+
     def test_annotation_detail(self):
         response = self.client.get(reverse('gcse_annotation_detail', kwargs={'id': self.annotation.id}))
 
@@ -277,3 +562,114 @@ class ViewsTemplatesTestCase(TestCase):
         response = self.client.get(reverse('gcse_results',  kwargs={'gid': self.cse.gid}))
         self.assertEqual(200, response.status_code)
         self.assertTemplateUsed(response, 'gcse/cse_results.html')
+
+
+@patch.dict(settings.GCSE_CONFIG, {'PAGE_CACHE_TIMEOUT': 60})
+class PageCacheTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.label = Label.objects.create(name='name', description='description')
+        self.other_label = Label.objects.create(name='other', description='other')
+        self.annotation = Annotation.objects.create(comment='A Site Name',
+                                                    original_url='http://example.com/',
+                                                    status=Annotation.STATUS.active)
+        self.annotation.labels.add(self.label)
+        self.cse = CustomSearchEngine.objects.create(gid="g123-456-AZ0",
+                                                     title="CSE 1234568",
+                                                     description="Description")
+        self.cse.background_labels.add(self.label)
+        self.other_cse = CustomSearchEngine.objects.create(gid="g123-456-AZ1",
+                                                           title="Other CSE",
+                                                           description="Other")
+
+    def tearDown(self):
+        cache.clear()
+
+    def _get(self, url):
+        """Return the number of queries answering the request and the response."""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        return len(queries), response
+
+    def _is_cached(self, url):
+        return self._get(url)[0] == 0
+
+    def test_pages_are_served_from_cache(self):
+        for url in [reverse('gcse_cse_list'),
+                    reverse('gcse_cse_detail', args=(self.cse.gid,)),
+                    reverse('gcse_cse_label_list', args=(self.cse.gid,)),
+                    reverse('gcse_annotation_list'),
+                    reverse('gcse_annotation_detail', args=(self.annotation.id,)),
+                    reverse('gcse_label_list'),
+                    reverse('gcse_label_detail', args=(self.label.id,))]:
+            queries, response = self._get(url)
+            self.assertNotEqual(0, queries)
+            cached_queries, cached = self._get(url)
+            self.assertEqual(0, cached_queries, url)
+            self.assertEqual(response.content, cached.content)
+
+    def test_query_strings_are_cached_separately(self):
+        url = reverse('gcse_annotation_list')
+        self._get(url + '?q=A')
+        self.assertFalse(self._is_cached(url + '?q=B'))
+
+    def test_local_memory_cache_is_not_used(self):
+        url = reverse('gcse_cse_detail', args=(self.cse.gid,))
+        with patch.dict(settings.GCSE_CONFIG, {'CACHE_SHARED': None}), \
+                warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self._get(url)
+            self.assertFalse(self._is_cached(url))
+        self.assertTrue("GCSE_CONFIG['PAGE_CACHE_TIMEOUT'] is ignored" in str(caught[0].message))
+
+    def test_caching_is_disabled_by_default(self):
+        url = reverse('gcse_cse_detail', args=(self.cse.gid,))
+        with patch.dict(settings.GCSE_CONFIG, {'PAGE_CACHE_TIMEOUT': 0}):
+            self._get(url)
+            self.assertFalse(self._is_cached(url))
+
+    def test_cse_change_invalidates_only_its_pages(self):
+        url = reverse('gcse_cse_detail', args=(self.cse.gid,))
+        other_url = reverse('gcse_cse_detail', args=(self.other_cse.gid,))
+        self._get(url)
+        self._get(other_url)
+        self.cse.title = 'Renamed'
+        self.cse.save()
+        queries, response = self._get(url)
+        self.assertContains(response, 'Renamed')
+        self.assertTrue(self._is_cached(other_url))
+
+    def test_annotation_change_invalidates_its_label_and_cse_pages(self):
+        urls = [reverse('gcse_annotation_list'),
+                reverse('gcse_label_detail', args=(self.label.id,)),
+                reverse('gcse_cse_annotation_list', args=(self.cse.gid,))]
+        unaffected = [reverse('gcse_label_detail', args=(self.other_label.id,)),
+                      reverse('gcse_cse_detail', args=(self.other_cse.gid,)),
+                      reverse('gcse_cse_list')]
+        for url in urls + unaffected:
+            self._get(url)
+        self.annotation.comment = 'A Renamed Site'
+        self.annotation.save()
+        for url in urls:
+            self.assertFalse(self._is_cached(url), url)
+        for url in unaffected:
+            self.assertTrue(self._is_cached(url), url)
+
+    def test_label_change_invalidates_label_pages(self):
+        url = reverse('gcse_label_list')
+        self._get(url)
+        self.other_label.name = 'renamed'
+        self.other_label.save()
+        queries, response = self._get(url)
+        self.assertContains(response, 'renamed')
+
+    def test_authenticated_users_are_not_cached(self):
+        request = RequestFactory().get(reverse('gcse_cse_detail', args=(self.cse.gid,)))
+        request.user = Mock(is_authenticated=Mock(return_value=True))
+        view = CustomSearchEngineDetail.as_view()
+        view(request, gid=self.cse.gid).render()
+        with CaptureQueriesContext(connection) as queries:
+            view(request, gid=self.cse.gid).render()
+        self.assertNotEqual(0, len(queries))